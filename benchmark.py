@@ -0,0 +1,218 @@
+"""
+End-to-end benchmark
+
+Runs a Session fed by a SimulatedBoard, a Server and a Client on localhost and
+writes a JSON report of:
+    cycles per second sustained by the Session
+    parse / convert cost per frame (and every other hot path stage, see metrics)
+    sample-to-client latency percentiles (board write to client receive, in ms)
+    bytes per message received by the client
+    write throughput of the local and client logs (HDF5 or segment logs)
+    rate / lag of each board (with --boards > 1, see MultiBoardReader)
+
+    python benchmark.py --rate 0 --ports 4 --sub_sensors 8 --duration 30
+    python benchmark.py --boards 4 --ports 8 --transport pty --alignment latest
+"""
+from sensational import Sensor, Session, Server, Client, SimulatedBoard
+from metrics import metrics
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+from time import perf_counter, sleep
+import numpy as np
+
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-p', '--port', help='Websocket port', default='8765')
+parser.add_argument('--rate', help='Frames per second of board (0 for as fast as possible)', default='1000')
+parser.add_argument('--ports', help='Number of ports', default='1')
+parser.add_argument('--boards', help='Number of boards (ports are split between boards)', default='1')
+parser.add_argument('--alignment', help='Alignment of boards (latest, nearest or interpolate)', default='latest')
+parser.add_argument('--sub_sensors', help='Number of sub sensors per port', default='1')
+parser.add_argument('--corruption_rate', help='Fraction of corrupted frames', default='0')
+parser.add_argument('--protocol', help='Wire format of board (ascii or binary)', default='ascii')
+parser.add_argument('--transport', help='Serial transport (loop or pty)', default='loop')
+parser.add_argument('--payload_format', help='Payload format of client (json or binary)', default='json')
+parser.add_argument('--log_interval', help='Number of cycles between logs', default='100')
+parser.add_argument('--duration', help='Length of measurement (in s)', default='10')
+parser.add_argument('--warmup', help='Time before measurement starts (in s)', default='1')
+parser.add_argument('--log_format', help='Log format of session and client (hdf5 or segments)', default='hdf5')
+parser.add_argument('--log_dir', help='Directory for log files (temporary if not given)', default=None)
+parser.add_argument('-o', '--output', help='Results file', default='benchmark_results.json')
+parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='ERROR')
+args = parser.parse_args()
+logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+num_ports = int(args.ports)
+num_sub_sensors = int(args.sub_sensors)
+ports = list(range(1, num_ports + 1))
+log_dir = args.log_dir or tempfile.mkdtemp(prefix='sensational_benchmark_')
+
+# Samples hold the frame sequence number (see SimulatedBoard), so keep them as is
+def make_sensor(i):
+    return Sensor(name='Sensor %d' % i,
+                  sub_sensors=['value_%d' % j for j in range(num_sub_sensors)],
+                  model='Simulated',
+                  ranges=[[0, 2**24]]*num_sub_sensors,
+                  precisions=[0.01]*num_sub_sensors,
+                  thresholds=[[-1, 2**24]]*num_sub_sensors,
+                  shutdown_times=[[500, 500]]*num_sub_sensors,
+                  conversions=['x']*num_sub_sensors,
+                  units=['count']*num_sub_sensors,
+                  documentation='',
+                  position=[0, 0])
+
+class BenchmarkClient(Client):
+    def __init__(self, board, *args, **kwargs):
+        # Board to look up send times of samples
+        self.board = board
+        # Latency of newest sample of each LOG_UPDATE (in s)
+        self.latencies = []
+        super().__init__(*args, **kwargs)
+
+    def log_data(self, dataset):
+        received = perf_counter()
+        sensor = self.sensors[0]
+        samples = dataset[sensor.name][sensor.sub_sensors[0]]
+        # Missing samples are replaced by means (not a sequence number)
+        if len(samples) and float(samples[-1]).is_integer():
+            sent = self.board.sent_time(samples[-1])
+            if sent is not None:
+                self.latencies.append(received - sent)
+        super().log_data(dataset)
+
+# Run an asyncio based object on its own event loop
+def run_in_thread(target, name):
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        target()
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+# Wait until the websocket server accepts connections
+def wait_for_server(port, timeout=10):
+    end = perf_counter() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), 1).close()
+            return
+        except OSError:
+            if perf_counter() > end:
+                raise
+            sleep(0.05)
+
+# Percentiles of latencies (in ms)
+def latency_report(latencies):
+    if not latencies:
+        return {'count': 0}
+    latencies = np.asarray(latencies) * 1000
+    report = {'count': len(latencies), 'mean': latencies.mean(), 'max': latencies.max()}
+    for percentile in [50, 90, 99]:
+        report['p%d' % percentile] = np.percentile(latencies, percentile)
+    return {key: value if key == 'count' else float(value) for key, value in report.items()}
+
+# Size of a log file or directory (in bytes)
+def log_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+# Init boards and session
+num_boards = int(args.boards)
+boards = [SimulatedBoard(ports[i::num_boards], num_sub_sensors, float(args.rate), args.protocol,
+                         float(args.corruption_rate)) for i in range(num_boards)]
+com_ports = [board.open_pty() if args.transport == 'pty' else 'loop://' for board in boards]
+if num_boards > 1:
+    sess = Session('Benchmark', ports, log_dir, int(args.log_interval), 100000, None,
+                   log_file='benchmark_session', log_format=args.log_format, alignment=args.alignment,
+                   boards=[{'com_port': com_port, 'ports': board.ports, 'protocol': args.protocol}
+                           for board, com_port in zip(boards, com_ports)])
+    serials = [reader.board for reader in sess.reader.readers]
+else:
+    sess = Session('Benchmark', ports, log_dir, int(args.log_interval), 100000, com_ports[0],
+                   log_file='benchmark_session', protocol=args.protocol, log_format=args.log_format)
+    serials = [sess.board]
+if args.transport != 'pty':
+    for board, serial_port in zip(boards, serials):
+        board.connect(serial_port)
+sensors = [make_sensor(i) for i in range(num_ports)]
+for port_index, sensor in enumerate(sensors):
+    sess.attach(sensor, port_index)
+for board in boards:
+    board.start()
+
+# Start server and client
+server = Server(sess, int(args.port))
+run_in_thread(server.start, 'server')
+wait_for_server(int(args.port))
+client = BenchmarkClient(boards[0], sensors, 'localhost', args.port, os.path.join(log_dir, 'client'), 'benchmark_client',
+                         payload_format=args.payload_format, log_format=args.log_format)
+run_in_thread(client.start, 'client')
+sleep(float(args.warmup))
+
+# Measure
+metrics.reset()
+client.latencies = []
+first_cycle, first_frame = sess.cycle_number, sum(board.frames_sent for board in boards)
+first_messages, first_bytes = client.messages_received, client.bytes_received
+first_rows = sess.log.length + client.log.length
+start = perf_counter()
+sleep(float(args.duration))
+elapsed = perf_counter() - start
+cycles = sess.cycle_number - first_cycle
+frames = sum(board.frames_sent for board in boards) - first_frame
+messages = client.messages_received - first_messages
+message_bytes = client.bytes_received - first_bytes
+latencies = list(client.latencies)
+# Rows written to logs (both logs)
+log_rows = sess.log.length + client.log.length - first_rows
+stats = metrics.get_stats()
+
+# Stop acquisition before closing logs
+server.acquisition.stop()
+server.acquisition.join(1)
+for board in boards:
+    board.stop()
+log_paths = [sess.log.path, client.log.path]
+sess.stop()
+client.close()
+
+stages = stats['stages']
+# Stage of log writes
+write_stage = stages.get('segment_write' if args.log_format == 'segments' else 'hdf5_flush', {})
+results = {
+    'config': vars(args),
+    'duration': elapsed,
+    'frames_sent': frames,
+    'frames_corrupted': sum(board.corrupted for board in boards),
+    'cycles': cycles,
+    'cycles_per_second': cycles / elapsed,
+    'frames_dropped': sess.reader.dropped,
+    'frames_lost': sess.lost_frames,
+    'counters': stats['counters'],
+    'safety': sess.safety.get_stats(),
+    'boards': sess.reader.get_stats() if num_boards > 1 else None,
+    # Mean cost per frame / message (in s)
+    'stage_seconds': {stage: stage_stats['mean'] for stage, stage_stats in stages.items()},
+    'latency_ms': latency_report(latencies),
+    'messages': messages,
+    'bytes_per_message': message_bytes / messages if messages else None,
+    'log': {
+        'format': args.log_format,
+        'rows': log_rows,
+        'writes': write_stage.get('count', 0),
+        'write_seconds': write_stage.get('total', 0),
+        'file_bytes': sum(log_size(path) for path in log_paths)
+    }
+}
+results['log']['rows_per_second'] = (results['log']['rows'] / results['log']['write_seconds']
+                                     if results['log']['write_seconds'] else None)
+with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+print(json.dumps(results, indent=2))
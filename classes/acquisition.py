@@ -0,0 +1,69 @@
+"""
+Acquisition Class
+
+Runs the cycles of a Session on a dedicated thread so that blocking serial reads
+never stall the asyncio event loop of the Server. There is one acquisition
+worker per Session, started with the server, so the acquisition rate does not
+depend on the number (or speed) of connected clients.
+
+Events are published to the event loop thru an asyncio.Queue using
+loop.call_soon_threadsafe as tuples of form (event, cycle_number):
+    ('NEW_DATA', cycle_number): new cycles are in the buffer (coalesced, at
+                                most one pending event at a time)
+    ('LOG_READY', cycle_number): Session.log_interval cycles are ready to log
+"""
+import logging
+import threading
+
+logger = logging.getLogger('sensational.acquisition')
+
+class Acquisition(threading.Thread):
+    def __init__(self, session, loop, events):
+        super().__init__(name='acquisition', daemon=True)
+        # Fully initialized Session instance
+        self.session = session
+        # Event loop to publish events to
+        self.loop = loop
+        # asyncio.Queue of events
+        self.events = events
+        # Run flag
+        self.running = False
+        # Flag for pending NEW_DATA event
+        self.new_data_scheduled = False
+        # Exception that stopped acquisition (if any)
+        self.error = None
+
+    # Run cycles until stopped
+    def run(self):
+        self.running = True
+        try:
+            for data, cycle_time, should_log in self.session:
+                self.notify_new_data()
+                if should_log:
+                    self.loop.call_soon_threadsafe(self.publish, 'LOG_READY', self.session.cycle_number)
+                if not self.running:
+                    break
+        except Exception as e:
+            self.error = e
+            logger.exception('Acquisition Error: %s', e)
+        finally:
+            self.running = False
+
+    # Stop after current cycle
+    def stop(self):
+        self.running = False
+
+    # Schedule NEW_DATA event (called from acquisition thread)
+    def notify_new_data(self):
+        if not self.new_data_scheduled:
+            self.new_data_scheduled = True
+            self.loop.call_soon_threadsafe(self.publish_new_data)
+
+    # Publish NEW_DATA event (called from event loop)
+    def publish_new_data(self):
+        self.new_data_scheduled = False
+        self.publish('NEW_DATA', self.session.cycle_number)
+
+    # Publish event (called from event loop)
+    def publish(self, event, cycle_number):
+        self.events.put_nowait((event, cycle_number))
@@ -0,0 +1,140 @@
+"""
+Binary Frame Protocol
+
+Compact alternative to the ASCII 'port:v1,v2;port:v1?' format. Each cycle is
+sent as one length-prefixed frame (all fields little-endian):
+
+    sync        uint16   0x5AA5 (bytes A5 5A)
+    length      uint16   number of bytes from sequence thru crc
+    sequence    uint32   cycle counter of board (wraps at 2^32)
+    num_ports   uint8    number of port blocks
+    port blocks:
+        port    uint8    port number (as in Session.ports)
+        count   uint8    number of samples
+        samples float32  * count
+    crc         uint32   CRC-32 (zlib.crc32) of sequence thru last port block
+
+Corrupted frames fail the CRC check and are dropped, lost frames are detected
+from gaps in the sequence number (see BinaryFrameReader.lost). A sequence number
+that does not move forward (board restarted or frame repeated) is a resync, not
+a gap (see BinaryFrameReader.resyncs). Samples are
+decoded with numpy.frombuffer so they can be copied straight into the buffer.
+
+encode_binary_frame is the reference encoder, so both sides of the protocol can
+be tested without hardware:
+    board.write(encode_binary_frame(sequence, [(17, [1.5, 2.5])]))
+"""
+import struct
+import zlib
+from time import perf_counter
+import numpy as np
+from frame_reader import FrameReader
+
+# Start of frame marker
+SYNC = b'\xa5\x5a'
+# Header: sync, length
+HEADER = struct.Struct('<2sH')
+# Frame info: sequence, num_ports
+INFO = struct.Struct('<IB')
+# Port block info: port, count
+BLOCK = struct.Struct('<BB')
+# Checksum
+CRC = struct.Struct('<I')
+# Sample data type
+SAMPLE_DTYPE = np.dtype('<f4')
+# Sequence numbers wrap at 2^32, gaps of half the range or more are backward jumps
+SEQUENCE_RANGE = 2**32
+
+# Encode a frame from a list of (port, samples)
+def encode_binary_frame(sequence, port_data):
+    body = bytearray(INFO.pack(sequence % 2**32, len(port_data)))
+    for port, samples in port_data:
+        samples = np.asarray(samples, dtype=SAMPLE_DTYPE)
+        body += BLOCK.pack(port, len(samples))
+        body += samples.tobytes()
+    body += CRC.pack(zlib.crc32(body))
+    return HEADER.pack(SYNC, len(body)) + bytes(body)
+
+# Decode body of a frame (sequence thru last port block)
+# Returns (sequence, [(port, samples), ...])
+def decode_binary_body(body):
+    sequence, num_ports = INFO.unpack_from(body)
+    offset = INFO.size
+    port_data = []
+    for _ in range(num_ports):
+        port, count = BLOCK.unpack_from(body, offset)
+        offset += BLOCK.size
+        samples = np.frombuffer(body, dtype=SAMPLE_DTYPE, count=count, offset=offset)
+        offset += count * SAMPLE_DTYPE.itemsize
+        port_data.append((port, samples))
+    if offset != len(body):
+        raise ValueError('Frame length does not match port blocks')
+    return sequence, port_data
+
+class BinaryFrameReader(FrameReader):
+    def __init__(self, board, max_frame_length=4096):
+        super().__init__(board, terminator=SYNC, max_frame_length=max_frame_length)
+        # Sequence number of last frame
+        self.last_sequence = None
+        # Number of frames lost (gaps in sequence numbers)
+        self.lost = 0
+        # Number of times the sequence number jumped back (restart / repeated frame)
+        self.resyncs = 0
+
+    # Add bytes to pending data and queue any complete frames
+    # arrival: time (from perf_counter) the bytes were read (now if not given)
+    def feed(self, chunk, arrival=None):
+        self.chunk_arrival = perf_counter() if arrival is None else arrival
+        self.pending += chunk
+        pending = self.pending
+        while True:
+            # Find start of frame
+            start = pending.find(SYNC)
+            if start < 0:
+                # Keep last byte in case it is the start of a sync word
+                del pending[:-1]
+                return
+            # Everything before sync word is garbage
+            if start > 0:
+                del pending[:start]
+            # Wait for header
+            if len(pending) < HEADER.size:
+                return
+            _, length = HEADER.unpack_from(pending)
+            # Invalid length, skip sync word
+            if length < INFO.size + CRC.size or length > self.max_frame_length:
+                self.dropped += 1
+                del pending[:len(SYNC)]
+                continue
+            # Wait for rest of frame
+            end = HEADER.size + length
+            if len(pending) < end:
+                return
+            body = bytes(pending[HEADER.size:end - CRC.size])
+            crc, = CRC.unpack_from(pending, end - CRC.size)
+            # Corrupted frame, skip sync word and search again
+            if crc != zlib.crc32(body):
+                self.dropped += 1
+                del pending[:len(SYNC)]
+                continue
+            del pending[:end]
+            self.synced = True
+            self.add_frame(body)
+
+    # Decode and queue a complete frame
+    def add_frame(self, body):
+        try:
+            sequence, port_data = decode_binary_body(body)
+        except (ValueError, struct.error):
+            self.dropped += 1
+            return
+        # Check for lost frames
+        if self.last_sequence is not None:
+            gap = (sequence - self.last_sequence - 1) % SEQUENCE_RANGE
+            # Sequence did not move forward, start counting again from here
+            if gap >= SEQUENCE_RANGE // 2:
+                self.resyncs += 1
+            else:
+                self.lost += gap
+        self.last_sequence = sequence
+        self.queue_frame((sequence, port_data))
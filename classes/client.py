@@ -3,17 +3,35 @@ Base Client Class
 author: Adam Johnston
 
 Class for client side (computer) to log data and handle GUI communication
+
+With payload_format='binary' the client requests binary payloads from the
+server (see payload module), which are decoded without copying the data.
+
+With subscription set, the client subscribes to a subset of channels and / or a
+limited update rate, i.e. {'channels': {'sensor_1': ['x']}, 'max_rate': 2,
+'decimation': 10} (see subscription module). Sub sensors that are not
+subscribed are logged as missing (NaN).
+
+The log file stays open while the client is running and is written in batches
+by a background thread (see LogWriter class). With log_format='segments' the
+log is a memory-mapped segment log instead (see SegmentLogWriter class).
 """
 
 import numpy as np
 import asyncio
 import websockets
 import os
-import h5py
 import json
+import logging
+from payload import decode_payload, is_payload
+from log_writer import LogWriter
+from segment_log import SegmentLogWriter
+
+logger = logging.getLogger('sensational.client')
 
 class Client:
-    def __init__(self, sensors, ip, port, log_dir, log_file, log_size=10e3):
+    def __init__(self, sensors, ip, port, log_dir, log_file, log_size=10e3, payload_format='json',
+                 log_compression=None, log_format='hdf5', subscription=None):
         # List of sensors from session (instance of Sensor class)
         self.sensors = sensors
         # IP Address of RPi
@@ -24,33 +42,65 @@ class Client:
         self.log_dir = log_dir
         # Name of log file
         self.log_file = log_file
-        # Resize interval / initial length of log file (per sensor + times)
-        # Default: 1 kB per sensor
+        # Initial length of log file (per sensor + times), grows geometrically
         self.log_size = log_size
-        # Counter of resizes
-        self.num_log_resizes = 1
         # Current log_file index
         self.log_index = 0
+        # Log writer (created in init_log)
+        self.log = None
+        # Compression of log file ('gzip', 'lzf' or None, see LogWriter class)
+        self.log_compression = log_compression
+        # Format of log file ('hdf5' or 'segments')
+        if log_format not in ['hdf5', 'segments']:
+            raise ValueError('Unknown log format %s' % log_format)
+        self.log_format = log_format
+        # Payload format requested from server ('json' or 'binary')
+        self.payload_format = payload_format
+        # Subscription requested from server (None for full updates)
+        self.subscription = subscription
+        # Number of messages / bytes received
+        self.messages_received = 0
+        self.bytes_received = 0
         # Initialize log
         self.init_log()
 
     # Start client
     def start(self):
-        asyncio.get_event_loop().run_until_complete(self.listen())
+        try:
+            asyncio.get_event_loop().run_until_complete(self.listen())
+        finally:
+            self.close()
+
+    # Write remaining data and close log file
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            logger.info('Closed log file %s', self.log_file)
 
     # Open port and listen
     async def listen(self):
         async with websockets.connect('ws://' + str(self.ip) + ':' + str(self.port)) as websocket:
-            print('Connected to port %s' % self.port)
+            logger.info('Connected to port %s', self.port)
+            # Request payload format
+            await websocket.send('FORMAT::%s' % self.payload_format)
+            if self.subscription is not None:
+                await websocket.send('SUBSCRIBE::' + json.JSONEncoder().encode(self.subscription))
             while True:
-                print('Listening...')
-                json_data = await websocket.recv()
-                print('Received data...')
-                print(json_data)
-                data = json.JSONDecoder().decode(json_data)
+                logger.debug('Listening...')
+                message = await websocket.recv()
+                logger.debug('Received data...')
+                self.messages_received += 1
+                self.bytes_received += len(message)
+                if is_payload(message):
+                    data = decode_payload(message)
+                else:
+                    logger.debug(message)
+                    data = json.JSONDecoder().decode(message)
                 if data['action'] == 'LOG_UPDATE':
-                    print('Logging data...')
+                    logger.debug('Logging data...')
                     self.log_data(data)
+                elif data['action'] == 'ERROR':
+                    logger.error('Server rejected %s request: %s', data.get('request'), data.get('message'))
 
     # Initialize log file
     def init_log(self):
@@ -86,27 +136,23 @@ class Client:
         else:
             filename = self.log_file
         # Check for file extension
-        if filename[-5:] != '.hdf5':
-            filename += '.hdf5'
+        extension = '.seg' if self.log_format == 'segments' else '.hdf5'
+        if not filename.endswith(extension):
+            filename += extension
         # Loop until successful
         filename_error = True
         # Create new, error if exists
         open_type = 'x'
         while filename_error:
             try:
-                with h5py.File(self.log_dir + '/' + filename, open_type) as f:
-                    # Create main groups
-                    times = f.create_group('times')
-                    times.create_dataset('t', (self.log_size,), maxshape=(None,))
-                    # NOTE: port is index of port
-                    # Loop thru sensors and create groups / sub-groups
-                    # TODO: More than just data, i.e. thresholds
-                    for port, sensor in enumerate(self.sensors):
-                        if sensor:
-                            group = f.create_group(sensor.name)
-                            for sub_sensor in sensor.sub_sensors:
-                                sub_group = group.create_group(sub_sensor)
-                                sub_group.create_dataset('data', (self.log_size,), maxshape=(None,))
+                # NOTE: port is index of port
+                # Creates groups / sub-groups for each sensor
+                # TODO: More than just data, i.e. thresholds
+                if self.log_format == 'segments':
+                    self.log = SegmentLogWriter(self.log_dir + '/' + filename, self.sensors, open_type)
+                else:
+                    self.log = LogWriter(self.log_dir + '/' + filename, self.sensors, open_type, self.log_size,
+                                         compression=self.log_compression)
             # TODO: Send error to GUI
             # File exists
             # TODO: Create metadata for files so that logs can be continued
@@ -118,9 +164,9 @@ class Client:
                     if confirm_overwrite and confirm_overwrite.lower()[0] == 'y':
                         print('Overwriting data in log file %s' % filename)
                         self.log_file = filename
-                        # Overwrite old file
+                        # Overwrite old file (retry with new open type)
                         open_type = 'w'
-                        break
+                        continue
                 filename = input('New filename: ')
 
             else:
@@ -130,44 +176,7 @@ class Client:
 
     # Log data to log file
     def log_data(self, dataset):
-        # Write to hdf5 file
-        with h5py.File(self.log_dir + '/' + self.log_file, 'a') as f:
-            should_resize = False
-            # Get current log position
-            start_index = self.log_index
-            print('Start Index:')
-            print(start_index)
-            # Get end of log index
-            end_index = start_index + len(dataset['times']['t'])
-            # Reset log index for next log
-            self.log_index += end_index
-            print('Log Data:')
-            print(dataset)
-            # Try writing to file (to check if full)
-            try:
-                f['times']['t'][start_index:end_index] = dataset['times']['t']
-            except TypeError as e:
-                # Add to resize counter
-                self.num_log_resizes += 1
-                # TODO: Grab actual error
-                # Calc new size
-                new_size = self.log_size * self.num_log_resizes
-                # Resize and write times
-                f['times']['t'].resize(new_size)
-                f['times']['t'][start_index:end_index] = self.times[indices]
-                # Flag for other dsets
-                should_resize = True
-            # Loop thru sensors
-            for main_key, sensor_data in dataset.items():
-                # Ignore non-sensor data
-                if main_key in [s.name for s in self.sensors]:
-                    # Loop thru each sub sensor
-                    for sub_key, sub_data in sensor_data.items():
-                        dset = f[main_key][sub_key]['data']
-                        print('Sub Data:')
-                        print(sub_data)
-                        # Resize if necessary
-                        if should_resize:
-                            dset.resize(new_size)
-                        # Write data
-                        dset[start_index:end_index] = sub_data
+        # Queue data for background writer
+        self.log.append_dataset(dataset)
+        # Update log index for next log
+        self.log_index = len(self.log)
@@ -0,0 +1,121 @@
+"""
+Client Queue Class
+
+Bounded outbound message queue for a single websocket client. Messages are
+encoded once by the Server and the same message is put on the queue of every
+client. Each queue is served by its own writer task, so a slow client only
+delays itself.
+
+When the queue is full, the overflow policy decides what happens:
+    'drop_oldest': drop the oldest queued message
+    'latest': coalesce to the latest message (queue holds at most one message)
+    'disconnect': close the connection to the client
+
+Queue depth, lag (age of oldest queued message in s), sent and dropped message
+counts are available thru get_stats().
+
+ClientQueue.format holds the payload format negotiated by the client ('json' or
+'binary', see payload module) and ClientQueue.subscription its channel
+subscription (see subscription module).
+"""
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+import websockets
+from metrics import metrics
+
+logger = logging.getLogger('sensational.client_queue')
+
+# Available overflow policies
+OVERFLOW_POLICIES = ['drop_oldest', 'latest', 'disconnect']
+
+class ClientQueue:
+    def __init__(self, websocket, max_size=64, policy='drop_oldest'):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % policy)
+        # Websocket of client
+        self.websocket = websocket
+        # Max number of queued messages
+        self.max_size = max_size
+        # Overflow policy
+        self.policy = policy
+        # Payload format of client
+        self.format = 'json'
+        # Subscription of client (None for full updates, see Subscription class)
+        self.subscription = None
+        # Queued messages of form (time queued, message)
+        self.messages = deque()
+        # Set when messages are queued
+        self.ready = asyncio.Event()
+        # Writer task (created on start)
+        self.task = None
+        # Closed flag
+        self.closed = False
+        # Number of messages sent
+        self.sent = 0
+        # Number of messages dropped
+        self.dropped = 0
+
+    # Number of queued messages
+    @property
+    def depth(self):
+        return len(self.messages)
+
+    # Age of oldest queued message (in s)
+    @property
+    def lag(self):
+        messages = self.messages
+        return perf_counter() - messages[0][0] if messages else 0
+
+    # Start writer task
+    def start(self):
+        self.task = asyncio.ensure_future(self.writer())
+
+    # Queue message, returns False if client was disconnected
+    def put(self, message):
+        if self.closed:
+            return False
+        if self.policy == 'latest':
+            self.dropped += len(self.messages)
+            self.messages.clear()
+        elif len(self.messages) >= self.max_size:
+            if self.policy == 'disconnect':
+                logger.warning('Client queue full, disconnecting')
+                self.close()
+                return False
+            self.messages.popleft()
+            self.dropped += 1
+        self.messages.append((perf_counter(), message))
+        self.ready.set()
+        return True
+
+    # Send queued messages until closed
+    async def writer(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.messages and not self.closed:
+                    _, message = self.messages.popleft()
+                    start = perf_counter()
+                    await self.websocket.send(message)
+                    metrics.observe_since('send', start)
+                    self.sent += 1
+        except websockets.ConnectionClosed:
+            self.closed = True
+
+    # Stop writer and close connection
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.dropped += len(self.messages)
+        self.messages.clear()
+        if self.task:
+            self.task.cancel()
+        asyncio.ensure_future(self.websocket.close())
+
+    def get_stats(self):
+        return {'depth': self.depth, 'lag': self.lag, 'sent': self.sent, 'dropped': self.dropped,
+                'format': self.format}
@@ -0,0 +1,28 @@
+"""
+Decimation Functions
+
+Reduce a block of buffer data to a bounded number of points while keeping short
+spikes visible. Rows are split into buckets and each bucket is represented by
+two points, its min and its max (in that order), both at the time of the first
+row of the bucket. NaN values are ignored unless a whole bucket is NaN.
+"""
+import numpy as np
+
+# Get start row of each bucket when splitting num_rows rows into num_buckets buckets
+def bucket_starts(num_rows, num_buckets):
+    num_buckets = max(1, min(num_buckets, num_rows))
+    return (np.arange(num_buckets) * num_rows) // num_buckets
+
+# Decimate (times, cycles, data) to at most max_points rows
+# Returns (times, cycles, data) of form [min 1, max 1, min 2, max 2, ...]
+def min_max_decimate(times, cycles, data, max_points):
+    if len(times) <= max_points:
+        return times, cycles, data
+    starts = bucket_starts(len(times), max_points // 2)
+    mins = np.fmin.reduceat(data, starts, axis=0)
+    maxs = np.fmax.reduceat(data, starts, axis=0)
+    # Interleave min and max of each bucket
+    decimated = np.empty((2 * len(starts), data.shape[1]), dtype=data.dtype)
+    decimated[0::2] = mins
+    decimated[1::2] = maxs
+    return np.repeat(times[starts], 2), np.repeat(cycles[starts], 2), decimated
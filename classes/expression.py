@@ -0,0 +1,161 @@
+"""
+Conversion Expression Compiler
+
+Compiles conversion strings of a single variable x, i.e. '(x - 32) * (5 / 9)',
+into numpy-vectorized functions without importing sympy (which takes seconds to
+import on a Raspberry Pi):
+
+    function = compile_expression('2 * sin(x) + pi')
+    function(np.array([0, 1, 2]))
+
+Supported:
+    arithmetic: + - * / ** % and parentheses
+    functions: FUNCTIONS (sympy names, i.e. log is natural log, log(x, b) is
+               log base b, Abs is absolute value)
+    constants: numbers and CONSTANTS (pi, E)
+
+Expressions are parsed with the ast module and the whole tree is checked node by
+node before anything is compiled, they are never evaluated as Python code as
+written. Anything that is not math (attribute access, subscripts, strings,
+keywords, names starting with _, unknown names or functions, ...) raises
+ValueError. Valid expressions that call functions of SYMPY_FUNCTIONS (which the
+compiler does not translate) raise UnsupportedExpression, so callers can fall
+back to sympy (see Sensor.compile_conversion).
+"""
+import ast
+import sys
+import numpy as np
+
+# Numpy function and allowed number of arguments of each function name
+FUNCTIONS = {
+    'sin': (np.sin, [1]), 'cos': (np.cos, [1]), 'tan': (np.tan, [1]),
+    'asin': (np.arcsin, [1]), 'acos': (np.arccos, [1]), 'atan': (np.arctan, [1]),
+    'atan2': (np.arctan2, [2]),
+    'sinh': (np.sinh, [1]), 'cosh': (np.cosh, [1]), 'tanh': (np.tanh, [1]),
+    'exp': (np.exp, [1]), 'sqrt': (np.sqrt, [1]),
+    'log': (lambda x, base=None: np.log(x) if base is None else np.log(x) / np.log(base), [1, 2]),
+    'ln': (np.log, [1]),
+    'Abs': (np.abs, [1]), 'abs': (np.abs, [1]), 'sign': (np.sign, [1]),
+    'floor': (np.floor, [1]), 'ceiling': (np.ceil, [1]),
+    'Min': (np.minimum, [2]), 'Max': (np.maximum, [2])
+}
+# Sympy functions allowed in conversions that are not translated (compiled by sympy)
+# All of them must convert arrays (see sensor.SYMPY_MODULES)
+SYMPY_FUNCTIONS = {
+    'sec', 'csc', 'cot', 'asec', 'acsc', 'acot',
+    'sech', 'csch', 'coth', 'asinh', 'acosh', 'atanh', 'acoth',
+    'cbrt', 'root', 'sinc', 'erf', 'erfc', 'gamma', 'loggamma',
+    'Heaviside'
+}
+# Value of each constant name
+CONSTANTS = {'pi': np.pi, 'E': np.e}
+# Allowed operators
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.UAdd, ast.USub)
+# Name of variable
+VARIABLE = 'x'
+# Nodes of numbers (ast.Num before Python 3.8)
+NUMBERS = (ast.Constant,) if sys.version_info >= (3, 8) else (ast.Num, ast.Constant)
+
+class UnsupportedExpression(ValueError):
+    pass
+
+# Check that a node (and its children) is a math expression
+# Names of called SYMPY_FUNCTIONS are added to sympy_functions
+def check_node(node, sympy_functions):
+    if isinstance(node, ast.Expression):
+        check_node(node.body, sympy_functions)
+    elif isinstance(node, ast.BinOp):
+        if not isinstance(node.op, OPERATORS):
+            raise ValueError('Invalid operator %s' % type(node.op).__name__)
+        check_node(node.left, sympy_functions)
+        check_node(node.right, sympy_functions)
+    elif isinstance(node, ast.UnaryOp):
+        if not isinstance(node.op, OPERATORS):
+            raise ValueError('Invalid operator %s' % type(node.op).__name__)
+        check_node(node.operand, sympy_functions)
+    elif isinstance(node, ast.Call):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise ValueError('Invalid function call')
+        name = node.func.id
+        check_name(name)
+        if name in SYMPY_FUNCTIONS:
+            sympy_functions.add(name)
+        elif name not in FUNCTIONS:
+            raise ValueError('Unknown function %s' % name)
+        elif len(node.args) not in FUNCTIONS[name][1]:
+            raise ValueError('Wrong number of arguments for %s' % name)
+        for arg in node.args:
+            check_node(arg, sympy_functions)
+    elif isinstance(node, ast.Name):
+        check_name(node.id)
+        if node.id != VARIABLE and node.id not in CONSTANTS:
+            raise ValueError('Unknown name %s' % node.id)
+    elif isinstance(node, NUMBERS):
+        value = number_value(node)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError('Invalid constant %r' % (value,))
+    else:
+        raise ValueError('Invalid expression (%s)' % type(node).__name__)
+
+# Value of a number node
+def number_value(node):
+    return node.value if hasattr(node, 'value') else node.n
+
+# Replaces numbers by numpy scalars (named _c0, _c1, ...), so constant parts of an
+# expression overflow to inf like the rest of it instead of raising (or taking
+# forever with integers, i.e. 10**10**10)
+class NumpyConstants(ast.NodeTransformer):
+    def __init__(self):
+        # Numpy scalars of form {name: value}
+        self.constants = {}
+
+    def visit(self, node):
+        if isinstance(node, NUMBERS):
+            name = '_c%d' % len(self.constants)
+            self.constants[name] = np.float64(number_value(node))
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+# Names must not reach Python internals
+def check_name(name):
+    if name.startswith('_'):
+        raise ValueError('Invalid name %s' % name)
+
+# Parse and check the whole expression
+# Returns (tree, sympy_functions) where sympy_functions are the names of the
+# SYMPY_FUNCTIONS called, raises ValueError for invalid expressions
+def check_expression(expression):
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Invalid expression %r: %s' % (expression, e))
+    sympy_functions = set()
+    check_node(tree, sympy_functions)
+    return tree, sympy_functions
+
+# Check and translate expression of x to code of a lambda
+# Returns (code, constants) where constants are of form {name: value}, both can be
+# stored with marshal (see ConversionCache)
+def translate_expression(expression):
+    tree, sympy_functions = check_expression(expression)
+    if sympy_functions:
+        raise UnsupportedExpression('Functions %s are compiled by sympy' % ', '.join(sorted(sympy_functions)))
+    constants = NumpyConstants()
+    tree = constants.visit(tree)
+    # Use checked expression as body of lambda x: ...
+    function = ast.parse('lambda %s: 0' % VARIABLE, mode='eval')
+    function.body.body = tree.body
+    code = compile(ast.fix_missing_locations(function), '<conversion>', 'eval')
+    return code, {name: float(value) for name, value in constants.constants.items()}
+
+# Create function from translated expression
+def load_expression(code, constants):
+    namespace = {name: value[0] for name, value in FUNCTIONS.items()}
+    namespace.update(CONSTANTS)
+    namespace.update({name: np.float64(value) for name, value in constants.items()})
+    namespace['__builtins__'] = {}
+    return eval(code, namespace)
+
+# Compile expression of x to a numpy-vectorized function
+def compile_expression(expression):
+    return load_expression(*translate_expression(expression))
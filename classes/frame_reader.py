@@ -0,0 +1,120 @@
+"""
+Frame Reader Class
+
+Reads frames from the Arduino without reading one byte at a time. Everything
+waiting on the serial port is read in a single call into a bytearray, which is
+split on the frame terminator (?). Partial frames are kept until the rest of the
+frame arrives, and complete frames are queued until requested:
+
+    reader = FrameReader(serial.serial_for_url(com_port, baud_rate))
+    reader.sync()
+    for frame in reader:
+        ...
+
+Data before the first terminator is discarded, since the reader may have been
+started in the middle of a frame. Frames that cannot be decoded or that grow
+beyond FrameReader.max_frame_length are dropped and counted in
+FrameReader.dropped.
+
+Frames are timestamped (perf_counter) when their bytes are read, the arrival
+time of the last frame returned by next_frame is FrameReader.arrival. Frames that
+arrive in one chunk share its arrival time.
+
+Works with any pyserial-like object (serial.Serial, pyserial's loop:// URL, a
+pty, ...) that provides read(size) and in_waiting.
+"""
+from collections import deque
+from time import perf_counter
+
+class FrameReader:
+    def __init__(self, board, terminator=b'?', max_frame_length=4096):
+        # Serial port (pyserial-like object)
+        self.board = board
+        # End of frame character
+        self.terminator = terminator
+        # Longest allowed frame (in bytes)
+        self.max_frame_length = max_frame_length
+        # Bytes of incomplete frame
+        self.pending = bytearray()
+        # Complete frames waiting to be read
+        self.frames = deque()
+        # Arrival times (from perf_counter) of queued frames
+        self.arrivals = deque()
+        # Arrival time of chunk being fed
+        self.chunk_arrival = None
+        # Arrival time of last frame returned by next_frame
+        self.arrival = None
+        # Flag for first terminator found
+        self.synced = False
+        # Number of complete frames read
+        self.frame_count = 0
+        # Number of malformed frames dropped
+        self.dropped = 0
+
+    # Iterator for looping thru frames
+    def __iter__(self):
+        while True:
+            yield self.next_frame()
+
+    # Discard data until the start of the next frame
+    def sync(self):
+        self.pending.clear()
+        self.frames.clear()
+        self.arrivals.clear()
+        self.synced = False
+        while not self.synced:
+            self.fill()
+
+    # Get next complete frame (blocks until available)
+    def next_frame(self):
+        while not self.frames:
+            self.fill()
+        self.arrival = self.arrivals.popleft()
+        return self.frames.popleft()
+
+    # Read all waiting bytes (blocks until at least one byte is read)
+    def fill(self):
+        waiting = self.board.in_waiting
+        chunk = self.board.read(waiting if waiting else 1)
+        if chunk:
+            self.feed(chunk, perf_counter())
+
+    # Add bytes to pending data and queue any complete frames
+    # arrival: time (from perf_counter) the bytes were read (now if not given)
+    def feed(self, chunk, arrival=None):
+        self.chunk_arrival = perf_counter() if arrival is None else arrival
+        self.pending += chunk
+        # No complete frame yet
+        if self.terminator not in chunk:
+            # Frame too long, drop it
+            if len(self.pending) > self.max_frame_length:
+                self.pending.clear()
+                self.dropped += 1
+            return
+        frames = self.pending.split(self.terminator)
+        # Last item is the start of the next frame
+        self.pending = frames.pop()
+        # Data before the first terminator is an incomplete frame
+        if not self.synced:
+            frames = frames[1:]
+            self.synced = True
+        for frame in frames:
+            self.add_frame(frame)
+
+    # Validate and queue a complete frame
+    def add_frame(self, frame):
+        if len(frame) > self.max_frame_length:
+            self.dropped += 1
+            return
+        try:
+            frame = frame.decode('ascii')
+        except UnicodeDecodeError:
+            self.dropped += 1
+            return
+        self.queue_frame(frame)
+
+    # Queue a decoded frame with the arrival time of its chunk
+    def queue_frame(self, frame):
+        self.frame_count += 1
+        self.frames.append(frame)
+        self.arrivals.append(self.chunk_arrival)
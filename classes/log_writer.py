@@ -0,0 +1,273 @@
+"""
+Log Writer Class
+
+Writes log data to an HDF5 file that stays open for the whole session. The
+layout of the file is:
+    times/t                      cycle times (in ms)
+    <sensor>/<sub_sensor>/data   data of each sub sensor
+
+Datasets are chunked and resizable, and grow geometrically (capacity is doubled
+when full) so resizes are rare. Incoming batches are accumulated in memory and
+written by a background thread once LogWriter.flush_size rows are pending or
+LogWriter.flush_interval seconds have passed. LogWriter.flush can also be called
+directly, flushes are written one at a time. On close, pending data is written
+and datasets are trimmed to the number of rows actually logged.
+
+    log = LogWriter('Logs/trial_1.hdf5', sensors)
+    log.append(times, data)     # data of form [cycle, sub sensor column]
+    log.close()
+
+With swmr=True the file is written in HDF5 single-writer/multiple-reader mode so
+other processes can read it while it is being written:
+    f = h5py.File('Logs/trial_1.hdf5', 'r', libver='latest', swmr=True)
+    f['times/t'].refresh()
+In this mode datasets are resized to exactly the number of rows written on each
+flush (instead of growing geometrically), so readers never see unwritten rows.
+
+With compression='gzip' or 'lzf' the log is compressed (opt-in):
+    <sensor>/<sub_sensor>/data: shuffle + compression + scale-offset quantization
+        to the resolution of the sub sensor (precision * largest absolute value
+        of its range), stored as decimal digits in attribute scaleoffset_digits.
+        Missing values (NaN) are stored as attribute missing_value.
+    times/t: integer deltas of times in units of attribute resolution (in ms),
+        with attribute encoding = 'delta'
+Use read_times / read_channel to read values back at the stated precision.
+
+With raw=True the parsed values are also logged before conversion, so a trial
+can be converted again with corrected conversions (see reprocess module):
+    <sensor>/<sub_sensor>/raw    raw values (float64, NaN for missing values)
+The conversion string used for each data dataset is stored as its attribute
+conversion ('' for none).
+"""
+import math
+import threading
+from time import perf_counter
+import numpy as np
+import h5py
+from metrics import metrics
+
+# Available compression filters
+COMPRESSION_FILTERS = ['gzip', 'lzf']
+# Stored in place of missing values in quantized datasets
+MISSING_VALUE = -1e30
+
+# Get number of decimal digits to keep for a sub sensor
+# precision: relative precision (i.e. 0.01 = +/- 1%), value_range: [min, max]
+# Returns None if no quantization is possible
+def quantization_digits(precision, value_range):
+    try:
+        resolution = float(precision) * max(abs(float(value)) for value in value_range)
+    except (TypeError, ValueError):
+        return None
+    if not resolution > 0:
+        return None
+    return max(0, int(math.ceil(-math.log10(resolution))))
+
+# Read times of a log file (decodes delta encoded times)
+def read_times(f):
+    t = f['times']['t']
+    if t.attrs.get('encoding') == 'delta':
+        return np.cumsum(t[:]) * t.attrs['resolution']
+    return t[:]
+
+# Read data of a sub sensor from a log file (missing values as NaN)
+def read_channel(f, sensor_name, sub_sensor):
+    dset = f[sensor_name][sub_sensor]['data']
+    data = dset[:].astype('f8')
+    if 'missing_value' in dset.attrs:
+        data[data == dset.dtype.type(dset.attrs['missing_value'])] = np.nan
+    return data
+
+class LogWriter:
+    def __init__(self, path, sensors, mode='x', initial_size=10e3, chunk_size=1024,
+                 flush_size=1000, flush_interval=1.0, dtype='f4', swmr=False, compression=None,
+                 time_resolution=1e-3, raw=False):
+        if compression is not None and compression not in COMPRESSION_FILTERS:
+            raise ValueError('Unknown compression %s' % compression)
+        # Path of log file
+        self.path = path
+        # List of Sensor objects (None for empty ports) in column order
+        self.sensors = [sensor for sensor in sensors if sensor]
+        # Rows pending before flush
+        self.flush_size = flush_size
+        # Max time (in s) between flushes
+        self.flush_interval = flush_interval
+        # Number of rows written to file
+        self.length = 0
+        # Single-writer/multiple-reader mode
+        self.swmr = swmr
+        # Compression filter (None for uncompressed log)
+        self.compression = compression
+        # Resolution of delta encoded times (in ms)
+        self.time_resolution = time_resolution
+        # Last time in units of time_resolution (for delta encoding)
+        self.last_time = 0
+        # Number of rows datasets can hold
+        self.capacity = 0 if swmr else max(int(initial_size), 1)
+        # Log raw values next to converted values
+        self.raw = raw
+        # Pending batches of form [(times, data, raw), ...]
+        self.pending = []
+        # Number of pending rows
+        self.pending_rows = 0
+        # Number of flushes
+        self.num_flushes = 0
+        # Lock / condition for pending data
+        self.condition = threading.Condition()
+        # Lock for writing to file
+        self.write_lock = threading.Lock()
+        # Run flag of flush thread
+        self.running = True
+        # Open file (error if exists with mode 'x')
+        self.file = h5py.File(path, mode, libver='latest') if swmr else h5py.File(path, mode)
+        chunks = (min(chunk_size, max(self.capacity, int(initial_size), 1)),)
+        # Create main groups
+        if compression:
+            self.times = self.file.create_group('times').create_dataset(
+                't', (self.capacity,), dtype='i8', chunks=chunks, maxshape=(None,),
+                shuffle=True, compression=compression, scaleoffset=0)
+            self.times.attrs['encoding'] = 'delta'
+            self.times.attrs['resolution'] = time_resolution
+        else:
+            self.times = self.file.create_group('times').create_dataset(
+                't', (self.capacity,), dtype='f8', chunks=chunks, maxshape=(None,))
+        # Loop thru sensors and create groups / sub-groups
+        self.channels = []
+        # Raw datasets (same order as channels)
+        self.raw_channels = []
+        # Channels with missing values stored as MISSING_VALUE
+        self.quantized = []
+        for sensor in self.sensors:
+            group = self.file.require_group(sensor.name)
+            for i, sub_sensor in enumerate(sensor.sub_sensors):
+                options = {}
+                digits = None
+                if compression:
+                    options = {'shuffle': True, 'compression': compression}
+                    digits = quantization_digits(sensor.precisions[i], sensor.ranges[i])
+                    if digits is not None:
+                        options['scaleoffset'] = digits
+                        options['fillvalue'] = MISSING_VALUE
+                channel = group.create_group(sub_sensor).create_dataset(
+                    'data', (self.capacity,), dtype=dtype, chunks=chunks, maxshape=(None,), **options)
+                channel.attrs['conversion'] = sensor.conversion_strings[i] or ''
+                if digits is not None:
+                    channel.attrs['precision'] = sensor.precisions[i]
+                    channel.attrs['range'] = sensor.ranges[i]
+                    channel.attrs['scaleoffset_digits'] = digits
+                    channel.attrs['missing_value'] = MISSING_VALUE
+                self.channels.append(channel)
+                if raw:
+                    options = {'shuffle': True, 'compression': compression} if compression else {}
+                    self.raw_channels.append(group[sub_sensor].create_dataset(
+                        'raw', (self.capacity,), dtype='f8', chunks=chunks, maxshape=(None,), **options))
+                self.quantized.append(digits is not None)
+        if compression:
+            self.file.attrs['compression'] = compression
+        self.file.attrs['raw'] = raw
+        # All datasets must be created before SWMR mode is started
+        if swmr:
+            self.file.swmr_mode = True
+        # Start flush thread
+        self.thread = threading.Thread(target=self.run, name='log_writer', daemon=True)
+        self.thread.start()
+
+    # Number of rows logged (written + pending)
+    def __len__(self):
+        return self.length + self.pending_rows
+
+    # Queue rows for logging
+    # times: 1-D array of cycle times, data: 2-D array of form [cycle, column]
+    # cycles: ignored (HDF5 layout has no cycle numbers, see SegmentLogWriter)
+    # raw: 2-D array of raw values like data (only logged if LogWriter.raw)
+    def append(self, times, data, cycles=None, raw=None):
+        times = np.asarray(times, dtype='f8')
+        data = np.asarray(data).reshape(len(times), len(self.channels))
+        if self.raw:
+            if raw is None:
+                raw = np.full(data.shape, np.nan)
+            raw = np.asarray(raw, dtype='f8').reshape(data.shape)
+        with self.condition:
+            self.pending.append((times, data, raw))
+            self.pending_rows += len(times)
+            if self.pending_rows >= self.flush_size:
+                self.condition.notify()
+
+    # Queue data in form of LOG_UPDATE message
+    #   {'times': {'t': [...]}, 'sensor_1': {'sub_sensor': [...]}, ...}
+    # Sub sensors missing from the message (i.e. not subscribed) are logged as NaN
+    def append_dataset(self, dataset):
+        times = dataset['times']['t']
+        missing = np.full(len(times), np.nan)
+        columns = [dataset.get(sensor.name, {}).get(sub_sensor, missing)
+                   for sensor in self.sensors for sub_sensor in sensor.sub_sensors]
+        self.append(times, np.column_stack(columns) if columns else np.empty((len(times), 0)))
+
+    # Flush pending data periodically
+    def run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running or self.pending_rows >= self.flush_size,
+                                        self.flush_interval)
+            self.flush()
+
+    # Write pending data to file
+    def flush(self):
+        # One flush at a time (flush is also called directly, i.e. by segments_to_hdf5)
+        with self.write_lock:
+            with self.condition:
+                pending = self.pending
+                self.pending = []
+                self.pending_rows = 0
+            if not pending:
+                return
+            start_time = perf_counter()
+            times = np.concatenate([batch[0] for batch in pending])
+            data = np.concatenate([batch[1] for batch in pending])
+            raw = np.concatenate([batch[2] for batch in pending]) if self.raw else None
+            start = self.length
+            end = start + len(times)
+            # Grow datasets geometrically (exactly in SWMR mode)
+            if end > self.capacity:
+                while end > self.capacity and not self.swmr:
+                    self.capacity *= 2
+                self.capacity = max(self.capacity, end)
+                self.resize(self.capacity)
+            if self.compression:
+                # Delta encode times
+                counts = np.round(times / self.time_resolution).astype('i8')
+                self.times[start:end] = np.diff(np.concatenate(([self.last_time], counts)))
+                self.last_time = counts[-1]
+            else:
+                self.times[start:end] = times
+            for i, channel in enumerate(self.channels):
+                if self.quantized[i]:
+                    channel[start:end] = np.where(np.isnan(data[:, i]), MISSING_VALUE, data[:, i])
+                else:
+                    channel[start:end] = data[:, i]
+            for i, channel in enumerate(self.raw_channels):
+                channel[start:end] = raw[:, i]
+            self.length = end
+            self.num_flushes += 1
+            self.file.flush()
+            metrics.observe_since('hdf5_flush', start_time)
+
+    # Resize all datasets
+    def resize(self, size):
+        self.times.resize((size,))
+        for channel in self.channels + self.raw_channels:
+            channel.resize((size,))
+
+    # Write pending data, trim datasets and close file
+    def close(self):
+        if not self.running:
+            return
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        self.flush()
+        with self.write_lock:
+            self.resize(self.length)
+            self.capacity = self.length
+            self.file.close()
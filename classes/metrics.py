@@ -0,0 +1,148 @@
+"""
+Metrics Class
+
+Low-overhead instrumentation of the hot path. Stage durations are measured with
+the monotonic clock and kept in fixed-bucket histograms, events are counted, and
+gauges are read from callbacks only when metrics are collected:
+
+    start = perf_counter()
+    ...
+    metrics.observe('serial_read', perf_counter() - start)
+    metrics.increment('frame_errors')
+    metrics.add_gauge('client_queue_depth', lambda: {'host:port': 3})
+
+Stages: serial_read, parse, convert, threshold_check, safety_check, shutdown,
+buffer_write, encode, send, hdf5_flush, segment_write
+Counters: frame_errors, conversion_errors, cycles_dropped, safety_over_budget, safety_errors
+
+All modules share the `metrics` instance of this module. If prometheus_client is
+installed, metrics can be exposed on an HTTP endpoint:
+    metrics.start_http_server(8000)
+"""
+import bisect
+import threading
+from time import perf_counter
+
+# Optional dependency for HTTP endpoint
+try:
+    import prometheus_client
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+except ImportError:
+    prometheus_client = None
+
+# Upper bounds of histogram buckets (in s)
+BUCKETS = [1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1,
+           float('inf')]
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        # Upper bounds of buckets
+        self.buckets = buckets
+        # Number of observations in each bucket (not cumulative)
+        self.counts = [0]*len(buckets)
+        # Sum of observations
+        self.sum = 0
+        # Number of observations
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self, enabled=True):
+        # Flag to skip all measurements
+        self.enabled = enabled
+        # Stage duration histograms of form {stage: Histogram}
+        self.histograms = {}
+        # Event counters of form {event: count}
+        self.counters = {}
+        # Gauge callbacks of form {gauge: function} where function returns {label: value}
+        self.gauges = {}
+        # Lock for creating histograms / counters from multiple threads
+        self.lock = threading.Lock()
+        # Flag for HTTP endpoint
+        self.serving = False
+
+    # Add duration (in s) of a stage
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    # Add duration since start (from perf_counter) of a stage
+    def observe_since(self, stage, start):
+        if self.enabled:
+            self.observe(stage, perf_counter() - start)
+
+    # Count an event
+    def increment(self, event, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    # Add gauge callback, function returns dict of form {label: value}
+    def add_gauge(self, gauge, function):
+        self.gauges[gauge] = function
+
+    # Clear all measurements
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+
+    # Get summary of all metrics of form:
+    #   {'stages': {stage: {'count': 10, 'mean': 1e-4, 'max_bucket': 2.5e-4}},
+    #    'counters': {event: count}, 'gauges': {gauge: {label: value}}}
+    def get_stats(self):
+        stages = {}
+        for stage, histogram in list(self.histograms.items()):
+            top = max((i for i, count in enumerate(histogram.counts) if count), default=None)
+            stages[stage] = {
+                'count': histogram.count,
+                'total': histogram.sum,
+                'mean': histogram.sum / histogram.count if histogram.count else None,
+                'max_bucket': histogram.buckets[top] if top is not None else None
+            }
+        return {'stages': stages, 'counters': dict(self.counters),
+                'gauges': {gauge: function() for gauge, function in list(self.gauges.items())}}
+
+    # Collect metrics for prometheus_client
+    def collect(self):
+        histograms = HistogramMetricFamily('sensational_stage_seconds', 'Duration of hot path stages',
+                                           labels=['stage'])
+        for stage, histogram in list(self.histograms.items()):
+            cumulative = 0
+            buckets = []
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                buckets.append(('+Inf' if bound == float('inf') else str(bound), cumulative))
+            histograms.add_metric([stage], buckets, histogram.sum)
+        yield histograms
+        counters = CounterMetricFamily('sensational_events', 'Counted events', labels=['event'])
+        for event, count in list(self.counters.items()):
+            counters.add_metric([event], count)
+        yield counters
+        for gauge, function in list(self.gauges.items()):
+            family = GaugeMetricFamily('sensational_' + gauge, gauge.replace('_', ' '), labels=['label'])
+            for label, value in function().items():
+                family.add_metric([str(label)], value)
+            yield family
+
+    # Expose metrics on HTTP endpoint (requires prometheus_client)
+    def start_http_server(self, port, addr=''):
+        if prometheus_client is None:
+            raise ImportError('prometheus_client is required for the metrics endpoint')
+        if not self.serving:
+            prometheus_client.REGISTRY.register(self)
+            self.serving = True
+        prometheus_client.start_http_server(int(port), addr)
+
+# Shared metrics instance
+metrics = Metrics()
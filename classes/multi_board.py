@@ -0,0 +1,310 @@
+"""
+Multi-Board Reader Classes
+
+Reads several boards at once so the ports of a Session can be spread over more
+than one serial link (see Session.boards):
+
+    session = Session(..., ports=[1, 2, 3, 4], com_port=None,
+                      boards=[{'com_port': '/dev/ttyACM0', 'ports': [1, 2]},
+                              {'com_port': '/dev/ttyACM1', 'ports': [3, 4], 'baud_rate': 115200,
+                               'protocol': 'binary'}],
+                      alignment='latest')
+
+Each board is read by a BoardReader thread with its own FrameReader (or
+BinaryFrameReader), frames are decoded and queued with the time their bytes
+arrived (perf_counter, see FrameReader.arrival) to the MultiBoardReader, which
+merges them into one timeline. Merged frames have the form of binary frames
+(sequence, [(port, samples), ...]) and replace the frames of a single board in
+Session.read_serial.
+
+Alignment policies (Session.alignment):
+    'latest'        every frame of any board is a cycle, the other boards hold
+                    their latest samples. Cycles per second are the sum of the
+                    rates of all boards.
+    'nearest'       frames of the reference board (first board) are cycles, the
+                    other boards use the sample nearest in time.
+    'interpolate'   like nearest, with samples linearly interpolated (before
+                    conversion) between the samples around the cycle. Ports with
+                    a different number of samples in the two frames (i.e. a
+                    corrupted frame) use the nearest samples.
+With nearest / interpolate a cycle waits for a later sample of every other
+board for up to max_delay (in s), then falls back to the latest sample. Ports of
+boards that have not sent anything yet are missing (NaN).
+
+Per-board rates (frames/s over the last RATE_WINDOW frames) and lags (age of the
+samples of a board in the last merged frame) are reported by
+MultiBoardReader.get_stats and as metrics gauges board_rate / board_lag.
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from time import time, perf_counter
+import numpy as np
+import serial
+from frame_reader import FrameReader
+from binary_protocol import BinaryFrameReader
+from metrics import metrics
+
+logger = logging.getLogger('sensational.boards')
+
+# Alignment policies
+ALIGNMENTS = ['latest', 'nearest', 'interpolate']
+# Number of frames used for rates
+RATE_WINDOW = 1000
+# Number of frames kept per board for alignment
+HISTORY_LENGTH = 64
+
+# Decode an ASCII frame of form 'port:v1,v2;port:v1'
+# Returns list of (port, samples), raises ValueError for malformed frames
+def decode_ascii_frame(frame):
+    port_data = []
+    for block in frame.split(';'):
+        if not block:
+            continue
+        port, _, samples = block.partition(':')
+        port_data.append((int(port), np.array([float(sample) for sample in samples.split(',')])))
+    return port_data
+
+class BoardReader(threading.Thread):
+    def __init__(self, index, com_port, ports, frames, baud_rate=9600, protocol='ascii'):
+        super().__init__(name='board_reader_%d' % index, daemon=True)
+        # Index of board in MultiBoardReader
+        self.index = index
+        # Serial port of board (may also be a pyserial URL, i.e. 'loop://')
+        self.com_port = com_port
+        self.board = serial.serial_for_url(com_port, baud_rate)
+        # Port numbers read from this board
+        self.ports = set(ports)
+        # Queue of decoded frames of form (index, arrival, port_data)
+        self.frames = frames
+        # Wire format of board ('ascii' or 'binary')
+        self.protocol = protocol
+        if protocol == 'ascii':
+            self.reader = FrameReader(self.board)
+        elif protocol == 'binary':
+            self.reader = BinaryFrameReader(self.board)
+        else:
+            raise ValueError('Unknown protocol %s' % protocol)
+        # Number of frames / port blocks that could not be decoded
+        self.errors = 0
+        # Arrival times of recent frames (for rate)
+        self.arrivals = deque(maxlen=RATE_WINDOW)
+        # Recent frames of form (arrival, port_data), oldest first (kept by merger)
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        # Age (in s) of samples of this board in last merged frame
+        self.lag = 0
+        self.max_lag = 0
+        # Run flag
+        self.running = False
+
+    # Number of frames read
+    @property
+    def frame_count(self):
+        return self.reader.frame_count
+
+    # Number of frames dropped by reader or decoder
+    @property
+    def dropped(self):
+        return self.reader.dropped + self.errors
+
+    # Number of frames lost (only detected with binary protocol)
+    @property
+    def lost(self):
+        return getattr(self.reader, 'lost', 0)
+
+    # Frames per second over last RATE_WINDOW frames
+    @property
+    def rate(self):
+        # Appended to by reader thread (single items only, no iteration)
+        count = len(self.arrivals)
+        if count < 2:
+            return 0
+        first, last = self.arrivals[0], self.arrivals[-1]
+        return (count - 1) / (last - first) if last > first else 0
+
+    # Decode a frame into a list of (port, samples) of this board
+    def decode(self, frame):
+        if self.protocol == 'binary':
+            port_data = frame[1]
+        else:
+            try:
+                port_data = decode_ascii_frame(frame)
+            except ValueError as e:
+                logger.warning('Parsing Error: %s (board %s)', e, self.com_port)
+                self.errors += 1
+                metrics.increment('frame_errors')
+                return []
+        valid = [(port, samples) for port, samples in port_data if port in self.ports]
+        if len(valid) != len(port_data):
+            logger.warning('Parsing Error: Unexpected port on board %s', self.com_port)
+            self.errors += 1
+            metrics.increment('frame_errors')
+        return valid
+
+    # Read, timestamp and queue frames until stopped
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                frame = self.reader.next_frame()
+                arrival = self.reader.arrival
+                self.arrivals.append(arrival)
+                self.frames.put((self.index, arrival, self.decode(frame)))
+        except Exception as e:
+            logger.exception('Board Reader Error (%s): %s', self.com_port, e)
+            # Wake up merger
+            self.frames.put((self.index, None, e))
+        finally:
+            self.running = False
+
+    # Stop after current frame
+    def stop(self):
+        self.running = False
+
+    # Get sample of form (arrival, port_data) for time t
+    # Returns None if no frame was read yet
+    def sample_at(self, t, alignment):
+        if not self.history:
+            return None
+        before = after = None
+        for arrival, port_data in reversed(self.history):
+            if arrival <= t:
+                before = (arrival, port_data)
+                break
+            after = (arrival, port_data)
+        if before is None or after is None or alignment == 'latest':
+            return before or after
+        # Nearest sample
+        nearest = before if t - before[0] <= after[0] - t else after
+        if alignment != 'interpolate':
+            return nearest
+        # Interpolate ports with the same number of samples in both frames (i.e.
+        # not corrupted), nearest samples otherwise
+        weight = (t - before[0]) / (after[0] - before[0])
+        before_ports, after_ports = dict(before[1]), dict(after[1])
+        nearest_ports = dict(nearest[1])
+        port_data = []
+        ports = [port for port, _ in before[1]] + [port for port in after_ports if port not in before_ports]
+        for port in ports:
+            samples, next_samples = before_ports.get(port), after_ports.get(port)
+            if samples is not None and next_samples is not None and len(samples) == len(next_samples):
+                port_data.append((port, samples + (next_samples - samples) * weight))
+            else:
+                port_data.append((port, nearest_ports.get(port, samples if next_samples is None else next_samples)))
+        return before[0], port_data
+
+    # Get report of form:
+    #   {'com_port': 'loop://', 'ports': [1, 2], 'frames': 100, 'rate': 99.5,
+    #    'lag_ms': 0.2, 'max_lag_ms': 1.5, 'dropped': 0, 'lost': 0}
+    def get_stats(self):
+        return {'com_port': self.com_port, 'ports': sorted(self.ports), 'frames': self.frame_count,
+                'rate': self.rate, 'lag_ms': self.lag * 1000, 'max_lag_ms': self.max_lag * 1000,
+                'dropped': self.dropped, 'lost': self.lost}
+
+class MultiBoardReader:
+    def __init__(self, boards, alignment='latest', max_delay=0.05):
+        if alignment not in ALIGNMENTS:
+            raise ValueError('Unknown alignment %s' % alignment)
+        if not boards:
+            raise ValueError('No boards given')
+        # Decoded frames of all boards of form (index, arrival, port_data)
+        self.frames = queue.Queue()
+        # Reader of each board of form {'com_port': ..., 'ports': [...], 'baud_rate': 9600,
+        # 'protocol': 'ascii'}
+        self.readers = [BoardReader(i, frames=self.frames, **board) for i, board in enumerate(boards)]
+        # Alignment policy (see ALIGNMENTS)
+        self.alignment = alignment
+        # Max time (in s) a cycle waits for later samples of other boards
+        self.max_delay = max_delay
+        # Frames of reference board waiting for other boards of form (arrival, port_data)
+        self.pending = deque()
+        # Number of merged frames
+        self.frame_count = 0
+        # Arrival time (from time()) of last merged frame
+        self.frame_time = None
+        # Arrival time (from perf_counter) of last merged frame
+        self.arrival = None
+        # Offset of time() to perf_counter()
+        self.clock_offset = time() - perf_counter()
+        metrics.add_gauge('board_rate', lambda: {reader.com_port: reader.rate for reader in self.readers})
+        metrics.add_gauge('board_lag', lambda: {reader.com_port: reader.lag * 1000 for reader in self.readers})
+
+    # Number of frames dropped by all boards
+    @property
+    def dropped(self):
+        return sum(reader.dropped for reader in self.readers)
+
+    # Number of frames lost by all boards
+    @property
+    def lost(self):
+        return sum(reader.lost for reader in self.readers)
+
+    # Sync to start of next frame of every board and start readers
+    def sync(self):
+        for reader in self.readers:
+            reader.reader.sync()
+        for reader in self.readers:
+            reader.start()
+
+    # Stop readers after their current frame
+    def stop(self):
+        for reader in self.readers:
+            reader.stop()
+
+    # Get next merged frame (blocks until available)
+    # Returns (sequence, [(port, samples), ...])
+    def next_frame(self):
+        while True:
+            if self.alignment == 'latest':
+                _, arrival, _ = self.get()
+                return self.merge(arrival)
+            timeout = None
+            if self.pending:
+                t = self.pending[0][0]
+                others = self.readers[1:]
+                if all(reader.history and reader.history[-1][0] >= t for reader in others):
+                    timeout = 0
+                else:
+                    timeout = t + self.max_delay - perf_counter()
+                if timeout <= 0:
+                    arrival, port_data = self.pending.popleft()
+                    return self.merge(arrival, port_data)
+            try:
+                index, arrival, port_data = self.get(timeout)
+            except queue.Empty:
+                continue
+            if index == 0:
+                self.pending.append((arrival, port_data))
+
+    # Get next decoded frame from readers and add it to history of its board
+    def get(self, timeout=None):
+        index, arrival, port_data = self.frames.get(timeout=timeout)
+        if arrival is None:
+            raise RuntimeError('Board %s stopped' % self.readers[index].com_port) from port_data
+        self.readers[index].history.append((arrival, port_data))
+        return index, arrival, port_data
+
+    # Merge samples of all boards at time t
+    # reference: port data of reference board at t (nearest / interpolate)
+    def merge(self, t, reference=None):
+        now = perf_counter()
+        merged = []
+        for reader in self.readers:
+            if reference is not None and reader.index == 0:
+                sample = (t, reference)
+            else:
+                sample = reader.sample_at(t, self.alignment)
+            if sample is None:
+                continue
+            merged += sample[1]
+            reader.lag = now - sample[0]
+            reader.max_lag = max(reader.max_lag, reader.lag)
+        self.frame_count += 1
+        self.arrival = t
+        self.frame_time = t + self.clock_offset
+        return self.frame_count, merged
+
+    # Get report of each board (see BoardReader.get_stats)
+    def get_stats(self):
+        return [reader.get_stats() for reader in self.readers]
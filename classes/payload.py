@@ -0,0 +1,94 @@
+"""
+Binary Payload Format
+
+Columnar binary alternative to the JSON LOG_UPDATE / GUI_UPDATE messages.
+A payload is a small JSON header followed by raw little-endian column buffers:
+
+    magic          4 bytes  b'SNSP'
+    version        uint16   PAYLOAD_VERSION
+    header_length  uint32   length of header (in bytes)
+    header         JSON     {'action': 'LOG_UPDATE',
+                             'rows': number of cycles,
+                             'cycles': [first cycle, last cycle],
+                             'dtype': '<f8',
+                             'sensors': [{'name': ..., 'sub_sensors': [...]}, ...],
+                             ...any other fields (i.e. current_cycle)}
+    padding        zeros to align columns to 8 bytes
+    times          rows * float64
+    columns        rows * dtype for each sub sensor, in order of header['sensors']
+
+Columns are written straight from the sample buffer (one transpose copy), and
+decoded with numpy.frombuffer so the decoded arrays are views of the message.
+
+Clients negotiate the format with the server by sending 'FORMAT::binary' (or
+'FORMAT::json', the default).
+"""
+import json
+import struct
+from collections import namedtuple
+import numpy as np
+
+# Available payload formats
+PAYLOAD_FORMATS = ['json', 'binary']
+# Start of payload marker
+MAGIC = b'SNSP'
+# Version of payload format
+PAYLOAD_VERSION = 1
+# Prefix: magic, version, header length
+PREFIX = struct.Struct('<4sHI')
+# Sensor layout for encode_payload (only name and sub sensors are used), i.e.
+# for payloads of a subset of sub sensors
+PayloadSensor = namedtuple('PayloadSensor', ['name', 'sub_sensors'])
+# Column alignment (in bytes)
+ALIGNMENT = 8
+# Data type of times column
+TIMES_DTYPE = np.dtype('<f8')
+
+# Encode payload
+# header: dict of extra header fields (i.e. action)
+# sensors: list of Sensor objects in column order
+# times, cycles: 1-D arrays of cycle times / numbers
+# data: 2-D array of form [cycle, column]
+def encode_payload(header, sensors, times, cycles, data, dtype='<f8'):
+    dtype = np.dtype(dtype)
+    header = dict(header)
+    header['rows'] = len(times)
+    header['cycles'] = [int(cycles[0]), int(cycles[-1])] if len(cycles) else [None, None]
+    header['dtype'] = dtype.str
+    header['sensors'] = [{'name': sensor.name, 'sub_sensors': sensor.sub_sensors} for sensor in sensors]
+    header = json.JSONEncoder().encode(header).encode('utf-8')
+    # Pad header so columns are aligned
+    offset = PREFIX.size + len(header)
+    padding = b'\0' * (-offset % ALIGNMENT)
+    # Columns are stored contiguously (transpose of buffer block)
+    columns = np.ascontiguousarray(np.asarray(data).T, dtype=dtype)
+    return b''.join([PREFIX.pack(MAGIC, PAYLOAD_VERSION, len(header)), header, padding,
+                     np.ascontiguousarray(times, dtype=TIMES_DTYPE).tobytes(), columns.tobytes()])
+
+# Check if message is a binary payload
+def is_payload(message):
+    return isinstance(message, (bytes, bytearray, memoryview)) and bytes(message[:len(MAGIC)]) == MAGIC
+
+# Decode payload into same form as JSON data:
+#   {'action': ..., 'times': {'t': [...]}, 'sensor_1': {'sub_sensor': [...]}, ...}
+# where data are numpy views of the message
+def decode_payload(message):
+    magic, version, header_length = PREFIX.unpack_from(message)
+    if magic != MAGIC:
+        raise ValueError('Not a binary payload')
+    if version != PAYLOAD_VERSION:
+        raise ValueError('Unsupported payload version %d' % version)
+    offset = PREFIX.size + header_length
+    header = json.JSONDecoder().decode(bytes(message[PREFIX.size:offset]).decode('utf-8'))
+    offset += -offset % ALIGNMENT
+    rows = header['rows']
+    dtype = np.dtype(header['dtype'])
+    dset = dict(header)
+    dset['times'] = {'t': np.frombuffer(message, dtype=TIMES_DTYPE, count=rows, offset=offset)}
+    offset += rows * TIMES_DTYPE.itemsize
+    for sensor in header['sensors']:
+        dset[sensor['name']] = {}
+        for sub_sensor in sensor['sub_sensors']:
+            dset[sensor['name']][sub_sensor] = np.frombuffer(message, dtype=dtype, count=rows, offset=offset)
+            offset += rows * dtype.itemsize
+    return dset
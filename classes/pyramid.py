@@ -0,0 +1,137 @@
+"""
+Pyramid Class
+
+Multi-resolution min/max/mean decimation of the live buffer for long-range
+plots. Each level holds buckets of Pyramid.factors[i] cycles in a RingBuffer
+(see RingBuffer class) whose columns are:
+    [min of each column | max of each column | mean of each column]
+with the time and cycle number of the first cycle of each bucket. Levels cover
+(at least) the same number of cycles as the raw buffer.
+
+Levels are updated incrementally: rows are accumulated into the current bucket
+of the finest level, and each completed bucket is accumulated into the current
+bucket of the next level, so a cycle costs a handful of numpy operations no
+matter how many levels there are. Buckets only appear once complete, so the most
+recent cycles of coarse levels lag behind the raw buffer. Blocks of rows can be
+added at once with Pyramid.update_block (one cascade per bucket instead of per row).
+"""
+import math
+import numpy as np
+from ring_buffer import RingBuffer
+
+class Level:
+    def __init__(self, factor, length, width):
+        # Number of cycles per bucket
+        self.factor = factor
+        # Completed buckets of form [min | max | mean]
+        self.buffer = RingBuffer(int(math.ceil(length / factor)) + 1, 3 * width)
+        self.reset(width)
+
+    # Number of columns
+    @property
+    def width(self):
+        return self.buffer.width // 3
+
+    # Clear current bucket
+    def reset(self, width=None):
+        width = self.width if width is None else width
+        self.min = np.full(width, np.nan)
+        self.max = np.full(width, np.nan)
+        self.sum = np.zeros(width)
+        self.count = np.zeros(width, dtype=np.int64)
+        # Number of cycles in bucket
+        self.cycles = 0
+        # Time / cycle number of first cycle of bucket
+        self.start_time = None
+        self.start_cycle = None
+
+    # Add columns (reallocates, all buckets are lost)
+    def add_columns(self, n):
+        width = self.width + n
+        self.buffer = RingBuffer(self.buffer.length, 3 * width)
+        self.reset(width)
+
+    # Accumulate values of `cycles` cycles into current bucket
+    # Returns True if bucket is complete
+    def accumulate(self, mins, maxs, sums, counts, cycles, t, cycle_number):
+        if self.start_time is None:
+            self.start_time = t
+            self.start_cycle = cycle_number
+        self.min = np.fmin(self.min, mins)
+        self.max = np.fmax(self.max, maxs)
+        self.sum += sums
+        self.count += counts
+        self.cycles += cycles
+        return self.cycles >= self.factor
+
+    # Write current bucket and start a new one
+    def commit(self):
+        width = self.width
+        row = self.buffer.row()
+        row[:width] = self.min
+        row[width:2 * width] = self.max
+        row[2 * width:] = np.where(self.count > 0, self.sum / np.maximum(self.count, 1), np.nan)
+        self.buffer.commit(self.start_time, self.start_cycle)
+        completed = (self.min, self.max, self.sum, self.count, self.cycles, self.start_time, self.start_cycle)
+        self.reset()
+        return completed
+
+    # Get buckets overlapping cycles start_cycle to end_cycle
+    # Returns (times, cycles, mins, maxs, means)
+    def get_range(self, start_cycle, end_cycle):
+        times, cycles, data = self.buffer.cycle_range(start_cycle - self.factor + 1, end_cycle)
+        width = self.width
+        return times, cycles, data[:, :width], data[:, width:2 * width], data[:, 2 * width:]
+
+class Pyramid:
+    def __init__(self, length, width=0, factors=(10, 100, 1000)):
+        factors = sorted(factors)
+        # Buckets of each level are built from whole buckets of the previous level
+        for finer, coarser in zip([1] + factors, factors):
+            if coarser % finer:
+                raise ValueError('Pyramid factors must be multiples of each other')
+        # Number of cycles covered by each level
+        self.length = length
+        # Levels of pyramid, finest first
+        self.levels = [Level(factor, length, width) for factor in factors]
+
+    # Cycles per bucket of each level
+    @property
+    def factors(self):
+        return [level.factor for level in self.levels]
+
+    # Add n columns to every level
+    def add_columns(self, n):
+        for level in self.levels:
+            level.add_columns(n)
+
+    # Add a row of samples (one per column)
+    def update(self, row, t, cycle_number):
+        valid = ~np.isnan(row)
+        values = (row, row, np.where(valid, row, 0), valid.astype(np.int64), 1, t, cycle_number)
+        # Cascade completed buckets into coarser levels
+        for level in self.levels:
+            if not level.accumulate(*values):
+                break
+            values = level.commit()
+
+    # Add a block of rows of form [row, column] (same result as one update per row)
+    def update_block(self, times, cycles, data):
+        if not len(times):
+            return
+        finest = self.levels[0]
+        # Split block at the ends of buckets of the finest level
+        starts = np.concatenate(([0], np.arange(finest.factor - finest.cycles, len(times), finest.factor)))
+        sizes = np.diff(np.append(starts, len(times)))
+        valid = ~np.isnan(data)
+        mins = np.fmin.reduceat(data, starts, axis=0)
+        maxs = np.fmax.reduceat(data, starts, axis=0)
+        sums = np.add.reduceat(np.where(valid, data, 0), starts, axis=0)
+        counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+        for i, start in enumerate(starts):
+            values = (mins[i], maxs[i], sums[i], counts[i], int(sizes[i]), times[start], cycles[start])
+            # Cascade completed buckets into coarser levels
+            for level in self.levels:
+                if not level.accumulate(*values):
+                    break
+                values = level.commit()
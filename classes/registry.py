@@ -0,0 +1,279 @@
+"""
+Template Registry Classes
+
+Loads sensor and session templates (JSON files of Sensor / Session arguments)
+from a directory, validates them once and builds fully attached sessions:
+
+    Templates/
+        sensors/accelerometer.json      {'name': 'Accelerometer', 'model': 'AC5000', ...}
+        sessions/test_session.json      {'name': 'Test Session', 'ports': [17], ...,
+                                         'sensors': [{'sensor': 'AC5000', 'port': 0}]}
+
+    registry = Registry('Templates')
+    sensor = registry.sensor('AC5000')          # by name or model
+    session = registry.session('Test Session', com_port='COM3')
+
+Session templates take the arguments of Session plus a list of sensors to
+attach, each of form {'sensor': name or model, 'port': index of port}. Keyword
+arguments of Registry.session override the template (i.e. serial port, log file).
+
+Compiled conversions are cached on disk by ConversionCache, so sensors of large
+test stands do not compile every conversion again on each launch. There is one
+file per conversion string:
+    <cache_dir>/<sha256 of conversion_key>.<cache_tag>.bin
+holding a marshalled dict of form:
+    {'version': CONVERSION_CACHE_VERSION, 'key': conversion_key,
+     'kind': 'expression', 'code': code, 'constants': {...}}
+or for conversions compiled by sympy:
+    {..., 'kind': 'sympy', 'source': 'def _lambdifygenerated(x): ...',
+     'names': {'erf': 'vectorized', 'exp': 'numpy', ...}}
+where names are the modules of the globals used by the source (see
+SYMPY_NAMESPACES), so cached entries are loaded without importing sympy.
+Code objects depend on the Python version, so entries are tagged like
+__pycache__ files. Loaded functions are added to compiled_conversions (see
+Sensor class) so they are shared by all sensors created afterwards.
+
+NOTE: Cache entries are executed as Python code, the cache directory must only
+      be writable by trusted users.
+"""
+import os
+import json
+import glob
+import marshal
+import hashlib
+import inspect
+import logging
+import sys
+import numpy as np
+from expression import check_expression, translate_expression, load_expression, UnsupportedExpression
+from sensor import Sensor, compiled_conversions, conversion_key, sympy_conversion, VECTORIZED_FUNCTIONS
+from session import Session
+
+logger = logging.getLogger('sensational.registry')
+
+# Version of cache entries
+CONVERSION_CACHE_VERSION = 2
+# Modules of globals of conversions compiled by sympy (see sensor.SYMPY_MODULES)
+SYMPY_NAMESPACES = {'vectorized': VECTORIZED_FUNCTIONS, 'numpy': vars(np)}
+# Fields of sensor templates with one entry per sub sensor
+SUB_SENSOR_FIELDS = ['ranges', 'precisions', 'thresholds', 'shutdown_times', 'conversions', 'units']
+# Fields of sub sensor entries of form [min, max] / [below, above]
+PAIR_FIELDS = ['ranges', 'thresholds', 'shutdown_times']
+
+class TemplateError(ValueError):
+    pass
+
+# Required and optional arguments of a class
+def get_arguments(cls):
+    parameters = list(inspect.signature(cls).parameters.values())
+    required = [p.name for p in parameters if p.default is inspect.Parameter.empty]
+    return required, [p.name for p in parameters]
+
+# Check that a template has the arguments of a class
+def check_arguments(template, cls, extra=()):
+    required, allowed = get_arguments(cls)
+    missing = [name for name in required if name not in template]
+    if missing:
+        raise TemplateError('Missing fields %s' % ', '.join(missing))
+    unknown = [name for name in template if name not in allowed and name not in extra]
+    if unknown:
+        raise TemplateError('Unknown fields %s' % ', '.join(unknown))
+
+# Get modules of the globals used by a conversion compiled by sympy
+# Returns dict of form {name: module of SYMPY_NAMESPACES}, raises ValueError for
+# globals that are not found there
+def sympy_names(function):
+    names = {}
+    for name in function.__code__.co_names:
+        # Builtins
+        if name not in function.__globals__:
+            continue
+        value = function.__globals__[name]
+        for module, namespace in SYMPY_NAMESPACES.items():
+            if namespace.get(name) is value:
+                names[name] = module
+                break
+        else:
+            raise ValueError('Global %s of sympy conversion not found' % name)
+    return names
+
+class ConversionCache:
+    def __init__(self, path):
+        # Cache directory
+        self.path = path
+        # Number of conversions loaded from / compiled into the cache
+        self.hits = 0
+        self.misses = 0
+
+    # Path of cache entry of a conversion key
+    def entry_path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '%s.%s.bin' % (digest, sys.implementation.cache_tag))
+
+    # Get compiled conversion (from memory, disk or compiler)
+    # Raises ValueError for invalid conversions (checked before any cache lookup)
+    def get(self, conversion):
+        check_expression(conversion)
+        key = conversion_key(conversion)
+        if key in compiled_conversions:
+            return compiled_conversions[key]
+        function = self.read(key)
+        if function is None:
+            self.misses += 1
+            function = self.compile(conversion, key)
+        else:
+            self.hits += 1
+        compiled_conversions[key] = function
+        return function
+
+    # Load a cache entry, returns None if missing or unreadable
+    def read(self, key):
+        try:
+            with open(self.entry_path(key), 'rb') as f:
+                entry = marshal.load(f)
+            if entry['version'] != CONVERSION_CACHE_VERSION or entry['key'] != key:
+                return None
+            if entry['kind'] == 'sympy':
+                # Restore globals of source of sympy.lambdify
+                namespace = {name: SYMPY_NAMESPACES[module][name] for name, module in entry['names'].items()}
+                exec(entry['source'], namespace)
+                return namespace['_lambdifygenerated']
+            return load_expression(entry['code'], entry['constants'])
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('Ignoring conversion cache entry %s: %s', self.entry_path(key), e)
+            return None
+
+    # Compile a conversion and write it to the cache
+    def compile(self, conversion, key):
+        entry = {'version': CONVERSION_CACHE_VERSION, 'key': key}
+        try:
+            code, constants = translate_expression(conversion)
+            entry.update(kind='expression', code=code, constants=constants)
+            function = load_expression(code, constants)
+        except UnsupportedExpression:
+            function = sympy_conversion(conversion)
+            try:
+                entry.update(kind='sympy', source=inspect.getsource(function), names=sympy_names(function))
+            except ValueError as e:
+                logger.warning('Not caching conversion %s: %s', conversion, e)
+                return function
+        self.write(key, entry)
+        return function
+
+    # Write a cache entry (replaced atomically)
+    def write(self, key, entry):
+        path = self.entry_path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                marshal.dump(entry, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning('Could not write conversion cache entry %s: %s', path, e)
+
+class Registry:
+    def __init__(self, path, cache_dir=None):
+        # Template directory
+        self.path = path
+        # Compiled conversion cache (in template directory by default)
+        self.cache = ConversionCache(cache_dir or os.path.join(path, '.conversion_cache'))
+        # Sensor templates by name
+        self.sensors = {}
+        # Sensor names by model
+        self.models = {}
+        # Session templates by name
+        self.sessions = {}
+        self.load()
+
+    # Load and validate all templates
+    def load(self):
+        self.sensors, self.models, self.sessions = {}, {}, {}
+        for path, template in self.read_templates('sensors'):
+            try:
+                self.check_sensor(template)
+            except (ValueError, TypeError, KeyError) as e:
+                raise TemplateError('%s: %s' % (path, e))
+            if template['name'] in self.sensors:
+                raise TemplateError('%s: Duplicate sensor name %s' % (path, template['name']))
+            self.sensors[template['name']] = template
+            self.models.setdefault(template['model'], []).append(template['name'])
+        for path, template in self.read_templates('sessions'):
+            try:
+                self.check_session(template)
+            except (ValueError, TypeError, KeyError) as e:
+                raise TemplateError('%s: %s' % (path, e))
+            if template['name'] in self.sessions:
+                raise TemplateError('%s: Duplicate session name %s' % (path, template['name']))
+            self.sessions[template['name']] = template
+        logger.info('Loaded %d sensor and %d session templates from %s (conversion cache: %d hits, %d misses)',
+                    len(self.sensors), len(self.sessions), self.path, self.cache.hits, self.cache.misses)
+
+    # Read JSON templates of a subdirectory
+    # Returns list of (path, template)
+    def read_templates(self, kind):
+        templates = []
+        for path in sorted(glob.glob(os.path.join(self.path, kind, '*.json'))):
+            try:
+                with open(path) as f:
+                    templates.append((path, json.load(f)))
+            except ValueError as e:
+                raise TemplateError('%s: %s' % (path, e))
+        return templates
+
+    # Validate a sensor template and compile its conversions
+    def check_sensor(self, template):
+        check_arguments(template, Sensor)
+        count = len(template['sub_sensors'])
+        for field in SUB_SENSOR_FIELDS:
+            if len(template[field]) != count:
+                raise TemplateError('%s needs one entry per sub sensor (%d)' % (field, count))
+        for field in PAIR_FIELDS:
+            if any(len(pair) != 2 for pair in template[field]):
+                raise TemplateError('%s entries must be of form [min, max]' % field)
+        for conversion in template['conversions']:
+            if conversion:
+                self.cache.get(conversion)
+
+    # Validate a session template
+    def check_session(self, template):
+        check_arguments(template, Session, extra=['sensors'])
+        ports = set()
+        for attachment in template.get('sensors', []):
+            self.find_sensor(attachment['sensor'])
+            port = attachment['port']
+            if not 0 <= port < len(template['ports']):
+                raise TemplateError('Port index %d out of range' % port)
+            if port in ports:
+                raise TemplateError('Port index %d in use' % port)
+            ports.add(port)
+
+    # Get sensor template by name or model
+    def find_sensor(self, key):
+        if key in self.sensors:
+            return self.sensors[key]
+        names = self.models.get(key, [])
+        if len(names) > 1:
+            raise TemplateError('Model %s is ambiguous (%s), use a sensor name' % (key, ', '.join(names)))
+        if not names:
+            raise TemplateError('Unknown sensor %s' % key)
+        return self.sensors[names[0]]
+
+    # Create sensor by name or model
+    def sensor(self, key):
+        return Sensor(**self.find_sensor(key))
+
+    # Create session with all sensors attached
+    # overrides: Session arguments that replace those of the template
+    def session(self, name, **overrides):
+        if name not in self.sessions:
+            raise TemplateError('Unknown session %s' % name)
+        template = dict(self.sessions[name])
+        attachments = template.pop('sensors', [])
+        template.update(overrides)
+        session = Session(**template)
+        for attachment in attachments:
+            session.attach(self.sensor(attachment['sensor']), attachment['port'])
+        return session
@@ -0,0 +1,214 @@
+"""
+Log Reprocessing
+
+Converts recorded trials again with updated sensor definitions, i.e. after a
+wrong calibration string in Sensor.conversions. Needs HDF5 logs written with raw
+values (Session(..., log_raw=True), see LogWriter class):
+
+    sensors = [Sensor(**info), ...]             # updated definitions
+    results = reprocess(['Logs/trial_1.hdf5', 'Logs/trial_2.hdf5'], sensors,
+                        output_dir='Reprocessed')
+
+For each log, every sensor with an updated definition (matched by name) is
+converted again from its raw datasets and written to its data datasets, and a
+threshold summary is computed with the thresholds of the updated definition:
+    {'path': 'Logs/trial_1.hdf5', 'output': 'Reprocessed/trial_1.hdf5', 'rows': 100000,
+     'sensors': {'sensor_1': {'sub_sensor': {
+        'converted': True, 'missing': 0,
+        'below': {'samples': 10, 'time': 12.5, 'longest': 5.0, 'trip_time': None},
+        'above': {...}}}}}
+where time / longest are the total / longest continuous time (in ms) below or
+above the thresholds and trip_time is the cycle time (in ms) the sub sensor
+would have been shut down at (None if never). Sensors without raw datasets are
+only summarized from their logged data. The summary is also stored as JSON in
+attribute threshold_summary of the output file.
+
+Logs are processed in chunks of chunk_size rows. Reading and converting chunks
+(the slow part) is spread over a process pool across all chunks of all files,
+the main process writes chunks and updates summaries in order. At most
+max_pending chunks (2 per worker by default) are submitted ahead of the chunk
+being written, so memory use does not grow with the amount of data. Output is
+written to a copy of each log that replaces the output file (or the log itself
+if output_dir is None) once it is complete.
+"""
+import os
+import json
+import shutil
+import logging
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+from sensor import Sensor
+from log_writer import read_times, MISSING_VALUE
+
+logger = logging.getLogger('sensational.reprocess')
+
+# Sensors of worker process by name
+worker_sensors = {}
+
+# Create sensors in worker process
+def init_worker(sensor_infos):
+    worker_sensors.clear()
+    for info in sensor_infos:
+        worker_sensors[info['name']] = Sensor(**info)
+
+# Read a chunk of a sensor and convert it (runs in worker process)
+# Returns (data, converted) where data is of form [row, sub sensor] and
+# converted is False if the chunk was read from logged data (no raw datasets)
+def convert_chunk(path, sensor_name, start, stop):
+    sensor = worker_sensors[sensor_name]
+    with h5py.File(path, 'r') as f:
+        group = f[sensor_name]
+        if all('raw' in group[sub_sensor] for sub_sensor in sensor.sub_sensors):
+            raw = np.column_stack([group[sub_sensor]['raw'][start:stop] for sub_sensor in sensor.sub_sensors])
+            return sensor.convert_block(raw), True
+        data = []
+        for sub_sensor in sensor.sub_sensors:
+            dset = group[sub_sensor]['data']
+            column = dset[start:stop].astype('f8')
+            if 'missing_value' in dset.attrs:
+                column[column == dset.dtype.type(dset.attrs['missing_value'])] = np.nan
+            data.append(column)
+        return np.column_stack(data), False
+
+# Accumulated time (in ms) of runs of flags, as kept by ThresholdEngine
+# Runs continue over missing values (neither flagged nor reset)
+# carry: accumulated time before the first row
+def run_times(flags, resets, cycle_times, carry=0):
+    totals = carry + np.cumsum(np.where(flags, cycle_times, 0))
+    last_reset = np.maximum.accumulate(np.where(resets, np.arange(len(flags)), -1))
+    return totals - np.where(last_reset >= 0, totals[np.maximum(last_reset, 0)], 0)
+
+class ThresholdSummary:
+    def __init__(self, sensor, i):
+        # Thresholds of sub sensor
+        self.min, self.max = sensor.thresholds[i]
+        self.precision = sensor.precisions[i]
+        # Allowed time (in ms) below / above thresholds
+        self.shutdown_times = sensor.shutdown_times[i]
+        # Number of missing values
+        self.missing = 0
+        # Summary of form {'samples': 0, 'time': 0, 'longest': 0, 'trip_time': None}
+        self.sides = [{'samples': 0, 'time': 0.0, 'longest': 0.0, 'trip_time': None} for _ in range(2)]
+        # Time (in ms) of current run below / above thresholds
+        self.carry = [0.0, 0.0]
+
+    # Add a chunk of values with their cycle times and cumulative times (in ms)
+    def update(self, values, cycle_times, times):
+        # Same tests as ThresholdEngine.check
+        error = self.precision * np.abs(values)
+        below = values - error < self.min
+        above = ~below & (values + error > self.max)
+        valid = ~np.isnan(values)
+        self.missing += int((~valid).sum())
+        for side, flags in enumerate([below, above]):
+            if not len(values):
+                continue
+            run = run_times(flags, valid & ~flags, cycle_times, self.carry[side])
+            summary = self.sides[side]
+            summary['samples'] += int(flags.sum())
+            summary['time'] += float(cycle_times[flags].sum())
+            summary['longest'] = max(summary['longest'], float(run.max()))
+            if summary['trip_time'] is None:
+                tripped = np.flatnonzero(flags & (run >= self.shutdown_times[side]))
+                if len(tripped):
+                    summary['trip_time'] = float(times[tripped[0]])
+            self.carry[side] = float(run[-1])
+
+    # Get summary (see module docstring)
+    def get_summary(self, converted):
+        return {'converted': converted, 'missing': self.missing, 'below': self.sides[0], 'above': self.sides[1]}
+
+# Results of function for each task (tuple of arguments) in order, with at most
+# max_pending tasks submitted ahead of the result being used
+def bounded_map(executor, function, tasks, max_pending):
+    tasks = iter(tasks)
+    pending = deque(executor.submit(function, *task) for task in islice(tasks, max_pending))
+    while pending:
+        result = pending.popleft().result()
+        for task in islice(tasks, 1):
+            pending.append(executor.submit(function, *task))
+        yield result
+
+# Split rows into chunks of form (start, stop)
+def get_chunks(rows, chunk_size):
+    return [(start, min(start + chunk_size, rows)) for start in range(0, rows, chunk_size)]
+
+# Get number of rows of a log and names of its sensors with an updated definition
+def read_layout(path, sensors):
+    with h5py.File(path, 'r') as f:
+        rows = len(f['times']['t'])
+        names = [sensor.name for sensor in sensors if sensor.name in f]
+    return rows, names
+
+# Reprocess logs (see module docstring)
+# sensors: updated Sensor objects, output_dir: directory of new files (None to
+# replace logs), workers: number of processes (None for number of CPUs),
+# max_pending: max chunks converted ahead of writing (None for 2 per worker)
+# Returns list of summaries (one per log)
+def reprocess(paths, sensors, output_dir=None, workers=None, chunk_size=65536, max_pending=None):
+    sensors = {sensor.name: sensor for sensor in sensors}
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    # Chunk tasks of all logs of form (path, sensor_name, start, stop)
+    jobs = []
+    for path in paths:
+        rows, names = read_layout(path, sensors.values())
+        if not names:
+            logger.warning('No sensors of %s have updated definitions', path)
+        jobs.append((path, rows, [(path, name, start, stop) for name in names
+                                  for start, stop in get_chunks(rows, chunk_size)]))
+    tasks = [task for _, _, log_tasks in jobs for task in log_tasks]
+    infos = [sensor.get_info() for sensor in sensors.values()]
+    workers = workers or os.cpu_count() or 1
+    results = []
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(infos,)) as executor:
+        chunks = bounded_map(executor, convert_chunk, tasks, max_pending or 2 * workers)
+        for path, rows, log_tasks in jobs:
+            output = os.path.join(output_dir, os.path.basename(path)) if output_dir else path
+            results.append(write_log(path, output, rows, sensors, log_tasks, chunks))
+    return results
+
+# Write converted chunks of a log to a copy, then replace output with it
+# sensors: updated Sensor objects by name
+# chunks: iterator of results of convert_chunk (in order of tasks)
+def write_log(path, output, rows, sensors, tasks, chunks):
+    temp_path = output + '.tmp'
+    shutil.copyfile(path, temp_path)
+    summaries = {}
+    try:
+        with h5py.File(temp_path, 'r+') as f:
+            times = read_times(f)
+            cycle_times = np.diff(np.concatenate(([0], times)))
+            for _, name, start, stop in tasks:
+                sensor = sensors[name]
+                data, converted = next(chunks)
+                if name not in summaries:
+                    summaries[name] = ([ThresholdSummary(sensor, i) for i in range(len(sensor.sub_sensors))],
+                                       converted)
+                    if not converted:
+                        logger.warning('%s has no raw values of %s, only summarizing logged data', path, name)
+                for i, sub_sensor in enumerate(sensor.sub_sensors):
+                    summaries[name][0][i].update(data[:, i], cycle_times[start:stop], times[start:stop])
+                    if not converted:
+                        continue
+                    dset = f[name][sub_sensor]['data']
+                    values = data[:, i]
+                    if 'missing_value' in dset.attrs:
+                        values = np.where(np.isnan(values), MISSING_VALUE, values)
+                    dset[start:stop] = values
+                    if start == 0:
+                        dset.attrs['conversion'] = sensor.conversion_strings[i] or ''
+            result = {'path': path, 'output': output, 'rows': rows, 'sensors': {
+                name: {sub_sensor: sub_summaries[i].get_summary(converted)
+                       for i, sub_sensor in enumerate(sensors[name].sub_sensors)}
+                for name, (sub_summaries, converted) in summaries.items()}}
+            f.attrs['threshold_summary'] = json.dumps(result['sensors'])
+        os.replace(temp_path, output)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    logger.info('Reprocessed %s (%d rows) to %s', path, rows, output)
+    return result
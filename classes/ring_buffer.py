@@ -0,0 +1,170 @@
+"""
+Ring Buffer Class
+
+Preallocated circular buffer used by the Session to hold the last
+RingBuffer.length cycles of sample data. All sub sensors of all attached
+sensors are stored as columns of a single 2-D block:
+
+    data[row, column]
+
+where each attached sensor owns a contiguous range of columns (see
+RingBuffer.add_columns). Missing samples are stored as NaN. Cycle times and
+cycle numbers are stored alongside the data in RingBuffer.times and
+RingBuffer.cycles so that readers never have to touch Python objects.
+
+Writing a cycle:
+    buffer.clear_row()
+    buffer.data[buffer.cursor, columns] = values
+    buffer.commit(t, cycle_number)
+
+Reading the last n cycles (oldest first):
+    times, cycles, data = buffer.last(n)
+
+Reading a range of cycles / cycle times (oldest first):
+    times, cycles, data = buffer.cycle_range(start_cycle, end_cycle)
+    times, cycles, data = buffer.time_range(start_time, end_time)
+Both are binary searches on either side of the cursor (see RingBuffer.search).
+"""
+import numpy as np
+
+class RingBuffer:
+    def __init__(self, length, width=0, dtype=np.float64):
+        # Number of rows (cycles) held in buffer
+        self.length = int(length)
+        # Data type of sample block
+        self.dtype = np.dtype(dtype)
+        # Sample block of form [cycle, column], NaN represents missing data
+        self.data = np.full((self.length, width), np.nan, dtype=self.dtype)
+        # Cumulative cycle times (in ms)
+        self.times = np.zeros(self.length)
+        # Cycle number of each row
+        self.cycles = np.full(self.length, -1, dtype=np.int64)
+        # Cursor for circular buffer
+        # NOTE: Points to NEXT row of buffer such that
+        # data[cursor - 1] is the most recent row
+        self.cursor = 0
+        # Total number of rows committed
+        self.count = 0
+
+    # Number of columns in buffer
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    # Number of valid rows in buffer
+    @property
+    def size(self):
+        return min(self.count, self.length)
+
+    # Index of oldest row
+    @property
+    def oldest(self):
+        return self.cursor if self.count > self.length else 0
+
+    # True if rows have been overwritten
+    @property
+    def wrapped(self):
+        return self.count > self.length
+
+    # Add n columns to the buffer, returns slice of new columns
+    # NOTE: Reallocates the block, should only be used before data collection
+    def add_columns(self, n):
+        start = self.width
+        data = np.full((self.length, start + n), np.nan, dtype=self.dtype)
+        data[:, :start] = self.data
+        self.data = data
+        return slice(start, start + n)
+
+    # Reset current row to missing data
+    def clear_row(self):
+        self.data[self.cursor] = np.nan
+
+    # Current (uncommitted) row
+    def row(self):
+        return self.data[self.cursor]
+
+    # Commit current row and advance cursor
+    def commit(self, t, cycle_number=None):
+        self.times[self.cursor] = t
+        self.cycles[self.cursor] = self.count if cycle_number is None else cycle_number
+        self.count += 1
+        self.cursor = self.count % self.length
+
+    # Append a full row of data
+    def append(self, values, t, cycle_number=None):
+        self.data[self.cursor] = values
+        self.commit(t, cycle_number)
+
+    # Time of most recent row
+    def last_time(self):
+        if self.count == 0:
+            return 0
+        return self.times[self.cursor - 1]
+
+    # Get last n buffer indices (oldest first)
+    def last_indices(self, n):
+        n = min(n, self.size)
+        cursor = self.cursor
+        indices = np.arange(self.length)
+        # Need to wrap back to beginning
+        if cursor - n < 0:
+            return np.concatenate((indices[cursor-n:], indices[:cursor]))
+        # Do not need to wrap
+        return indices[cursor-n:cursor]
+
+    # Get last n rows as (times, cycles, data)
+    # Returns views if window does not wrap, otherwise a single copy
+    def last(self, n):
+        n = min(n, self.size)
+        cursor = self.cursor
+        if n <= cursor:
+            window = slice(cursor - n, cursor)
+            return self.times[window], self.cycles[window], self.data[window]
+        # Window wraps around end of buffer
+        start = self.length - (n - cursor)
+        return (np.concatenate((self.times[start:], self.times[:cursor])),
+                np.concatenate((self.cycles[start:], self.cycles[:cursor])),
+                np.concatenate((self.data[start:], self.data[:cursor])))
+
+    # Get rows at given buffer indices as (times, cycles, data)
+    def take(self, indices):
+        return self.times[indices], self.cycles[indices], self.data[indices]
+
+    # Get spans of rows (oldest first) where keys (a monotonic column such as
+    # times or cycles) are from start to end (inclusive)
+    # Returns list of slices (two if the range wraps around end of buffer)
+    def search(self, keys, start, end):
+        # Buffer is empty
+        if not self.size:
+            segments = []
+        # Rows do not wrap around end of buffer
+        elif self.oldest < self.cursor:
+            segments = [(self.oldest, self.cursor)]
+        # Oldest rows are at the end of the buffer (at 0 if the buffer is exactly full)
+        else:
+            segments = [(self.oldest, self.length), (0, self.cursor)]
+        spans = []
+        for low, high in segments:
+            first = low + np.searchsorted(keys[low:high], start, side='left')
+            last = low + np.searchsorted(keys[low:high], end, side='right')
+            if first < last:
+                spans.append(slice(first, last))
+        return spans
+
+    # Get rows of spans as (times, cycles, data)
+    # Returns views for a single span, otherwise a single copy
+    def rows(self, spans):
+        if len(spans) == 1:
+            return self.take(spans[0])
+        if not spans:
+            return self.take(slice(0, 0))
+        return tuple(np.concatenate([column[span] for span in spans])
+                     for column in (self.times, self.cycles, self.data))
+
+    # Get rows with cycle numbers from start_cycle to end_cycle (inclusive)
+    def cycle_range(self, start_cycle, end_cycle):
+        return self.rows(self.search(self.cycles, start_cycle, end_cycle))
+
+    # Get rows with cycle times from start_time to end_time (inclusive)
+    def time_range(self, start_time, end_time):
+        return self.rows(self.search(self.times, start_time, end_time))
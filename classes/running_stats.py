@@ -0,0 +1,131 @@
+"""
+Running Statistics Class
+
+Keeps statistics of every buffer column up to date as each row of samples is
+added, so they never require a scan of the buffer:
+    Trial: count, mean, variance (Welford's algorithm), min and max of every
+           sample since the last reset
+    Window: count, mean, variance, min and max of the last RunningStats.window
+            rows (sums are updated incrementally, min/max/variance are computed
+            from the small window block on request)
+Missing samples (NaN) are ignored. Blocks of rows can be added at once with
+RunningStats.update_block (i.e. rows read from a shared buffer).
+"""
+import numpy as np
+
+class RunningStats:
+    def __init__(self, window, width=0):
+        # Number of rows in sliding window
+        self.window = max(int(window), 1)
+        # Rows of sliding window of form [row, column]
+        self.window_data = np.full((self.window, width), np.nan)
+        self.reset()
+
+    # Number of columns
+    @property
+    def width(self):
+        return self.window_data.shape[1]
+
+    # Clear all statistics
+    def reset(self):
+        width = self.width
+        # Trial statistics
+        self.count = np.zeros(width, dtype=np.int64)
+        self.mean = np.zeros(width)
+        self.m2 = np.zeros(width)
+        self.min = np.full(width, np.inf)
+        self.max = np.full(width, -np.inf)
+        # Window statistics
+        self.window_data[:] = np.nan
+        self.window_cursor = 0
+        self.window_count = np.zeros(width, dtype=np.int64)
+        self.window_sum = np.zeros(width)
+
+    # Add n columns, returns slice of new columns
+    def add_columns(self, n):
+        start = self.width
+        self.window_data = np.full((self.window, start + n), np.nan)
+        self.reset()
+        return slice(start, start + n)
+
+    # Add a row of samples (one per column)
+    def update(self, row):
+        valid = ~np.isnan(row)
+        values = np.where(valid, row, 0)
+        # Welford update of trial statistics
+        self.count += valid
+        delta = np.where(valid, values - self.mean, 0)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(valid, values - self.mean, 0)
+        self.min = np.fmin(self.min, row)
+        self.max = np.fmax(self.max, row)
+        # Replace oldest row of window
+        old = self.window_data[self.window_cursor]
+        old_valid = ~np.isnan(old)
+        self.window_count += valid.astype(np.int64) - old_valid
+        self.window_sum += values - np.where(old_valid, old, 0)
+        self.window_data[self.window_cursor] = row
+        self.window_cursor = (self.window_cursor + 1) % self.window
+        # Recompute sums once per window to avoid drift
+        if self.window_cursor == 0:
+            self.window_sum = np.nansum(self.window_data, axis=0)
+
+    # Add a block of rows of form [row, column] (same result as one update per row)
+    def update_block(self, rows):
+        if not len(rows):
+            return
+        valid = ~np.isnan(rows)
+        counts = valid.sum(axis=0)
+        # Combine trial statistics with those of the block (Chan et al.)
+        means = np.where(counts > 0, np.where(valid, rows, 0).sum(axis=0) / np.maximum(counts, 1), 0)
+        m2 = np.where(valid, rows - means, 0)
+        m2 = (m2 * m2).sum(axis=0)
+        total = self.count + counts
+        delta = means - self.mean
+        self.mean += delta * counts / np.maximum(total, 1)
+        self.m2 += m2 + delta * delta * self.count * counts / np.maximum(total, 1)
+        self.count = total
+        self.min = np.fmin(self.min, np.fmin.reduce(rows, axis=0))
+        self.max = np.fmax(self.max, np.fmax.reduce(rows, axis=0))
+        # Replace oldest rows of window
+        rows = rows[-self.window:]
+        indices = (self.window_cursor + np.arange(len(rows))) % self.window
+        self.window_data[indices] = rows
+        self.window_cursor = (self.window_cursor + len(rows)) % self.window
+        self.window_count = (~np.isnan(self.window_data)).sum(axis=0)
+        self.window_sum = np.nansum(self.window_data, axis=0)
+
+    # Trial variance of each column
+    def variance(self):
+        return np.where(self.count > 0, self.m2 / np.maximum(self.count, 1), np.nan)
+
+    # Window mean of each column (NaN if no samples)
+    def window_mean(self):
+        return np.where(self.window_count > 0, self.window_sum / np.maximum(self.window_count, 1), np.nan)
+
+    # Get statistics as dict of arrays (one value per column) of form
+    #   {'trial': {'count': ..., 'mean': ..., 'std': ..., 'min': ..., 'max': ...},
+    #    'window': {...}}
+    def get_stats(self):
+        has_data = self.count > 0
+        mean = self.window_mean()
+        window_valid = self.window_count > 0
+        # Window deviations from mean (missing samples ignored)
+        deviations = np.where(np.isnan(self.window_data), 0, self.window_data - mean)
+        window_variance = np.where(window_valid, (deviations ** 2).sum(axis=0) / np.maximum(self.window_count, 1), np.nan)
+        return {
+            'trial': {
+                'count': self.count.copy(),
+                'mean': np.where(has_data, self.mean, np.nan),
+                'std': np.sqrt(self.variance()),
+                'min': np.where(has_data, self.min, np.nan),
+                'max': np.where(has_data, self.max, np.nan)
+            },
+            'window': {
+                'count': self.window_count.copy(),
+                'mean': mean,
+                'std': np.sqrt(window_variance),
+                'min': np.where(window_valid, np.fmin.reduce(self.window_data, axis=0), np.nan),
+                'max': np.where(window_valid, np.fmax.reduce(self.window_data, axis=0), np.nan)
+            }
+        }
@@ -0,0 +1,221 @@
+"""
+Safety Monitor Class
+
+Runs directly behind the serial reader of a Session on its own thread. Every
+frame is parsed, converted and checked against the thresholds / shutdown times
+of all sub sensors (see ThresholdEngine) before it is handed to the rest of the
+Session, and the shutdown action is triggered from this thread. The monitor
+never waits on the buffer lock, the local log, the event loop or clients, so
+slow HDF5 flushes, JSON encoding or stalled clients cannot delay a shutdown.
+
+Converted rows (and raw rows if Session.log_raw) are passed on to Session.cycle
+thru a bounded queue. If the
+Session falls behind by more than SafetyMonitor.max_pending cycles, rows are
+dropped (and counted) instead of blocking the monitor.
+
+The shutdown action is called as action(session, mask) where mask flags the
+buffer columns that should be shut down. It is called once for each sub sensor
+that trips (until SafetyMonitor.reset). Actions for common setups:
+    serial_command(board, b'X')   write a shutdown command to the board
+    log_shutdown                  only log (default, stand-in for tests)
+or any callable, i.e. a GPIO callback:
+    Session(..., shutdown_action=lambda session, mask: GPIO.output(pin, GPIO.HIGH))
+
+The time from the arrival of the bytes of a frame (see FrameReader.arrival) to
+the end of the shutdown action must stay within SafetyMonitor.budget (in s).
+Check and shutdown times are measured on every frame (metrics stages
+safety_check and shutdown) and reported by get_stats.
+
+The monitor fails safe: frames that cannot be converted or checked are logged
+and skipped, but after SafetyMonitor.max_errors errors in a row, or if reading
+frames fails, the shutdown action is called for every column that is not shut
+down yet and the monitor stops.
+"""
+import logging
+import queue
+import threading
+from time import time, perf_counter
+import numpy as np
+from metrics import metrics
+
+logger = logging.getLogger('sensational.safety')
+
+# Shutdown action that only logs the tripped columns
+def log_shutdown(session, mask):
+    logger.critical('SHUT IT DOWN! Columns: %s', np.flatnonzero(mask).tolist())
+
+# Shutdown action that writes a command to the board
+def serial_command(board, command):
+    def action(session, mask):
+        log_shutdown(session, mask)
+        board.write(command)
+        board.flush()
+    return action
+
+class SafetyMonitor(threading.Thread):
+    def __init__(self, session, action=None, budget=0.01, max_pending=10000, max_errors=10):
+        super().__init__(name='safety_monitor', daemon=True)
+        # Session to monitor (frames are read thru Session.read_serial)
+        self.session = session
+        # Shutdown action called as action(session, mask)
+        self.action = action or log_shutdown
+        # Max time (in s) from reading a frame to the end of the shutdown action
+        self.budget = budget
+        # Converted rows waiting for Session.cycle of form (row, raw, cycle_time, mask)
+        # where raw is the row before conversion (None unless Session.log_raw)
+        self.rows = queue.Queue(max_pending)
+        # Number of rows dropped because Session.cycle fell behind
+        self.dropped = 0
+        # Columns already shut down
+        self.tripped = np.zeros(0, dtype=bool)
+        # Number of times the shutdown action was called
+        self.trips = 0
+        # Info of last trip
+        self.last_trip = None
+        # Number of frames checked
+        self.checks = 0
+        # Longest time (in s) from reading a frame to end of check / shutdown
+        self.max_latency = 0
+        # Number of frames over budget
+        self.over_budget = 0
+        # Number of frames that could not be converted or checked (in total / in a row)
+        self.errors = 0
+        self.errors_in_row = 0
+        # Errors in a row before failing safe
+        self.max_errors = max_errors
+        # Exception that stopped the monitor (if any)
+        self.error = None
+        # Run flag
+        self.running = False
+
+    # Max number of pending rows
+    @property
+    def max_pending(self):
+        return self.rows.maxsize
+
+    # Clear tripped columns (i.e. for a new trial)
+    def reset(self):
+        self.tripped = np.zeros(0, dtype=bool)
+
+    # Read and check frames until stopped
+    def run(self):
+        self.running = True
+        clock = time()
+        try:
+            while self.running:
+                start = perf_counter()
+                frame = self.session.read_serial()
+                read = perf_counter()
+                metrics.observe('serial_read', read - start)
+                # Latency is measured from the arrival of the bytes of the frame
+                arrival = self.session.frame_arrival or read
+                # Get time since last reading (in ms), from arrival time if timestamped
+                # (never negative, so cycle times stay in order)
+                now = max(self.session.frame_time or time(), clock)
+                cycle_time = (now - clock) * 1000
+                try:
+                    raw = np.full(self.session.buffer.width, np.nan) if self.session.log_raw else None
+                    row = self.session.convert_frame(frame, raw)
+                    mask = self.check(row, cycle_time, arrival)
+                except Exception as e:
+                    self.frame_error(e)
+                    continue
+                self.errors_in_row = 0
+                clock = now
+                try:
+                    self.rows.put_nowait((row, raw, cycle_time, mask))
+                except queue.Full:
+                    self.dropped += 1
+                    metrics.increment('cycles_dropped')
+        except Exception as e:
+            self.error = e
+            logger.exception('Safety Monitor Error: %s', e)
+            self.fail_safe()
+            # Wake up Session.cycle
+            self.rows.put(None)
+        finally:
+            self.running = False
+
+    # Skip a frame that could not be converted or checked
+    # Raises the error after max_errors errors in a row (monitor fails safe)
+    def frame_error(self, e):
+        self.errors += 1
+        self.errors_in_row += 1
+        metrics.increment('safety_errors')
+        if self.errors_in_row >= self.max_errors:
+            raise RuntimeError('%d frames in a row could not be checked' % self.errors_in_row) from e
+        logger.exception('Safety Check Error (frame skipped): %s', e)
+
+    # Call shutdown action for every column not shut down yet (frames can no longer
+    # be checked)
+    def fail_safe(self):
+        width = self.session.buffer.width
+        if len(self.tripped) < width:
+            self.tripped = np.concatenate((self.tripped, np.zeros(width - len(self.tripped), dtype=bool)))
+        mask = ~self.tripped
+        if not mask.any():
+            return
+        logger.critical('Safety monitor failed, shutting down all columns')
+        self.tripped |= mask
+        self.shutdown(mask, perf_counter())
+
+    # Check a converted row, trigger shutdown for newly tripped columns
+    # read: time (from perf_counter) the bytes of the frame arrived
+    # Returns shutdown mask (one flag per buffer column)
+    def check(self, row, cycle_time, read):
+        self.checks += 1
+        start = perf_counter()
+        mask = self.session.check_thresholds(row, cycle_time)
+        metrics.observe_since('threshold_check', start)
+        # Columns added since last check
+        if len(self.tripped) < len(mask):
+            self.tripped = np.concatenate((self.tripped, np.zeros(len(mask) - len(self.tripped), dtype=bool)))
+        new = mask & ~self.tripped
+        if new.any():
+            self.tripped |= mask
+            self.shutdown(new, read)
+        latency = perf_counter() - read
+        self.max_latency = max(self.max_latency, latency)
+        metrics.observe('safety_check', latency)
+        if latency > self.budget:
+            self.over_budget += 1
+            metrics.increment('safety_over_budget')
+            logger.warning('Safety check took %.2f ms (budget %.2f ms)', latency * 1000, self.budget * 1000)
+        return mask
+
+    # Call shutdown action for the given columns
+    def shutdown(self, mask, read):
+        try:
+            self.action(self.session, mask)
+        except Exception as e:
+            logger.exception('Shutdown Error: %s', e)
+        latency = perf_counter() - read
+        metrics.observe('shutdown', latency)
+        self.trips += 1
+        self.last_trip = {'frame': self.checks,
+                          'columns': np.flatnonzero(mask).tolist(),
+                          'latency': latency,
+                          'within_budget': latency <= self.budget}
+        if latency > self.budget:
+            logger.error('Shutdown took %.2f ms (budget %.2f ms)', latency * 1000, self.budget * 1000)
+
+    # Get next checked row (blocks until available)
+    # Returns (row, raw, cycle_time, mask)
+    def next_row(self):
+        item = self.rows.get()
+        if item is None:
+            raise RuntimeError('Safety monitor stopped') from self.error
+        return item
+
+    # Stop after current frame
+    def stop(self):
+        self.running = False
+
+    # Get report of form:
+    #   {'budget': 0.01, 'checks': 100, 'max_latency': 1e-4, 'over_budget': 0,
+    #    'trips': 1, 'last_trip': {'frame': 50, 'columns': [0], 'latency': 2e-4,
+    #    'within_budget': True}, 'pending': 0, 'dropped': 0, 'errors': 0}
+    def get_stats(self):
+        return {'budget': self.budget, 'checks': self.checks, 'max_latency': self.max_latency,
+                'over_budget': self.over_budget, 'trips': self.trips, 'last_trip': self.last_trip,
+                'pending': self.rows.qsize(), 'dropped': self.dropped, 'errors': self.errors}
@@ -0,0 +1,260 @@
+"""
+Segment Log Classes
+
+Append-only log format for high sample rates on slow storage, as an alternative
+to HDF5 (see LogWriter). A log is a directory of fixed-size, memory-mapped
+column files and a JSON manifest:
+
+    trial_1.seg/
+        manifest.json
+        000000_times.bin        cycle times (in ms), float64
+        000000_c000.bin         data of first sub sensor, dtype of log
+        000000_c001.bin         ...
+        000001_times.bin        next segment
+        ...
+
+manifest.json:
+    {'version': SEGMENT_LOG_VERSION,
+     'segment_size': rows per segment,
+     'dtype': dtype of data columns (i.e. '<f4'),
+     'sensors': [Sensor.get_info(), ...] in column order,
+     'channels': [{'sensor': name, 'sub_sensor': name}, ...] (c000, c001, ...),
+     'rows': number of rows logged,
+     'segments': [{'index': 0, 'start_row': 0, 'rows': 65536,
+                   'start_time': 0.1, 'end_time': 655.4,
+                   'start_cycle': 1, 'end_cycle': 65536}, ...]}
+Cycle ranges are None if cycles were not given. Missing values are NaN.
+
+Appends are plain writes into memory-mapped files (no background thread). The
+manifest is rewritten when a segment is full, on flush and at most every
+flush_interval seconds, so a log is readable (up to the last manifest) while it
+is being written. On close, the files of the last segment are trimmed.
+
+    log = SegmentLogWriter('Logs/trial_1.seg', sensors)
+    log.append(times, data)         # same interface as LogWriter
+    log.close()
+
+    log = SegmentLog('Logs/trial_1.seg')
+    times, columns = log.segment(0)  # numpy views, no copies
+    segments_to_hdf5('Logs/trial_1.seg', 'Logs/trial_1.hdf5')
+"""
+import os
+import json
+import shutil
+from time import time, perf_counter
+import numpy as np
+from log_writer import LogWriter
+from sensor import Sensor
+from metrics import metrics
+
+# Version of manifest / file layout
+SEGMENT_LOG_VERSION = 1
+# Name of manifest file
+MANIFEST = 'manifest.json'
+# Data type of times column
+TIMES_DTYPE = np.dtype('<f8')
+
+# Path of a column file of a segment (column is 'times' or channel index)
+def column_path(path, segment, column):
+    if column == 'times':
+        return os.path.join(path, '%06d_times.bin' % segment)
+    return os.path.join(path, '%06d_c%03d.bin' % (segment, column))
+
+class SegmentLogWriter:
+    def __init__(self, path, sensors, mode='x', segment_size=65536, dtype='f4', flush_interval=1.0):
+        # Path of log directory
+        self.path = path
+        # List of Sensor objects (None for empty ports) in column order
+        self.sensors = [sensor for sensor in sensors if sensor]
+        # Rows per segment
+        self.segment_size = int(segment_size)
+        # Data type of data columns
+        self.dtype = np.dtype(dtype)
+        # Max time (in s) between manifest updates
+        self.flush_interval = flush_interval
+        # Create directory (error if exists with mode 'x', replace log with mode 'w')
+        if mode == 'w' and os.path.exists(os.path.join(path, MANIFEST)):
+            shutil.rmtree(path)
+        os.makedirs(path, exist_ok=mode != 'x')
+        # Channels of form (sensor, sub_sensor) in column order
+        self.channels = [(sensor.name, sub_sensor) for sensor in self.sensors for sub_sensor in sensor.sub_sensors]
+        # Number of rows logged
+        self.length = 0
+        # Info of each segment (see manifest)
+        self.segments = []
+        # Memory maps of current segment
+        self.times = None
+        self.columns = []
+        # Time of last manifest update
+        self.last_flush = time()
+        # Open flag
+        self.running = True
+        self.write_manifest()
+
+    # Number of rows logged
+    def __len__(self):
+        return self.length
+
+    # Start a new segment
+    def open_segment(self):
+        index = len(self.segments)
+        self.segments.append({'index': index, 'start_row': self.length, 'rows': 0,
+                              'start_time': None, 'end_time': None, 'start_cycle': None, 'end_cycle': None})
+        self.times = np.memmap(column_path(self.path, index, 'times'), TIMES_DTYPE, 'w+',
+                               shape=(self.segment_size,))
+        self.columns = [np.memmap(column_path(self.path, index, i), self.dtype, 'w+', shape=(self.segment_size,))
+                        for i in range(len(self.channels))]
+
+    # Write and release memory maps of current segment
+    def close_segment(self):
+        self.times.flush()
+        for column in self.columns:
+            column.flush()
+        self.times = None
+        self.columns = []
+
+    # Log rows
+    # times: 1-D array of cycle times, data: 2-D array of form [cycle, column]
+    # cycles: 1-D array of cycle numbers (optional, for manifest)
+    def append(self, times, data, cycles=None):
+        start_time = perf_counter()
+        times = np.asarray(times, dtype=TIMES_DTYPE)
+        data = np.asarray(data).reshape(len(times), len(self.channels))
+        start = 0
+        while start < len(times):
+            if self.times is None:
+                self.open_segment()
+            segment = self.segments[-1]
+            offset = segment['rows']
+            end = min(len(times), start + self.segment_size - offset)
+            rows = end - start
+            self.times[offset:offset + rows] = times[start:end]
+            for i, column in enumerate(self.columns):
+                column[offset:offset + rows] = data[start:end, i]
+            if segment['start_time'] is None:
+                segment['start_time'] = float(times[start])
+                if cycles is not None:
+                    segment['start_cycle'] = int(cycles[start])
+            segment['end_time'] = float(times[end - 1])
+            if cycles is not None:
+                segment['end_cycle'] = int(cycles[end - 1])
+            segment['rows'] += rows
+            self.length += rows
+            # Segment full
+            if segment['rows'] == self.segment_size:
+                self.close_segment()
+                self.write_manifest()
+            start = end
+        if time() - self.last_flush > self.flush_interval:
+            self.flush()
+        metrics.observe_since('segment_write', start_time)
+
+    # Log data in form of LOG_UPDATE message
+    #   {'times': {'t': [...]}, 'sensor_1': {'sub_sensor': [...]}, ...}
+    # Sub sensors missing from the message (i.e. not subscribed) are logged as NaN
+    def append_dataset(self, dataset):
+        times = dataset['times']['t']
+        missing = np.full(len(times), np.nan)
+        columns = [dataset.get(sensor, {}).get(sub_sensor, missing) for sensor, sub_sensor in self.channels]
+        cycles = None
+        # Binary payloads hold first and last cycle
+        if dataset.get('cycles') and dataset['cycles'][0] is not None:
+            cycles = np.arange(dataset['cycles'][0], dataset['cycles'][1] + 1)
+            if len(cycles) != len(times):
+                cycles = None
+        self.append(times, np.column_stack(columns) if columns else np.empty((len(times), 0)), cycles)
+
+    # Write memory maps to disk and update manifest
+    def flush(self):
+        if self.times is not None:
+            self.times.flush()
+            for column in self.columns:
+                column.flush()
+        self.write_manifest()
+
+    # Write manifest (replaced atomically)
+    def write_manifest(self):
+        manifest = {
+            'version': SEGMENT_LOG_VERSION,
+            'segment_size': self.segment_size,
+            'dtype': self.dtype.str,
+            'sensors': [sensor.get_info() for sensor in self.sensors],
+            'channels': [{'sensor': sensor, 'sub_sensor': sub_sensor} for sensor, sub_sensor in self.channels],
+            'rows': self.length,
+            'segments': self.segments
+        }
+        temp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, os.path.join(self.path, MANIFEST))
+        self.last_flush = time()
+
+    # Write remaining data, trim last segment and update manifest
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        if self.times is not None:
+            segment = self.segments[-1]
+            self.close_segment()
+            # Trim unused rows of last segment
+            os.truncate(column_path(self.path, segment['index'], 'times'), segment['rows'] * TIMES_DTYPE.itemsize)
+            for i in range(len(self.channels)):
+                os.truncate(column_path(self.path, segment['index'], i), segment['rows'] * self.dtype.itemsize)
+        self.write_manifest()
+
+class SegmentLog:
+    def __init__(self, path):
+        # Path of log directory
+        self.path = path
+        self.refresh()
+
+    # Reread manifest (i.e. while log is being written)
+    def refresh(self):
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if self.manifest['version'] != SEGMENT_LOG_VERSION:
+            raise ValueError('Unsupported segment log version %d' % self.manifest['version'])
+        # Data type of data columns
+        self.dtype = np.dtype(self.manifest['dtype'])
+        # Channels of form (sensor, sub_sensor) in column order
+        self.channels = [(channel['sensor'], channel['sub_sensor']) for channel in self.manifest['channels']]
+        # Info of each segment
+        self.segments = self.manifest['segments']
+
+    # Number of rows logged
+    def __len__(self):
+        return self.manifest['rows']
+
+    # Get times and data columns of a segment (read-only memory maps)
+    # Returns (times, [column, ...]) with columns in channel order
+    def segment(self, index):
+        rows = self.segments[index]['rows']
+        if not rows:
+            return np.empty(0, dtype=TIMES_DTYPE), [np.empty(0, dtype=self.dtype) for _ in self.channels]
+        times = np.memmap(column_path(self.path, index, 'times'), TIMES_DTYPE, 'r', shape=(rows,))
+        columns = [np.memmap(column_path(self.path, index, i), self.dtype, 'r', shape=(rows,))
+                   for i in range(len(self.channels))]
+        return times, columns
+
+    # Get data of a sub sensor as a list of views (one per segment)
+    def channel(self, sensor_name, sub_sensor):
+        i = self.channels.index((sensor_name, sub_sensor))
+        return [self.segment(segment['index'])[1][i] for segment in self.segments]
+
+# Fold a segment log into the HDF5 layout of LogWriter
+#   times/t, <sensor>/<sub_sensor>/data
+# compression: see LogWriter
+def segments_to_hdf5(path, hdf5_path, mode='x', compression=None):
+    log = SegmentLog(path)
+    sensors = [Sensor(**info) for info in log.manifest['sensors']]
+    writer = LogWriter(hdf5_path, sensors, mode, max(len(log), 1), dtype=log.dtype, compression=compression)
+    try:
+        for segment in log.segments:
+            times, columns = log.segment(segment['index'])
+            writer.append(times, np.column_stack(columns) if columns else np.empty((len(times), 0)))
+            # Write one segment at a time
+            writer.flush()
+    finally:
+        writer.close()
+    return hdf5_path
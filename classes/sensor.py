@@ -13,10 +13,68 @@ where dict is the parsed JSON object.
 
 After initialization, the sensor must be attached to a session (see Session class)
 
+Conversions are compiled once into numpy-vectorized functions that are shared by
+all sensors with the same conversion string, so a whole block of raw frames can
+be converted in one call:
+    converted = new_sensor.convert_block(raw)
+where raw is of form [frame, sub sensor]. Conversions are compiled by the
+built-in expression compiler (see expression module), sympy is only imported
+for valid conversions that call functions it does not translate. Compiled conversions can also be cached on
+disk (see Registry class).
+
 TODO: Should everything be stored under sub-sensors?
 """
-import sympy as sp
-from sympy.parsing.sympy_parser import parse_expr
+import math
+import numpy as np
+from expression import compile_expression, check_expression, UnsupportedExpression
+from expression import FUNCTIONS, SYMPY_FUNCTIONS, CONSTANTS
+
+# Sympy names of functions with a different name in conversions
+SYMPY_NAMES = {'ln': 'log', 'abs': 'Abs'}
+
+# Vectorize scalar math function, values outside its domain are NaN
+def vectorize_math(function):
+    def scalar(x):
+        try:
+            return function(x)
+        except (ValueError, OverflowError):
+            return np.nan
+    return np.vectorize(scalar, otypes=[float])
+
+# Vectorized versions of functions sympy prints as scalar math calls
+VECTORIZED_FUNCTIONS = {name: vectorize_math(getattr(math, name)) for name in ['erf', 'erfc', 'gamma', 'lgamma']}
+# Modules of functions compiled by sympy
+SYMPY_MODULES = [VECTORIZED_FUNCTIONS, 'numpy']
+
+# Compiled conversion functions, keyed by conversion_key
+compiled_conversions = {}
+
+# Key of a conversion string (without whitespace)
+def conversion_key(conversion):
+    return ''.join(conversion.split())
+
+# Compile conversion string with sympy (slow to import)
+# Only checked expressions are parsed, with nothing but math names in scope
+def sympy_conversion(conversion):
+    check_expression(conversion)
+    import sympy as sp
+    from sympy.parsing.sympy_parser import parse_expr
+    names = set(FUNCTIONS) | SYMPY_FUNCTIONS | set(CONSTANTS) | {'Symbol', 'Integer', 'Float', 'Rational'}
+    global_dict = {name: getattr(sp, SYMPY_NAMES.get(name, name)) for name in names}
+    global_dict['__builtins__'] = {}
+    expression = parse_expr(conversion, local_dict={'x': sp.Symbol('x')}, global_dict=global_dict)
+    return sp.lambdify('x', expression, SYMPY_MODULES)
+
+# Compile conversion string to numpy-vectorized function (shared between sensors)
+def compile_conversion(conversion):
+    key = conversion_key(conversion)
+    if key not in compiled_conversions:
+        try:
+            compiled_conversions[key] = compile_expression(conversion)
+        except UnsupportedExpression:
+            # Fall back to sympy
+            compiled_conversions[key] = sympy_conversion(conversion)
+    return compiled_conversions[key]
 
 class Sensor:
     def __init__(self, name, sub_sensors, model, ranges, precisions, thresholds,
@@ -39,9 +97,21 @@ class Sensor:
         self.conversion_strings = conversions
         # Conversion function given in string form with x as variable as such:
         # '(x - 32) * (5 / 9)'
-        # Converted to lambda function
-        # If no conversion given, returns raw data
-        self.conversions = [sp.lambdify('x', parse_expr(conversion)) if conversion else lambda x: x for conversion in conversions]
+        # Converted to numpy-vectorized function
+        # If no conversion given (None), returns raw data
+        self.conversions = [compile_conversion(conversion) if conversion else None for conversion in conversions]
+        # Sub sensor indices of each conversion function
+        # Form: [ (function, [index, ...]), ... ]
+        self.conversion_groups = []
+        for i, conversion in enumerate(self.conversions):
+            if not conversion:
+                continue
+            for function, indices in self.conversion_groups:
+                if function is conversion:
+                    indices.append(i)
+                    break
+            else:
+                self.conversion_groups.append((conversion, [i]))
         # String representation of units, i.e. 'Pa' or 'K'
         # TODO: Create acceptable list and check against it so that we can
         #       use generic conversion functions as needed
@@ -54,8 +124,21 @@ class Sensor:
 
     # Convert data (i = index of data)
     def convert(self, x, i):
+        if not self.conversions[i]:
+            return x
         return self.conversions[i](x)
 
+    # Convert a block of raw data of form [frame, sub sensor]
+    def convert_block(self, raw):
+        converted = np.array(raw, dtype=float)
+        for function, indices in self.conversion_groups:
+            converted[:, indices] = function(converted[:, indices])
+        return converted
+
+    # Convert a single frame of raw data (one value per sub sensor)
+    def convert_frame(self, raw):
+        return self.convert_block(np.reshape(raw, (1, -1)))[0]
+
     def get_info(self):
         info = {
             'name': self.name,
@@ -3,79 +3,276 @@ Base Server Class
 author: Adam Johnston
 
 Class for server side (RPi) to initiate session and send data to client
+
+The session is run by a single Acquisition thread that is started with the
+server (see Acquisition class), clients only receive data and send requests.
+
+Updates are encoded once (per payload format) and broadcast to every client thru
+its own bounded ClientQueue (see ClientQueue class), so slow clients do not stall
+the server.
+
+Client requests are of form 'ACTION::payload':
+    'FORMAT::binary': receive binary payloads (see payload module), or
+                      'FORMAT::json' (default)
+    'GET_DATA::last_cycle': get all data since last_cycle
+    'SYNC::{"last_cycle": 100, "max_points": 500}': get data since last_cycle,
+                      decimated if more than max_points (see Session.get_sync_data)
+    'QUERY::{"by": "time", "start": 120000, "end": 125000, "max_points": 500}':
+                      get cycle times (in ms, or cycle numbers if by is "cycle")
+                      from start to end (see Session.get_query_data)
+    'SUBSCRIBE::{"channels": {"sensor_1": ["sub_sensor"]}, "max_rate": 2, "decimation": 10}':
+                      receive LOG_UPDATE messages of only the given channels, at
+                      most max_rate per second (see subscription module)
+    'UNSUBSCRIBE::':  receive full LOG_UPDATE messages again (default)
+Full LOG_UPDATE messages hold every cycle since the previous one (fields
+start_cycle and end_cycle), cycles overwritten in the buffer before they were
+sent are skipped.
+Rejected subscriptions (i.e. unknown sensors) are answered with
+    {"action": "ERROR", "request": "SUBSCRIBE", "message": "..."}
+and the client keeps its previous updates.
+
+With metrics_port set, hot path metrics and client queue depth / lag are exposed
+for Prometheus (see metrics module).
 """
 
 import numpy as np
 import asyncio
 import websockets
 import json
+import logging
+from time import perf_counter
+from acquisition import Acquisition
+from client_queue import ClientQueue
+from payload import PAYLOAD_FORMATS, encode_payload
+from subscription import Subscription, parse_subscription
+from metrics import metrics
+
+logger = logging.getLogger('sensational.server')
 
 class Server:
-    def __init__(self, session, port):
+    def __init__(self, session, port, queue_size=64, overflow_policy='drop_oldest', include_stats=False,
+                 metrics_port=None):
         # Fully initialized Session instance
         self.session = session
         # Websocket port
         self.port = port
-        # Clients
-        self.clients = set()
+        # Clients of form {websocket: ClientQueue}
+        self.clients = {}
+        # Subscriptions shared by clients of form {key: Subscription}
+        self.subscriptions = {}
+        # Max number of queued messages per client
+        self.queue_size = queue_size
+        # Overflow policy of client queues (see ClientQueue class)
+        self.overflow_policy = overflow_policy
+        # Add running statistics to LOG_UPDATE messages (see Session.get_stats)
+        self.include_stats = include_stats
+        # Port of Prometheus metrics endpoint (None to disable)
+        self.metrics_port = metrics_port
+        # Per client metrics
+        for stat in ['depth', 'lag', 'dropped']:
+            metrics.add_gauge('client_queue_' + stat, lambda stat=stat: {
+                client: stats[stat] for client, stats in self.get_client_stats().items()})
+        # Acquisition thread (created on start)
+        self.acquisition = None
+        # Queue of acquisition events (created on start)
+        self.events = None
+        # Last cycle sent in full LOG_UPDATE messages (set on start)
+        self.last_logged = None
 
     # Start server
     def start(self):
-       asyncio.get_event_loop().run_until_complete(
-           websockets.serve(self.main, '', self.port)
-       )
-       asyncio.get_event_loop().run_forever()
-#       while True:
-#           self.session.start()
-#           while True:
-#               self.session.cycle()
+        if self.metrics_port:
+            metrics.start_http_server(self.metrics_port)
+            logger.info('Serving metrics on port %s', self.metrics_port)
+        loop = asyncio.get_event_loop()
+        # Start acquisition
+        self.start_acquisition(loop)
+        loop.run_until_complete(
+            websockets.serve(self.main, '', self.port)
+        )
+        loop.create_task(self.dispatch_events())
+        try:
+            loop.run_forever()
+        finally:
+            # Stop acquisition and close local log
+            self.acquisition.stop()
+            self.session.stop()
+
+    # Start session and acquisition thread
+    def start_acquisition(self, loop):
+        if not self.session.is_running:
+            logger.info('Starting Session...')
+            # Init session
+            self.session.start()
+            self.session.is_running = True
+        self.events = asyncio.Queue()
+        self.last_logged = self.session.last_cycle()
+        self.acquisition = Acquisition(self.session, loop, self.events)
+        self.acquisition.start()
+
+    # Handle events from acquisition thread
+    async def dispatch_events(self):
+        while True:
+            event, cycle_number = await self.events.get()
+            if event == 'LOG_READY':
+                await self.send_log_data(cycle_number)
 
     # Main server function
     async def main(self, websocket, path):
         await self.add_client(websocket)
         try:
             while True:
-                if not self.session.is_running:
-                    print('Starting Session...')
-                    # Init session
-                    self.session.start()
-                    self.session.is_running = True
-                # Execute next cycle
-                print('Reading Serial...')
-                print('')
-                data, time, should_log = next(self.session.__iter__())
-                if should_log:
-                    await self.send_log_data(websocket)
                 # Listen for client requests
-                self.request_handler(websocket)
+                await self.request_handler(websocket)
+        except websockets.ConnectionClosed:
+            pass
         finally:
             # Disconnect client
             await self.remove_client(websocket)
 
     async def add_client(self, websocket):
-        self.clients.add(websocket)
-        print('Added client')
+        queue = ClientQueue(websocket, self.queue_size, self.overflow_policy)
+        queue.start()
+        self.clients[websocket] = queue
+        logger.info('Added client')
 
     async def remove_client(self, websocket):
-        self.clients.remove(websocket)
-        print('Client disconnected')
-
-    # Handle sending log data
-    async def send_log_data(self, websocket):
-        dset, _ = self.session.get_log_data()
-        dset['action'] = 'LOG_UPDATE'
-        if self.clients:
-            print('Sending data...')
-            await asyncio.wait([client.send(json.JSONEncoder().encode(dset)) for client in self.clients])
-            print('Data sent')
+        queue = self.clients.pop(websocket)
+        self.unsubscribe(queue)
+        queue.close()
+        logger.info('Client disconnected')
+
+    # Queue message for all clients (or given client queues)
+    # encode(format) is called once for each payload format in use
+    def broadcast(self, encode, queues=None):
+        messages = {}
+        for queue in list(self.clients.values()) if queues is None else queues:
+            if queue.format not in messages:
+                messages[queue.format] = encode(queue.format)
+            queue.put(messages[queue.format])
+
+    # Get queue stats of each client
+    # Returns dict of form {'host:port': {'depth': 0, 'sent': 0, 'dropped': 0}}
+    def get_client_stats(self):
+        stats = {}
+        for websocket, queue in self.clients.items():
+            address = websocket.remote_address
+            name = '%s:%s' % address[:2] if address else str(id(websocket))
+            stats[name] = queue.get_stats()
+        return stats
+
+    # Get stats of each subscription (see Subscription.get_stats)
+    def get_subscription_stats(self):
+        return [subscription.get_stats() for subscription in self.subscriptions.values()]
+
+    # Subscribe client to channels (see subscription module)
+    # Clients with the same subscription share one Subscription
+    def subscribe(self, queue, channels=None, max_rate=0, decimation=1):
+        subscription = Subscription(self.session, channels, max_rate, decimation)
+        subscription = self.subscriptions.setdefault(subscription.key, subscription)
+        if subscription is queue.subscription:
+            return
+        self.unsubscribe(queue)
+        subscription.queues.add(queue)
+        queue.subscription = subscription
+
+    # Return client to full updates
+    def unsubscribe(self, queue):
+        subscription = queue.subscription
+        if subscription is None:
+            return
+        subscription.queues.discard(queue)
+        if not subscription.queues:
+            del self.subscriptions[subscription.key]
+        queue.subscription = None
+
+    # Handle sending log data of all cycles up to the LOG_READY event at cycle_number
+    # (next cycle of the session), so cycles are sent once and in order even if
+    # events are handled late
+    async def send_log_data(self, cycle_number):
+        start_cycle, end_cycle = self.last_logged + 1, cycle_number - 1
+        if end_cycle < start_cycle:
+            return
+        self.last_logged = end_cycle
+        if not self.clients:
+            return
+        queues = [queue for queue in self.clients.values() if queue.subscription is None]
+        if queues:
+            times, cycles, data = self.session.get_log_range(start_cycle, end_cycle)
+            if len(times):
+                fields = {'action': 'LOG_UPDATE', 'start_cycle': start_cycle, 'end_cycle': end_cycle}
+                if self.include_stats:
+                    fields['stats'] = self.session.get_stats()
+                # Encode once for all clients without subscription
+                self.broadcast(lambda payload_format: self.encode_log_data(payload_format, fields, times, cycles, data),
+                               queues)
+        # Encode once per subscription
+        for subscription in list(self.subscriptions.values()):
+            subscription.publish()
+
+    # Encode log data in given payload format
+    def encode_log_data(self, payload_format, fields, times, cycles, data):
+        start = perf_counter()
+        message = self.encode_log_message(payload_format, fields, times, cycles, data)
+        metrics.observe_since('encode', start)
+        return message
+
+    # Build LOG_UPDATE message in given payload format
+    def encode_log_message(self, payload_format, fields, times, cycles, data):
+        if payload_format == 'binary':
+            return encode_payload(fields, self.session.get_layout(), times, cycles, data)
+        dset = self.session.label_data(times, data)
+        dset.update(fields)
+        return json.JSONEncoder().encode(dset)
 
     # Handle client requests
     async def request_handler(self, websocket):
         # Get requests
         request = await websocket.recv()
         # Split request
-        action, payload = request.split('::')
+        try:
+            action, payload = request.split('::', 1)
+        except ValueError:
+            logger.warning('Invalid request: %s', request)
+            return
+        queue = self.clients[websocket]
         # Event handler
-        if action == 'GET_DATA':
-            data = self.session.get_gui_data(payload)
-            await websocket.send(data)
+        if action == 'FORMAT':
+            if payload in PAYLOAD_FORMATS:
+                queue.format = payload
+            else:
+                logger.warning('Unknown payload format: %s', payload)
+        elif action == 'GET_DATA':
+            data = self.session.get_gui_data(payload, binary=queue.format == 'binary')
+            if data:
+                await websocket.send(data)
+        elif action == 'SYNC':
+            try:
+                sync = json.JSONDecoder().decode(payload)
+                last_cycle, max_points = int(sync['last_cycle']), int(sync.get('max_points', 1000))
+            except (ValueError, KeyError, TypeError):
+                logger.warning('Invalid sync request: %s', payload)
+                return
+            await websocket.send(self.session.get_sync_data(last_cycle, max_points, binary=queue.format == 'binary'))
+        elif action == 'QUERY':
+            try:
+                query = json.JSONDecoder().decode(payload)
+                by = query.get('by', 'time')
+                start, end = float(query['start']), float(query['end'])
+                max_points = int(query.get('max_points', 1000))
+                if by not in ['time', 'cycle']:
+                    raise ValueError
+            except (ValueError, KeyError, TypeError, AttributeError):
+                logger.warning('Invalid query: %s', payload)
+                return
+            await websocket.send(self.session.get_query_data(start, end, by, max_points,
+                                                             binary=queue.format == 'binary'))
+        elif action == 'SUBSCRIBE':
+            try:
+                self.subscribe(queue, **parse_subscription(payload))
+            except ValueError as e:
+                logger.warning('Invalid subscription: %s (%s)', payload, e)
+                await websocket.send(json.JSONEncoder().encode(
+                    {'action': 'ERROR', 'request': 'SUBSCRIBE', 'message': str(e)}))
+        elif action == 'UNSUBSCRIBE':
+            self.unsubscribe(queue)
@@ -8,21 +8,58 @@ for the following:
         [sensor_1, sensor_2, None, sensor_3]
         where None represents an empty port
     Conversions: each sensor will have corresponding conversion functions:
-        data = sensor_1.convert(raw_data, index)
+        data = sensor_1.convert_block(raw_data)
         (see Sensor class for more info)
     Check Thresholds / Trigger Shutdown: On each cycle this class will check for
         sensors outside their acceptable values and keep track of how long (in ms)
         they are outside this range. If this time is larger than the acceptable
         time (saved as Sensor.shutdown_time), the shutdown sequence will begin.
+        Frames are read, converted and checked by a SafetyMonitor on its own
+        thread, which calls Session.shutdown_action within Session.safety_budget
+        (see SafetyMonitor class), independent of logging and clients. The
+        monitor keeps checking frames after the session is stopped
     Logging Data: Will write to a log file every Session.log_interval cycles
-    Managing Data Buffer: Will hold Session.buffer_length cycles of data
-    Prepare Data for GUI: Label data and encode to JSON
+        If Session.log_file is given, every cycle is also logged locally to
+        Session.log_dir/Session.log_file (see LogWriter class), in SWMR mode so
+        the file can be read while the test is running. With
+        Session.log_format = 'segments' the local log is a memory-mapped
+        segment log instead (see SegmentLogWriter class). With Session.log_raw
+        the parsed values are logged before conversion as well, so the trial
+        can be converted again later (see reprocess module)
+    Managing Data Buffer: Will hold Session.buffer_length cycles of data in a
+        RingBuffer (see RingBuffer class), each sub sensor is a column of the
+        buffer and missing samples are stored as NaN
+    Statistics: Count, mean, std, min and max of each sub sensor are kept up to
+        date over the whole trial and over the last Session.log_interval cycles
+        (see RunningStats class and Session.get_stats)
+    Long-Range Plots: A min/max/mean decimation pyramid of the buffer is kept up
+        to date (see Pyramid class and Session.get_range)
+    Range Queries: Absolute ranges of cycle times or cycle numbers are resolved
+        to spans of the buffer by binary search (see Session.query)
+    Multi-Process Mode: If Session.shared_buffer is given, every cycle is also
+        written to a shared memory ring buffer of that name so server, logger
+        and watchdog processes can read it on other cores (see SharedRingBuffer,
+        SharedSession for a Server in another process and SharedWatchdog)
+    Prepare Data for GUI: Label data and encode to JSON (or binary payload, see
+        payload module). GUIs can sync incrementally from their last cycle with
+        a bounded number of points (see Session.get_sync_data)
 
 Like the Sensor class, the Session class can take a dict input as such:
     my_session = Session(**dict)
 where dict can be a parsed JSON object. This will allow us to create and save
 templates for different testing setups.
 
+Wire format is chosen by Session.protocol:
+    'ascii': frames of form 'port:data;port:data?', i.e. '12:134,25;13:150?'
+             would be port 12 = [134, 25], port 13 = [150]
+    'binary': CRC-checked, sequence numbered frames (see binary_protocol)
+
+Multiple boards: If Session.boards is given, each board (with its own serial
+port, baud rate and protocol) feeds a subset of Session.ports and is read on its
+own thread. Frames are timestamped on arrival and merged into one timeline by
+Session.alignment (see MultiBoardReader). com_port, baud_rate and protocol are
+not used in this mode.
+
 TODOS:
     Ensure Arduino is giving data in correct order:
         IDEA: Send data in form port:data, i.e. '12:134,25:150' would be
@@ -34,25 +71,52 @@ CONSIDERATIONS:
     Should we create a microcontroller class to attach and determine ports?
 """
 import os
+import math
+import logging
+import threading
 import numpy as np
 import h5py
 import json
-from time import time
+from time import perf_counter
 import serial
+from ring_buffer import RingBuffer
+from thresholds import ThresholdEngine
+from frame_reader import FrameReader
+from binary_protocol import BinaryFrameReader
+from multi_board import MultiBoardReader
+from payload import encode_payload, PayloadSensor
+from decimation import min_max_decimate, bucket_starts
+from log_writer import LogWriter
+from segment_log import SegmentLogWriter
+from running_stats import RunningStats
+from pyramid import Pyramid
+from safety_monitor import SafetyMonitor
+from shared_buffer import SharedRingBuffer
+from metrics import metrics
+
+logger = logging.getLogger('sensational.session')
 
 class Session:
-    def __init__(self, name, ports, log_dir, log_interval, buffer_length, com_port, log_size=10e3, log_file=None):
+    def __init__(self, name, ports, log_dir, log_interval, buffer_length, com_port, log_size=10e3, log_file=None,
+                 buffer_dtype=np.float64, baud_rate=9600, protocol='ascii', log_swmr=True,
+                 log_compression=None, pyramid_factors=(10, 100, 1000), shutdown_action=None,
+                 safety_budget=0.01, shared_buffer=None,
+                 log_format='hdf5', log_raw=False, boards=None, alignment='latest', alignment_delay=0.05):
         # TODO: Hash ID
         # Name of session
         self.name = name
         # List of available ports i.e. [12, 13, 15, 19]
         self.ports = ports
+        # Index of each port number
+        self.port_indices = {port: i for i, port in enumerate(ports)}
         # Init empty sensor List
         self.sensors = [None]*len(ports)
         # Sub sensor list
         self.sub_sensors = [None]*len(ports)
-        # List to track threshold times
-        self.threshold_times = np.array([None]*len(ports))
+        # Thresholds of all sub sensors, tracks threshold times
+        self.threshold_engine = ThresholdEngine()
+        # Sub sensors (buffer columns) that should be shut down
+        self.shutdown_mask = np.zeros(0, dtype=bool)
         # Name of log directory
         self.log_dir = log_dir
         # Name of log file
@@ -63,16 +127,35 @@ class Session:
         self.log_size = log_size
         # Counter of resizes
         self.num_log_resizes = 1
+        # Write local log in single-writer/multiple-reader mode
+        self.log_swmr = log_swmr
+        # Compression of local log ('gzip', 'lzf' or None, see LogWriter class)
+        self.log_compression = log_compression
+        # Format of local log ('hdf5' or 'segments')
+        if log_format not in ['hdf5', 'segments']:
+            raise ValueError('Unknown log format %s' % log_format)
+        self.log_format = log_format
+        # Log raw values next to converted values (HDF5 logs only)
+        if log_raw and log_format != 'hdf5':
+            raise ValueError('Raw values can only be logged with log format hdf5')
+        self.log_raw = log_raw
+        # Local log writer (created on start if log_file is given)
+        self.log = None
         # Number of cycles to hold in buffer
         self.buffer_length = buffer_length
         # Init empty buffer
-        # Buffer of form: [ [port data], [port data], ...]
-        #   where port data of form: [ [sensor 1 data], ... ]
-        self.buffer = np.array([None]*len(ports))
-        # Cursor for circular buffer
-        # NOTE: Points to NEXT index of buffer such that
-        # buffer[cursor - 1] is the most recent item
-        self.cursor = 0
+        # Buffer of form: [cycle, column] where each port owns a range of columns
+        self.buffer = RingBuffer(self.buffer_length, dtype=buffer_dtype)
+        # Buffer columns of each port (slice of sub sensor columns)
+        self.columns = [None]*len(ports)
+        # Running statistics of each buffer column (window of one log interval)
+        self.stats = RunningStats(log_interval)
+        # Decimation pyramid of buffer
+        self.pyramid = Pyramid(self.buffer_length, factors=pyramid_factors)
+        # Name of shared memory ring buffer (None for single process mode)
+        self.shared_buffer = shared_buffer
+        # Shared ring buffer (created on start)
+        self.shared = None
         # Init cycle_number
         self.cycle_number = 0
         # For GUI syncing
@@ -80,12 +163,59 @@ class Session:
         # Init trial number
         # TODO: Use for multiple log files
         self.trial = 0
-        # Init times list
-        self.times = np.zeros(self.buffer_length)
-        # TODO: Use board class
-        self.board = serial.Serial(com_port, 9600)
+        # Boards of form [{'com_port': ..., 'ports': [port, ...], 'baud_rate': 9600,
+        # 'protocol': 'ascii'}, ...] (None for a single board on com_port)
+        self.boards = boards
+        # Wire format of board ('ascii' or 'binary')
+        self.protocol = protocol
+        # Dropped / lost frames are counted by reader
+        metrics.add_gauge('frames_dropped', lambda: {self.name: self.reader.dropped})
+        metrics.add_gauge('frames_lost', lambda: {self.name: self.lost_frames})
+        if boards:
+            # Each board is read on its own thread, frames are merged into one timeline
+            # by alignment policy ('latest', 'nearest' or 'interpolate', see MultiBoardReader)
+            board_ports = [port for board in boards for port in board['ports']]
+            if len(set(board_ports)) != len(board_ports) or not set(board_ports) <= set(ports):
+                raise ValueError('Ports of boards must be distinct ports of the session')
+            self.reader = MultiBoardReader(boards, alignment, alignment_delay)
+            # First board (i.e. for shutdown commands)
+            self.board = self.reader.readers[0].board
+        else:
+            # TODO: Use board class
+            # NOTE: com_port may also be a pyserial URL, i.e. 'loop://'
+            self.board = serial.serial_for_url(com_port, baud_rate)
+            # Buffered frame reader for board
+            if protocol == 'ascii':
+                self.reader = FrameReader(self.board)
+            elif protocol == 'binary':
+                self.reader = BinaryFrameReader(self.board)
+            else:
+                raise ValueError('Unknown protocol %s' % protocol)
+        # Reads, converts and checks frames (shutdown_action of form action(session, mask))
+        self.safety = SafetyMonitor(self, shutdown_action, safety_budget)
+        metrics.add_gauge('safety_max_latency', lambda: {self.name: self.safety.max_latency})
         # To avoid reset on new client connection
         self.is_running = False
+        # Lock for buffer (cycles may run on a separate thread, see Acquisition)
+        self.lock = threading.RLock()
+
+    # Cursor for circular buffer
+    # NOTE: Points to NEXT index of buffer such that
+    # buffer[cursor - 1] is the most recent item
+    @property
+    def cursor(self):
+        return self.buffer.cursor
+
+    # Time (in ms) each sub sensor has been below/above its thresholds
+    # Form: [ [below, above], ... ] with one row per buffer column
+    @property
+    def threshold_times(self):
+        return self.threshold_engine.times
+
+    # Cumulative cycle times (in ms)
+    @property
+    def times(self):
+        return self.buffer.times
 
     # Begin session
     def start(self):
@@ -94,11 +224,55 @@ class Session:
         # while not connected:
         #     serial_in = self.board.readline()
         #     break
-        # TODO: Check for existing log_dir / create directory
         self.trial += 1
-        self.clock = time()
-        print('Started')
-    # TODO: End session
+        # Statistics are kept per trial
+        self.stats.reset()
+        self.safety.reset()
+        # Create local log
+        if self.log_file:
+            self.open_log()
+        # Create shared buffer for other processes
+        if self.shared_buffer and self.shared is None:
+            self.shared = SharedRingBuffer.create(self.shared_buffer, self.buffer_length, self.buffer.width,
+                                                  self.buffer.dtype, self.get_shared_meta())
+            logger.info('Sharing buffer as %s', self.shared_buffer)
+        logger.info('Started')
+
+    # End session
+    def stop(self):
+        self.is_running = False
+        # Cycles may still run on the acquisition thread (see Acquisition)
+        with self.lock:
+            # Write remaining data and close local log
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+            # Remove shared buffer
+            if self.shared is not None:
+                self.shared.close()
+                self.shared = None
+        logger.info('Stopped')
+
+    # Create local log file for current trial
+    # Files of form log_dir/log_file.hdf5 (log_file_2.hdf5, ... if file exists)
+    # or log_dir/log_file.seg for segment logs
+    def open_log(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        extension = '.seg' if self.log_format == 'segments' else '.hdf5'
+        filename = self.log_file
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+        path = os.path.join(self.log_dir, filename + extension)
+        suffix = 1
+        while os.path.exists(path):
+            suffix += 1
+            path = os.path.join(self.log_dir, '%s_%d%s' % (filename, suffix, extension))
+        if self.log_format == 'segments':
+            self.log = SegmentLogWriter(path, self.get_layout(), 'x')
+        else:
+            self.log = LogWriter(path, self.get_layout(), 'x', self.log_size, swmr=self.log_swmr,
+                                 compression=self.log_compression, raw=self.log_raw)
+        logger.info('Logging to %s', path)
 
     # Attach a sensor to a specified port
     def attach(self, sensor, port):
@@ -107,71 +281,57 @@ class Session:
             raise ConnectionError('Port %d in use' % port)
         # Attach sensor
         self.sensors[port] = sensor
-        # Create threshold counters for each sub sensor
-        self.threshold_times[port] = [np.array([0, 0])]*len(sensor.sub_sensors)
         # TODO: create or lookup conversion function
         # Add individual sensor names
         self.sub_sensors[port] = [name for name in sensor.sub_sensors]
-        # TODO: Initialize buffer (circular?)
-        # Buffer of form [ [sensor 1 data],
-        #                  [sensor 2 data],
-        #                   ...          ]
-        self.buffer[port] = np.array([ [None]*len(sensor.sub_sensors) ]*self.buffer_length)
+        # Add a buffer column for each sub sensor
+        self.columns[port] = self.buffer.add_columns(len(sensor.sub_sensors))
+        # Create threshold counters for each sub sensor
+        self.threshold_engine.add(sensor, self.columns[port])
+        # Create statistics for each sub sensor
+        self.stats.add_columns(len(sensor.sub_sensors))
+        self.pyramid.add_columns(len(sensor.sub_sensors))
 
     # Complete a cycle of data collection
     def cycle(self, first_run=False):
         # Wait until start of next cycle to ensure we are in sync
         if first_run:
-            print('Syncing...')
-            c = self.board.read().decode('utf-8', 'ignore')
-            while c != '?':
-                c = self.board.read().decode('utf-8', 'ignore')
+            logger.info('Syncing...')
+            self.reader.sync()
+            # Frames are read and checked by safety monitor from now on
+            self.safety.start()
             return
-        # Init empty string
-        data_string = self.read_serial()
-        print('data-string:', data_string)
-        # Get time since last reading (in ms)
-        cycle_time = (time() - self.clock) * 1000
-        # Reset clock
-        self.clock = time()
-        # Loop through data
-        for port_data in data_string.split(';'):
-            # Parse data
-            parse_error, port_index, temp_data = self.parse_serial(port_data)
-            # Data not read
-            if not temp_data:
-                continue
-            # Check for parsing error
-            if parse_error[0]:
-                print('Parsing Error:', parse_error[1])
-                continue
-            # Convert data and check thresholds
-            conversion_error, converted_data, should_shutdown = self.check_thresholds(port_index, temp_data, cycle_time)
-            # Check for shutdown
-            if should_shutdown:
-                print('SHUT IT DOWN!')
-                # TODO: Actual shutdown sequence
-            # Check for conversion error
-            if conversion_error[0]:
-                print('Conversion Error:', conversion_error[1])
-                # TODO: Possibly replace value
-            # Add to data buffer
-            self.buffer[port_index][self.cursor] = converted_data
-        # Get return data
-        curr_data = [d[self.cursor] for d in self.buffer]
-        # Append to times
-        self.times[self.cursor] = self.times[self.cursor-1] + cycle_time
-        # Log flag
-        should_log = False
-        # Check log interval
-        if self.cycle_number > 0 and self.cycle_number % self.log_interval == 0:
-            should_log = True
-        # Update cycle number
-        self.cycle_number += 1
-        # Update buffer cursor
-        self.cursor = self.cycle_number % self.buffer_length
-        print('data:', curr_data)
-        print('')
+        # Get next frame (converted and checked by safety monitor)
+        row, raw, cycle_time, self.shutdown_mask = self.safety.next_row()
+        with self.lock:
+            start = perf_counter()
+            self.buffer.row()[:] = row
+            curr_data = [row[columns] if columns else None for columns in self.columns]
+            # Append to times
+            t = self.buffer.last_time() + cycle_time
+            self.buffer.commit(t, self.cycle_number)
+            # Update statistics
+            self.stats.update(row)
+            self.pyramid.update(row, t, self.cycle_number)
+            # Publish to other processes
+            if self.shared is not None:
+                self.shared.append(row, t, self.cycle_number)
+            # Append to local log
+            if self.log is not None:
+                # Only LogWriter takes raw values (log_raw needs the hdf5 format)
+                if self.log_raw:
+                    self.log.append([t], row, [self.cycle_number], raw)
+                else:
+                    self.log.append([t], row, [self.cycle_number])
+            metrics.observe_since('buffer_write', start)
+            # Log flag
+            should_log = False
+            # Check log interval
+            if self.cycle_number > 0 and self.cycle_number % self.log_interval == 0:
+                should_log = True
+            # Update cycle number
+            self.cycle_number += 1
+        logger.debug('data: %s', curr_data)
         # Return data, time
         return curr_data, cycle_time, should_log
 
@@ -184,26 +344,83 @@ class Session:
                 self.cycle(first_run=True)
                 # Go to next iteration
                 self.cycle_number += 1
-                print('Cycle initiated')
+                logger.info('Cycle initiated')
                 continue
             # Execute next cycle
-            print('Next Cycle:')
-            print('')
             yield self.cycle()
 
-    # Get data from Arduino
+    # Get data from Arduino (next complete frame without end char)
     def read_serial(self):
-        # Init empty string
-        data_string = ''
-        # Read first character
-        c = self.board.read().decode('utf-8', 'ignore')
-        # Read until end char (?) is reached
-        while c != '?':
-            # Add to string
-            data_string += c
-            # Get next char
-            c = self.board.read().decode('utf-8', 'ignore')
-        return data_string
+        return self.reader.next_frame()
+
+    # Number of frames lost (only detected with binary protocol)
+    @property
+    def lost_frames(self):
+        return getattr(self.reader, 'lost', 0)
+
+    # Arrival time (from perf_counter) of the bytes of last frame (see FrameReader)
+    @property
+    def frame_arrival(self):
+        return self.reader.arrival
+
+    # Arrival time (from time()) of last frame, None if frames are not timestamped
+    # by the reader (single board)
+    @property
+    def frame_time(self):
+        return getattr(self.reader, 'frame_time', None)
+
+    # Parse and convert a frame into a row (one value per buffer column)
+    # Missing or unreadable samples are NaN
+    # raw: row filled with the parsed values before conversion (optional)
+    def convert_frame(self, frame, raw=None):
+        logger.debug('frame: %s', frame)
+        row = np.full(self.buffer.width, np.nan, dtype=self.buffer.dtype)
+        # Split frame into data of each port
+        start = perf_counter()
+        port_data = list(self.parse_frame(frame))
+        metrics.observe_since('parse', start)
+        # Loop through data
+        start = perf_counter()
+        for port_index, temp_data in port_data:
+            # Convert data
+            conversion_error, converted_data = self.convert_data(port_index, temp_data, raw)
+            # Check for conversion error (sample stays missing)
+            if conversion_error[0]:
+                logger.warning('Conversion Error: %s', conversion_error[1])
+                metrics.increment('conversion_errors')
+                # TODO: Possibly replace value
+                continue
+            row[self.columns[port_index]] = converted_data
+        metrics.observe_since('convert', start)
+        return row
+
+    # Split frame into data of each port, yields (port_index, data)
+    def parse_frame(self, frame):
+        # Binary (and merged multi-board) frames are already decoded into
+        # (sequence, [(port, samples), ...])
+        if self.protocol == 'binary' or self.boards:
+            sequence, port_data = frame
+            for port_number, samples in port_data:
+                port_index = self.port_indices.get(port_number)
+                # Port not found in list of ports
+                if port_index is None:
+                    logger.warning('Parsing Error: Port %d not found', port_number)
+                    metrics.increment('frame_errors')
+                    continue
+                yield port_index, samples
+            return
+        for port_data in frame.split(';'):
+            # Parse data
+            parse_error, port_index, temp_data = self.parse_serial(port_data)
+            # Data not read
+            if not temp_data:
+                continue
+            # Check for parsing error
+            if parse_error[0]:
+                logger.warning('Parsing Error: %s', parse_error[1])
+                metrics.increment('frame_errors')
+                continue
+            yield port_index, temp_data
 
     # Parse string from Arduino, returns [(error, message), port_index, data]
     def parse_serial(self, port_data):
@@ -223,117 +440,391 @@ class Session:
             except ValueError:
                 error = True
                 e = 'Error parsing port number'
-                print(e)
                 return (error, e), None, None
         try:
             # Get index of port
-            port_index = self.ports.index(port_number)
+            port_index = self.port_indices[port_number]
         # Port not found in list of ports
         # TODO: More thorough handling of error
-        except ValueError as e:
+        except KeyError:
             error = True
-            print(e)
+            e = 'Port %d not found' % port_number
             return (error, e), None, None
         # Get data from port
         temp_data = port_data.split(':')[1]
         return (error, None), port_index, temp_data
 
-    # Check tresholds
-    def check_thresholds(self, port_index, temp_data, cycle_time):
-        # Shutdown flag
-        shutdown = False
+    # Convert data of a port, returns [(error, message), data]
+    # raw: row filled with the parsed values before conversion (optional)
+    def convert_data(self, port_index, temp_data, raw=None):
         # Error flag
         error = False
         # Get corresponding sensor information
         sensor = self.sensors[port_index]
+        # No sensor attached to port
+        if not sensor:
+            error = True
+            return (error, 'No sensor on port %d' % self.ports[port_index]), np.array([None])
         # With quick cycles, data is sometimes corrupted
         try:
             # assign value(s) to index of port in data array
-            temp_data = np.array([float(x) for x in temp_data.split(',')])
+            # NOTE: Binary frames are already decoded
+            if isinstance(temp_data, str):
+                temp_data = np.array([float(x) for x in temp_data.split(',')])
+            # Incomplete data
+            if len(temp_data) != len(sensor.sub_sensors):
+                raise ValueError('Expected %d values, got %d' % (len(sensor.sub_sensors), len(temp_data)))
+            if raw is not None:
+                raw[self.columns[port_index]] = temp_data
             # Convert data
-            converted_data = np.array([sensor.convert(x, i) for i, x in enumerate(temp_data)])
-            # Check thresholds
-            for i, threshold in enumerate(sensor.thresholds):
-                # Below min
-                if converted_data[i] - sensor.precisions[i] * converted_data[i] < threshold[0]:
-                     self.threshold_times[port_index][i][0] += cycle_time
-                # Above max
-                elif converted_data[i] + sensor.precisions[i] * converted_data[i] > threshold[1]:
-                     self.threshold_times[port_index][i][1] += cycle_time
-                     # print('Threshold Warning')
-                     # print('%s, %s: %d' \
-                     #        % (self.sensors[port_index].name,
-                     #           self.sub_sensors[port_index][i],
-                     #           self.threshold_times[port_index][i][1]))
-            # TODO: check for shutdown
+            converted_data = sensor.convert_block(temp_data[np.newaxis])[0]
         except ValueError as e:
             # TODO: Maybe repeat previous value?
             error = True
             converted_data = np.array([None])
-            return (error, e), converted_data, shutdown
-        return (error, None), converted_data, shutdown
+            return (error, e), converted_data
+        # Failing conversion functions only lose the samples of this port
+        except Exception as e:
+            error = True
+            converted_data = np.array([None])
+            return (error, '%s: %s' % (type(e).__name__, e)), converted_data
+        return (error, None), converted_data
+
+    # Check thresholds of a row of converted data (one value per buffer column)
+    # Returns shutdown mask (one flag per buffer column)
+    def check_thresholds(self, values, cycle_time):
+        return self.threshold_engine.check(values, cycle_time)
+
+    # Get attached sensors in buffer column order
+    def get_layout(self):
+        attached = [(columns.start, sensor) for sensor, columns in zip(self.sensors, self.columns) if sensor]
+        return [sensor for _, sensor in sorted(attached, key=lambda item: item[0])]
+
+    # Get layout info for readers of the shared buffer of form:
+    #   {'session': name, 'log_interval': 5, 'sensors': [Sensor.get_info(), ...]}
+    # with sensors in buffer column order
+    def get_shared_meta(self):
+        return {'session': self.name, 'log_interval': self.log_interval,
+                'sensors': [sensor.get_info() for sensor in self.get_layout()]}
+
+    # Get block of buffer for logging
+    # Returns (times, cycles, data) where data is of form [cycle, column]
+    # with missing values replaced by the mean of each column
+    def get_log_block(self, indices=[]):
+        with self.lock:
+            # Get rows of buffer (last log interval if indices not given)
+            if len(indices) == 0:
+                times, cycles, data = self.buffer.last(self.log_interval)
+                # Copy views so cycles can continue
+                times, cycles, data = times.copy(), cycles.copy(), data.copy()
+                # Means of log interval are kept by running statistics
+                means = self.stats.window_mean()
+            else:
+                times, cycles, data = self.buffer.take(indices)
+                means = None
+        return times, cycles, self.fill_missing(data, means)
+
+    # Get cycles start_cycle to end_cycle (inclusive) for logging (see Session.query)
+    # Returns (times, cycles, data) as Session.get_log_block, cycles no longer in
+    # the buffer are skipped
+    def get_log_range(self, start_cycle, end_cycle):
+        result = self.query(start_cycle, end_cycle, by='cycle')
+        if result['overwritten']:
+            logger.warning('Log Cycle Error: cycles from %d overwritten before logging', start_cycle)
+        return result['times'], result['cycles'], self.fill_missing(result['data'])
+
+    # Replace missing values with mean of each column (or given means)
+    def fill_missing(self, data, means=None):
+        missing = np.isnan(data)
+        if missing.any():
+            counts = len(data) - missing.sum(axis=0)
+            if not counts.all():
+                logger.warning('Log Cycle Error: No data collected')
+            if means is None:
+                means = np.nansum(data, axis=0) / np.maximum(counts, 1)
+            # Columns without data are zero
+            data = np.where(missing, np.nan_to_num(means), data)
+        return data
 
     # Get log data
     # Returns data for logging
     def get_log_data(self, indices=[], return_json=False):
         # Get cycle number
         cycle_number = self.cycle_number
-        # Get indices for buffer if not given
-        if len(indices) == 0:
-            indices = self.get_last_n_indices(self.log_interval)
+        times, _, data = self.get_log_block(indices)
+        dset = self.label_data(times, data)
+        if return_json:
+            return json.JSONEncoder().encode(dset), cycle_number
+        return dset, cycle_number
+
+    # Label block of buffer data by sensor / sub sensor
+    # Returns dict of form:
+    #   {'times': {'t': [...]}, 'sensor_1': {'sub_sensor': [...]}, ...}
+    def label_data(self, times, data):
         # Init data dict
         dset = {}
         dset['times'] = {}
         # Get cycle times
-        dset['times']['t'] = self.times[indices].tolist()
+        dset['times']['t'] = times.tolist()
         # Get data from buffer
         for port_index, sensor in enumerate(self.sensors):
+            # Empty port
+            if not sensor:
+                continue
             dset[sensor.name] = {}
-            # Transpose so that sub sensors are rows
-            port_data = self.buffer[port_index][indices].T
+            port_data = data[:, self.columns[port_index]]
             for i, sub_sensor in enumerate(sensor.sub_sensors):
-                # Get mean to replace None values
-                try:
-                    mean = port_data[i][port_data[i] != None].mean()
-                except ZeroDivisionError:
-                    mean = 0
-                    print('Log Cycle Error: No data collected')
-                dset[sensor.name][sub_sensor] = [d if d else mean for d in port_data[i]]
-        if return_json:
-            return json.JSONEncoder().encode(dset), cycle_number
-        return dset, cycle_number
+                dset[sensor.name][sub_sensor] = port_data[:, i].tolist()
+        return dset
+
+    # Label block of given buffer columns (see Session.get_channel_columns)
+    # Returns dict of same form as Session.label_data
+    def label_columns(self, times, data, layout):
+        dset = {'times': {'t': times.tolist()}}
+        i = 0
+        for sensor in layout:
+            dset[sensor.name] = {}
+            for sub_sensor in sensor.sub_sensors:
+                dset[sensor.name][sub_sensor] = data[:, i].tolist()
+                i += 1
+        return dset
+
+    # Get buffer columns of channels of form {'sensor_1': ['sub_sensor', ...], 'sensor_2': None}
+    # (None for all sub sensors of a sensor, all sensors if channels is None)
+    # Returns (columns, layout) in buffer column order, where layout is a list of
+    # PayloadSensor (see payload module)
+    def get_channel_columns(self, channels=None):
+        sensors = {sensor.name: sensor for sensor in self.get_layout()}
+        if channels is None:
+            channels = {name: None for name in sensors}
+        unknown = [name for name in channels if name not in sensors]
+        if unknown:
+            raise ValueError('Unknown sensors %s' % ', '.join(unknown))
+        columns = []
+        layout = []
+        for sensor in self.get_layout():
+            if sensor.name not in channels:
+                continue
+            sub_sensors = channels[sensor.name]
+            if sub_sensors is None:
+                sub_sensors = sensor.sub_sensors
+            unknown = [name for name in sub_sensors if name not in sensor.sub_sensors]
+            if unknown:
+                raise ValueError('Unknown sub sensors %s of %s' % (', '.join(unknown), sensor.name))
+            # Keep buffer column order
+            sub_sensors = [name for name in sensor.sub_sensors if name in sub_sensors]
+            start = self.columns[self.sensors.index(sensor)].start
+            columns += [start + sensor.sub_sensors.index(name) for name in sub_sensors]
+            layout.append(PayloadSensor(sensor.name, sub_sensors))
+        return columns, layout
+
+    # Cycle number of newest row in buffer
+    def last_cycle(self):
+        with self.lock:
+            if self.buffer.count:
+                return int(self.buffer.cycles[self.cursor - 1])
+            return self.cycle_number - 1
+
+    # Get rows newer than last_cycle of the given buffer columns, only cycles
+    # divisible by decimation (at most one buffer of rows)
+    # Returns (end_cycle, times, cycles, data) where end_cycle is the newest cycle
+    # in the buffer and missing values are replaced (see Session.fill_missing)
+    def get_column_block(self, last_cycle, columns, decimation=1):
+        with self.lock:
+            end_cycle = self.last_cycle()
+            num_cycles = min(max(0, end_cycle - int(last_cycle)), self.buffer.count)
+            times, cycles, data = self.buffer.last(num_cycles)
+            # Copy only the rows and columns that are sent
+            if decimation > 1:
+                keep = cycles % decimation == 0
+                times, cycles, data = times[keep], cycles[keep], data[keep]
+            else:
+                times, cycles = times.copy(), cycles.copy()
+            data = data[:, columns]
+        return end_cycle, times, cycles, self.fill_missing(data)
+
+    # Get running statistics of each sub sensor
+    # Returns dict of form:
+    #   {'sensor_1': {'sub_sensor': {'trial': {'count': 10, 'mean': 1.5, 'std': 0.5,
+    #                                          'min': 1, 'max': 2},
+    #                                'window': {...}}}}
+    # where window covers the last Session.log_interval cycles
+    # Values are None if no data was collected
+    def get_stats(self):
+        with self.lock:
+            stats = self.stats.get_stats()
+        dset = {}
+        for port_index, sensor in enumerate(self.sensors):
+            # Empty port
+            if not sensor:
+                continue
+            dset[sensor.name] = {}
+            for i, sub_sensor in enumerate(sensor.sub_sensors):
+                column = self.columns[port_index].start + i
+                dset[sensor.name][sub_sensor] = {
+                    span: {key: values[column].item() if np.isfinite(values[column]) else None
+                           for key, values in span_stats.items()}
+                    for span, span_stats in stats.items()
+                }
+        return dset
+
+    # Get log data as binary payload (see payload module)
+    # Extra fields are added to the payload header
+    def get_log_payload(self, indices=[], action='LOG_UPDATE', **fields):
+        times, cycles, data = self.get_log_block(indices)
+        fields['action'] = action
+        return encode_payload(fields, self.get_layout(), times, cycles, data)
 
     # Get data going back (cycle_number - last_cycle) cycles (to be sent to GUI)
     # Returns JSON of form:
     #   {"times": [100, 200, ...], "sensor_1": {"sub_sensor": {"data": [data...]} }, ...}
-    def get_gui_data(self, last_cycle):
-        # Get current cycle
-        current_cycle = self.cycle_number
-        # Determine how far to go back
-        num_cycles = current_cycle - int(last_cycle)
-        if num_cycles < 1:
-            return
-        # Get indices for buffer
-        indices = self.get_last_n_indices(num_cycles)
-        print(current_cycle, last_cycle)
-        # Get data (in same form as log data)
-        dset, _ = self.get_log_data(indices)
-        # NOTE: current_cycle will become last_cycle on next call from GUI
+    # or a binary payload if binary is True
+    def get_gui_data(self, last_cycle, binary=False):
+        with self.lock:
+            # Get current cycle
+            current_cycle = self.cycle_number
+            # Determine how far to go back
+            num_cycles = current_cycle - int(last_cycle)
+            if num_cycles < 1:
+                return
+            # Get indices for buffer
+            indices = self.get_last_n_indices(num_cycles)
+            logger.debug('GUI update: cycles %s to %d', last_cycle, current_cycle)
+            # NOTE: current_cycle will become last_cycle on next call from GUI
+            if binary:
+                return self.get_log_payload(indices, 'GUI_UPDATE', current_cycle=current_cycle,
+                                            last_update=self.last_update)
+            # Get data (in same form as log data)
+            dset, _ = self.get_log_data(indices)
         dset['current_cycle'] = current_cycle
         dset['last_update'] = self.last_update
         dset['action'] = 'GUI_UPDATE'
         return json.JSONEncoder().encode(dset)
 
-    # TODO: initiate shutdown sequence
-    # Possibly set shutdown pin to HIGH
+    # Get data newer than last_cycle for GUI syncing, with at most max_points rows
+    # If there are more rows (or older rows were overwritten in the buffer) the
+    # data is min/max decimated (see decimation module)
+    # Returns JSON (or binary payload if binary is True) with fields:
+    #   start_cycle, end_cycle: range of cycles covered
+    #   current_cycle: cycle number of session
+    #   decimated: True if data is decimated
+    #   complete: False if some cycles were overwritten before syncing
+    def get_sync_data(self, last_cycle, max_points, binary=False):
+        max_points = max(2, int(max_points))
+        with self.lock:
+            current_cycle = self.cycle_number
+            # Last cycle in buffer
+            end_cycle = int(self.buffer.cycles[self.cursor - 1]) if self.buffer.count else int(last_cycle)
+            # Number of new cycles
+            num_cycles = max(0, end_cycle - int(last_cycle))
+            if num_cycles:
+                times, cycles, data = self.get_log_block(self.get_last_n_indices(num_cycles))
+            # Already up to date
+            else:
+                times, cycles, data = self.buffer.take(slice(0, 0))
+        fields = {
+            'action': 'SYNC',
+            'start_cycle': int(cycles[0]) if len(cycles) else end_cycle + 1,
+            'end_cycle': end_cycle,
+            'current_cycle': current_cycle,
+            'decimated': len(times) > max_points,
+            'complete': len(times) == num_cycles
+        }
+        times, cycles, data = min_max_decimate(times, cycles, data, max_points)
+        if binary:
+            return encode_payload(fields, self.get_layout(), times, cycles, data)
+        dset = self.label_data(times, data)
+        dset.update(fields)
+        return json.JSONEncoder().encode(dset)
+
+    # Get rows of an absolute range (inclusive) of cycle times in ms (by='time') or
+    # cycle numbers (by='cycle')
+    # Returns dict of form:
+    #   {'times': [...], 'cycles': [...], 'data': [cycle, column],
+    #    'overwritten': True if the start of the range is no longer in the buffer,
+    #    'pending': True if the end of the range has not been collected yet}
+    # Arrays are copies, or views of the buffer if copy is False (only valid while
+    # holding Session.lock, ranges that wrap around the end of the buffer are copied)
+    def query(self, start, end, by='time', copy=True):
+        if by not in ['time', 'cycle']:
+            raise ValueError('Unknown query key %s' % by)
+        with self.lock:
+            keys = self.buffer.times if by == 'time' else self.buffer.cycles
+            spans = self.buffer.search(keys, start, end)
+            times, cycles, data = self.buffer.rows(spans)
+            if copy and len(spans) == 1:
+                times, cycles, data = times.copy(), cycles.copy(), data.copy()
+            if self.buffer.count:
+                overwritten = self.buffer.wrapped and start < keys[self.buffer.oldest]
+                pending = end > keys[self.cursor - 1]
+            else:
+                overwritten, pending = False, True
+        return {'times': times, 'cycles': cycles, 'data': data,
+                'overwritten': bool(overwritten), 'pending': bool(pending)}
+
+    # Get query result (see Session.query) for GUI with at most max_points rows
+    # (min/max decimated if there are more, see decimation module)
+    # Returns JSON (or binary payload if binary is True) with fields:
+    #   by, start, end: range of query
+    #   overwritten, pending: see Session.query
+    #   decimated: True if data is decimated
+    def get_query_data(self, start, end, by='time', max_points=1000, binary=False):
+        result = self.query(start, end, by)
+        times, cycles = result['times'], result['cycles']
+        # Replace missing values (as for log data)
+        data = self.fill_missing(result['data'])
+        fields = {
+            'action': 'QUERY',
+            'by': by,
+            'start': start,
+            'end': end,
+            'overwritten': result['overwritten'],
+            'pending': result['pending'],
+            'decimated': len(times) > max(2, int(max_points))
+        }
+        times, cycles, data = min_max_decimate(times, cycles, data, max(2, int(max_points)))
+        if binary:
+            return encode_payload(fields, self.get_layout(), times, cycles, data)
+        dset = self.label_data(times, data)
+        dset.update(fields)
+        return json.JSONEncoder().encode(dset)
+
+    # Get cycles start_cycle to end_cycle (inclusive) with at most max_points rows
+    # Uses the finest pyramid level (or raw buffer) that fits in max_points, or the
+    # coarsest level min/max decimated to max_points
+    # Returns dict of form:
+    #   {'factor': cycles per row (approx.), 'times': [...], 'cycles': [...],
+    #    'min': [cycle, column], 'max': [cycle, column], 'mean': [cycle, column]}
+    # NOTE: Incomplete buckets are not included, so the most recent cycles of
+    # coarse levels may be missing
+    def get_range(self, start_cycle, end_cycle, max_points):
+        max_points = max(2, int(max_points))
+        num_cycles = end_cycle - start_cycle + 1
+        with self.lock:
+            # Raw buffer fits
+            if num_cycles <= max_points:
+                times, cycles, data = self.buffer.cycle_range(start_cycle, end_cycle)
+                return {'factor': 1, 'times': times.copy(), 'cycles': cycles.copy(),
+                        'min': data.copy(), 'max': data.copy(), 'mean': data.copy()}
+            # Finest level that fits (or coarsest level)
+            for level in self.pyramid.levels:
+                if math.ceil(num_cycles / level.factor) <= max_points:
+                    break
+            times, cycles, mins, maxs, means = (column.copy() for column in level.get_range(start_cycle, end_cycle))
+        factor = level.factor
+        # Decimate coarsest level further if needed
+        if len(times) > max_points:
+            starts = bucket_starts(len(times), max_points)
+            factor *= int(math.ceil(len(times) / len(starts)))
+            times, cycles = times[starts], cycles[starts]
+            mins = np.fmin.reduceat(mins, starts, axis=0)
+            maxs = np.fmax.reduceat(maxs, starts, axis=0)
+            valid = ~np.isnan(means)
+            counts = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+            sums = np.add.reduceat(np.where(valid, means, 0), starts, axis=0)
+            means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        return {'factor': factor, 'times': times, 'cycles': cycles, 'min': mins, 'max': maxs, 'mean': means}
 
     # Get last n indices from buffer using cursor
     def get_last_n_indices(self, n):
-        cursor = self.cursor
-        indices = np.arange(self.buffer_length)
-        # Need to wrap back to beginning
-        if cursor - n < 0:
-            return np.concatenate((indices[cursor-n:], indices[:cursor]))
-        # Do not need to wrap
-        else:
-            return indices[cursor-n:cursor]
+        return self.buffer.last_indices(n)
@@ -0,0 +1,297 @@
+"""
+Shared Ring Buffer Classes
+
+Ring buffer in a multiprocessing.shared_memory block (Python 3.8+) so cycles
+collected by the Session process can be read by other processes (server,
+logger, watchdog, ...) on other cores without going thru the GIL of the Session:
+
+    # Session process (see Session.shared_buffer)
+    shared = SharedRingBuffer.create('sensational', length, width, meta=layout)
+    shared.append(row, t, cycle_number)
+
+    # Any other process
+    shared = SharedRingBuffer.attach('sensational')
+    count, rows = shared.read_since(last_count)
+
+See SharedSession (server process) and SharedWatchdog (watchdog process).
+
+SharedBufferView reads the block in place with the read methods of RingBuffer
+(last, take, search, cycle_range, ...): it is pinned to a row count, hides the
+oldest SharedBufferView.reserve rows (the next ones the writer overwrites) and
+tells if the rows it exposed were overwritten while they were read:
+
+    view = SharedBufferView(shared)
+    view.pin(shared.count())
+    times, cycles, data = view.cycle_range(100, 200)
+    if not view.valid():
+        # Read again
+
+Memory layout (version 1, little-endian):
+    offset  type        field
+    0       4 bytes     magic b'SNSR'
+    4       uint16      layout version (SHARED_BUFFER_VERSION)
+    6       uint16      reserved
+    8       uint32      sequence (seqlock, odd while a row is being written)
+    12      uint32      meta_length: length of meta JSON (in bytes)
+    16      uint64      count: number of rows written
+    24      uint64      length: number of rows held
+    32      uint64      width: number of columns
+    40      8 bytes     dtype of data (numpy dtype string, i.e. '<f8')
+    48      JSON        meta (i.e. {'sensors': [Sensor.get_info(), ...]}),
+                        zero padded to a multiple of 8 bytes
+            float64     times[length]: cycle times (in ms)
+            int64       cycles[length]: cycle numbers
+            dtype       data[length, width]: samples, NaN for missing
+
+Cursor protocol: row count % length is the next row to be written. The single
+writer increments sequence (odd), writes times / cycles / data of the row,
+increments count and increments sequence again (even). Readers read count
+between two reads of an even, unchanged sequence. Rows [count - n, count) can
+be used in place (no copy) as long as the writer has not started to overwrite
+them, i.e. while SharedRingBuffer.valid(count, n) is True, which readers should
+check after using the rows. read_since / last copy rows and retry on overwrite.
+
+NOTE: The sequence is 32 bits so it is updated atomically on 32 bit boards.
+Python does not expose memory barriers, so readers on weakly ordered CPUs should
+always confirm windows with SharedRingBuffer.valid.
+"""
+import json
+import struct
+import numpy as np
+from ring_buffer import RingBuffer
+
+# Optional dependency (Python 3.8+)
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Start of block marker
+MAGIC = b'SNSR'
+# Version of memory layout
+SHARED_BUFFER_VERSION = 1
+# Header: magic, version, reserved, sequence, meta_length, count, length, width, dtype
+HEADER = struct.Struct('<4sHHIIQQQ8s')
+# Offsets of header fields updated by the writer
+SEQUENCE_OFFSET = 8
+COUNT_OFFSET = 16
+# Alignment of arrays (in bytes)
+ALIGNMENT = 8
+
+# Offset of arrays for given meta length
+def data_offset(meta_length):
+    offset = HEADER.size + meta_length
+    return offset + -offset % ALIGNMENT
+
+class SharedRingBuffer:
+    def __init__(self, block, owner=False):
+        # Shared memory block
+        self.block = block
+        # Block is unlinked on close by the process that created it
+        self.owner = owner
+        magic, version, _, _, meta_length, _, length, width, dtype = HEADER.unpack_from(block.buf)
+        if magic != MAGIC:
+            raise ValueError('Not a shared ring buffer')
+        if version != SHARED_BUFFER_VERSION:
+            raise ValueError('Unsupported shared buffer version %d' % version)
+        # Number of rows held
+        self.length = length
+        # Data type of samples
+        self.dtype = np.dtype(dtype.rstrip(b'\0').decode('ascii'))
+        # Layout info written by the creator
+        self.meta = json.loads(bytes(block.buf[HEADER.size:HEADER.size + meta_length]).decode('utf-8'))
+        buf = block.buf
+        # Seqlock sequence and row count
+        self.sequence = np.ndarray((1,), dtype='<u4', buffer=buf, offset=SEQUENCE_OFFSET)
+        self.counter = np.ndarray((1,), dtype='<u8', buffer=buf, offset=COUNT_OFFSET)
+        offset = data_offset(meta_length)
+        # Cycle times, cycle numbers and samples (views of the block)
+        self.times = np.ndarray((length,), dtype='<f8', buffer=buf, offset=offset)
+        offset += length * 8
+        self.cycles = np.ndarray((length,), dtype='<i8', buffer=buf, offset=offset)
+        offset += length * 8
+        self.data = np.ndarray((length, width), dtype=self.dtype, buffer=buf, offset=offset)
+
+    # Create a new block
+    # meta: JSON serializable layout info (i.e. sensors) for readers
+    @classmethod
+    def create(cls, name, length, width, dtype=np.float64, meta=None):
+        if shared_memory is None:
+            raise ImportError('multiprocessing.shared_memory (Python 3.8+) is required for shared buffers')
+        dtype = np.dtype(dtype)
+        meta = json.dumps(meta or {}).encode('utf-8')
+        size = data_offset(len(meta)) + int(length) * (16 + int(width) * dtype.itemsize)
+        block = shared_memory.SharedMemory(name, create=True, size=size)
+        HEADER.pack_into(block.buf, 0, MAGIC, SHARED_BUFFER_VERSION, 0, 0, len(meta), 0, int(length), int(width),
+                         dtype.str.encode('ascii'))
+        block.buf[HEADER.size:HEADER.size + len(meta)] = meta
+        shared = cls(block, owner=True)
+        shared.data[:] = np.nan
+        shared.cycles[:] = -1
+        return shared
+
+    # Attach to an existing block
+    @classmethod
+    def attach(cls, name):
+        if shared_memory is None:
+            raise ImportError('multiprocessing.shared_memory (Python 3.8+) is required for shared buffers')
+        block = shared_memory.SharedMemory(name)
+        # Only the creator should unlink the block (Python < 3.13 tracks attached blocks too)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(block._name, 'shared_memory')
+        except (ImportError, AttributeError, KeyError):
+            pass
+        return cls(block)
+
+    # Name of shared memory block
+    @property
+    def name(self):
+        return self.block.name
+
+    # Number of columns
+    @property
+    def width(self):
+        return self.data.shape[1]
+
+    # Write a row (single writer only)
+    def append(self, row, t, cycle_number):
+        index = int(self.counter[0] % self.length)
+        self.sequence[0] += 1
+        self.times[index] = t
+        self.cycles[index] = cycle_number
+        self.data[index] = row
+        self.counter[0] += 1
+        self.sequence[0] += 1
+
+    # Number of rows written (consistent with sequence)
+    def count(self):
+        while True:
+            sequence = self.sequence[0]
+            if sequence & 1:
+                continue
+            count = int(self.counter[0])
+            if self.sequence[0] == sequence:
+                return count
+
+    # Check that rows [count - n, count) have not been overwritten
+    def valid(self, count, n):
+        return self.count() - count < self.length - n
+
+    # Get last n rows before count (at most length - 1) without copying
+    # Returns list of (times, cycles, data) views, oldest first
+    def window(self, count, n):
+        n = max(0, min(n, count, self.length - 1))
+        start = (count - n) % self.length
+        end = count % self.length
+        if start <= end:
+            spans = [slice(start, end)]
+        else:
+            spans = [slice(start, self.length), slice(0, end)]
+        return [(self.times[span], self.cycles[span], self.data[span]) for span in spans if span.stop > span.start]
+
+    # Copy rows written after last_count (at most length - 1 rows)
+    # Returns (count, (times, cycles, data)), rows lost to overwriting are skipped
+    def read_since(self, last_count):
+        while True:
+            count = self.count()
+            n = count - last_count
+            views = self.window(count, n)
+            if views:
+                rows = tuple(np.concatenate(column) for column in zip(*views))
+            else:
+                rows = (np.empty(0), np.empty(0, dtype=np.int64), np.empty((0, self.width), dtype=self.dtype))
+            # Retry if writer overwrote rows while copying
+            if self.valid(count, len(rows[0])):
+                return count, rows
+
+    # Copy last n rows
+    # Returns (times, cycles, data)
+    def last(self, n):
+        count = self.count()
+        times, cycles, data = self.read_since(count - min(n, count))[1]
+        return times[-n:], cycles[-n:], data[-n:]
+
+    # Detach from block (and remove it if this process created it)
+    def close(self):
+        # Views must be released before the block can be closed
+        self.sequence = self.counter = self.times = self.cycles = self.data = None
+        self.block.close()
+        if self.owner:
+            self.block.unlink()
+
+class SharedBufferView(RingBuffer):
+    def __init__(self, shared, reserve=None):
+        # Shared ring buffer to read
+        self.shared = shared
+        # Number of rows held by block
+        self.length = shared.length
+        # Data type of samples
+        self.dtype = shared.dtype
+        # Cycle times, cycle numbers and samples (views of the block)
+        self.times = shared.times
+        self.cycles = shared.cycles
+        self.data = shared.data
+        # Oldest rows not exposed, the writer can write this many rows while a
+        # pinned view is read
+        self.reserve = max(1, int(reserve if reserve is not None else self.length // 10))
+        # Row count the view is pinned to (None if not pinned)
+        self.pinned = None
+        # Number of rows exposed
+        self.exposed = 0
+        # Number of columns handed out by add_columns
+        self.attached = 0
+
+    # Total number of rows committed (pinned)
+    @property
+    def count(self):
+        return self.pinned or 0
+
+    # Cursor of pinned row count
+    @property
+    def cursor(self):
+        return self.count % self.length
+
+    # Number of valid rows in buffer (rows that may be overwritten are hidden)
+    @property
+    def size(self):
+        return self.exposed
+
+    # Index of oldest exposed row
+    @property
+    def oldest(self):
+        return (self.cursor - self.exposed) % self.length
+
+    # True if rows before the oldest exposed row were written
+    @property
+    def wrapped(self):
+        return self.count > self.exposed
+
+    # Hand out the next n columns of the block (the block has all columns already)
+    def add_columns(self, n):
+        start = self.attached
+        if start + n > self.width:
+            raise ValueError('Shared buffer has %d columns' % self.width)
+        self.attached += n
+        return slice(start, start + n)
+
+    # Pin view to the rows written before count (count must have been written)
+    def pin(self, count):
+        self.pinned = count
+        # Rows written since count are closer to the exposed rows
+        behind = self.shared.count() - count
+        self.exposed = max(0, min(count, self.length - self.reserve - behind))
+
+    # Unpin view (nothing is exposed)
+    def unpin(self):
+        self.pinned = None
+        self.exposed = 0
+
+    # Check that the exposed rows have not been overwritten since the view was pinned
+    def valid(self):
+        return self.shared.valid(self.count, self.exposed)
+
+    # Release views of the block (so it can be closed)
+    def release(self):
+        self.unpin()
+        self.times = self.cycles = self.data = None
@@ -0,0 +1,197 @@
+"""
+Shared Session Class
+
+Stand-in for a Session in another process of multi-process mode (see
+Session.shared_buffer and SharedRingBuffer). Attaches to the shared buffer of the
+acquisition process and reads it in place, so a Server (and all JSON / binary
+encoding) runs in its own process, on its own core and GIL:
+
+    # Acquisition process (owns the serial port, safety monitor and local log)
+    session = Session(..., shared_buffer='sensational')
+
+    # Server process
+    session = SharedSession('sensational')
+    Server(session, port).start()
+
+All read methods of Session (log data, GUI sync, queries, ranges, statistics,
+subscriptions) read the shared buffer thru a SharedBufferView: rows are not
+copied into the server process. Each read pins the view to the rows processed
+so far and is repeated if the writer overwrote rows while they were read (see
+pinned_read). The oldest SharedSession.reserve rows of the shared buffer are
+not exposed, so reads are only repeated if the server falls behind.
+
+New rows are processed in blocks that end at log intervals, so LOG_READY events
+are published for every log interval as in the acquisition process (see
+Acquisition class). Each block updates the running statistics and the decimation
+pyramid in a few numpy operations, straight from the shared buffer. Rows
+overwritten before they were processed are skipped and counted in
+SharedSession.missed.
+
+The serial port, conversions, threshold checks and shutdowns stay in the
+acquisition process (see SharedWatchdog for a second check in another process).
+"""
+import logging
+import threading
+from time import sleep
+import numpy as np
+from sensor import Sensor
+from session import Session
+from ring_buffer import RingBuffer
+from running_stats import RunningStats
+from pyramid import Pyramid
+from thresholds import ThresholdEngine
+from shared_buffer import SharedRingBuffer, SharedBufferView
+
+logger = logging.getLogger('sensational.shared_session')
+
+# Max number of times a read is repeated after rows were overwritten
+MAX_READ_RETRIES = 3
+
+# Run a read method of Session with the view pinned to the rows processed so far
+# Repeated if the writer overwrote rows while they were read
+def pinned_read(method):
+    def read(self, *args, **kwargs):
+        with self.lock:
+            # Nested read or detached (empty buffer)
+            if self.shared is None or self.buffer.pinned is not None:
+                return method(self, *args, **kwargs)
+            try:
+                for _ in range(MAX_READ_RETRIES):
+                    self.buffer.pin(self.shared_count)
+                    result = method(self, *args, **kwargs)
+                    if self.buffer.valid():
+                        return result
+                    self.retries += 1
+                logger.warning('Shared buffer overwritten while reading (%s)', method.__name__)
+                return result
+            finally:
+                self.buffer.unpin()
+    return read
+
+class SharedSession(Session):
+    def __init__(self, shared_buffer, reserve=None, pyramid_factors=(10, 100, 1000), poll_interval=0.005):
+        # Name of shared memory ring buffer
+        self.shared_buffer = shared_buffer
+        # Shared ring buffer of acquisition process
+        self.shared = SharedRingBuffer.attach(shared_buffer)
+        meta = self.shared.meta
+        sensors = [Sensor(**info) for info in meta['sensors']]
+        # Name of session
+        self.name = meta['session']
+        # Frequency of logging in cycles
+        self.log_interval = meta['log_interval']
+        # One port per sensor (in buffer column order)
+        self.ports = list(range(len(sensors)))
+        self.port_indices = {port: i for i, port in enumerate(self.ports)}
+        self.sensors = [None]*len(sensors)
+        self.sub_sensors = [None]*len(sensors)
+        # Thresholds are checked by the acquisition process (kept for Session.attach)
+        self.threshold_engine = ThresholdEngine()
+        # Number of cycles held by shared buffer
+        self.buffer_length = self.shared.length
+        # View of shared buffer (read in place), the oldest reserve rows are not exposed
+        self.buffer = SharedBufferView(self.shared, reserve)
+        self.reserve = self.buffer.reserve
+        self.columns = [None]*len(sensors)
+        # Running statistics of each buffer column (window of one log interval)
+        self.stats = RunningStats(self.log_interval)
+        # Decimation pyramid of shared buffer
+        self.pyramid = Pyramid(self.buffer_length, factors=pyramid_factors)
+        # Number of next cycle
+        self.cycle_number = 0
+        # For GUI syncing
+        self.last_update = 0
+        # No local log or raw values in this process
+        self.log = None
+        self.log_raw = False
+        # Time (in s) between polls of shared buffer
+        self.poll_interval = poll_interval
+        # Row count of shared buffer processed so far (reads are pinned to it)
+        self.shared_count = 0
+        # Time (in ms) of last row processed
+        self.last_time = 0
+        # Number of rows overwritten before they were processed
+        self.missed = 0
+        # Number of reads repeated because rows were overwritten
+        self.retries = 0
+        # To avoid reset on new client connection
+        self.is_running = False
+        # Lock for statistics / pyramid and pinning (rows are processed on the
+        # acquisition thread of the server)
+        self.lock = threading.RLock()
+        for port, sensor in enumerate(sensors):
+            self.attach(sensor, port)
+
+    # Read methods of Session on the shared buffer (see pinned_read)
+    last_cycle = pinned_read(Session.last_cycle)
+    get_log_block = pinned_read(Session.get_log_block)
+    get_column_block = pinned_read(Session.get_column_block)
+    get_gui_data = pinned_read(Session.get_gui_data)
+    get_sync_data = pinned_read(Session.get_sync_data)
+    query = pinned_read(Session.query)
+    get_range = pinned_read(Session.get_range)
+
+    # Begin with the rows the shared buffer exposes
+    def start(self):
+        self.stats.reset()
+        self.shared_count = max(0, self.shared.count() - self.buffer_length + self.reserve)
+        logger.info('Reading shared buffer %s of session %s', self.shared_buffer, self.name)
+
+    # Detach from shared buffer
+    def stop(self):
+        self.is_running = False
+        with self.lock:
+            if self.shared is not None:
+                # Views of the block must be released before it is closed
+                width = self.buffer.width
+                self.buffer.release()
+                self.buffer = RingBuffer(1, width)
+                self.shared.close()
+                self.shared = None
+        logger.info('Stopped')
+
+    # Process new rows of the shared buffer, yields (None, cycle_time, should_log)
+    # once per block of rows (blocks end at log intervals)
+    def __iter__(self):
+        while True:
+            with self.lock:
+                # Detached (stopped)
+                if self.shared is None:
+                    return
+                count = self.shared.count()
+                n = min(count - self.shared_count, self.buffer_length - 1)
+                self.missed += count - self.shared_count - n
+                self.shared_count = count - n
+            if not n:
+                sleep(self.poll_interval)
+                continue
+            while True:
+                with self.lock:
+                    if self.shared is None:
+                        return
+                    if self.shared_count == count:
+                        break
+                    times, cycles, data = self.shared.window(count, count - self.shared_count)[0]
+                    # Block ends after the next cycle at the end of a log interval
+                    head = cycles[:self.log_interval]
+                    ends = np.flatnonzero((head > 0) & (head % self.log_interval == 0))
+                    should_log = bool(len(ends))
+                    end = ends[0] + 1 if should_log else len(times)
+                    cycle_time = self.process(count, times[:end], cycles[:end], data[:end])
+                    # Views of the block must not be held while waiting
+                    times = cycles = data = head = None
+                yield None, cycle_time, should_log
+
+    # Update statistics and pyramid with a block of rows (views of the shared
+    # buffer before count), returns time (in ms) of last row since the row before
+    def process(self, count, times, cycles, data):
+        previous = times[-2] if len(times) > 1 else self.last_time
+        self.stats.update_block(data)
+        self.pyramid.update_block(times, cycles, data)
+        # Rows of block (and after it) must not have changed while they were used
+        if not self.shared.valid(count, count - self.shared_count):
+            logger.warning('Shared buffer overwritten while processing rows')
+        self.shared_count += len(times)
+        self.last_time = float(times[-1])
+        self.cycle_number = int(cycles[-1]) + 1
+        return float(times[-1] - previous)
@@ -0,0 +1,138 @@
+"""
+Shared Watchdog Class
+
+Independent safety check in its own process for multi-process mode (see
+Session.shared_buffer and SharedRingBuffer). Attaches to the shared buffer of the
+acquisition process, checks every new row against the thresholds / shutdown
+times of the sensors in the buffer meta (see ThresholdEngine) and calls the
+shutdown action for tripped columns, like the SafetyMonitor of the acquisition
+process but without sharing its GIL:
+
+    watchdog = SharedWatchdog('sensational', action=lambda watchdog, mask: GPIO.output(pin, GPIO.HIGH))
+    watchdog.run()
+
+Rows are checked in place (zero-copy windows of the shared buffer, confirmed with
+SharedRingBuffer.valid after the check). Rows overwritten before they could be
+checked are counted in SharedWatchdog.missed.
+
+The watchdog fails safe: if no new rows arrive for SharedWatchdog.timeout
+seconds after the first row (acquisition process stalled or died), the shutdown
+action is called for every column not shut down yet. Shutdown actions are called
+as action(watchdog, mask) (see safety_monitor module for common actions).
+"""
+import logging
+from time import sleep, perf_counter
+import numpy as np
+from sensor import Sensor
+from thresholds import ThresholdEngine
+from shared_buffer import SharedRingBuffer
+from safety_monitor import log_shutdown
+
+logger = logging.getLogger('sensational.watchdog')
+
+class SharedWatchdog:
+    def __init__(self, shared_buffer, action=None, timeout=1.0, poll_interval=0.001):
+        # Name of shared memory ring buffer
+        self.shared_buffer = shared_buffer
+        # Shared ring buffer of acquisition process
+        self.shared = SharedRingBuffer.attach(shared_buffer)
+        # Sensors in buffer column order
+        self.sensors = [Sensor(**info) for info in self.shared.meta['sensors']]
+        # Thresholds of all sub sensors, tracks threshold times
+        self.threshold_engine = ThresholdEngine()
+        start = 0
+        for sensor in self.sensors:
+            columns = slice(start, start + len(sensor.sub_sensors))
+            self.threshold_engine.add(sensor, columns)
+            start = columns.stop
+        # Shutdown action called as action(watchdog, mask)
+        self.action = action or log_shutdown
+        # Max time (in s) without new rows before failing safe
+        self.timeout = timeout
+        # Time (in s) between polls of shared buffer
+        self.poll_interval = poll_interval
+        # Row count of shared buffer checked so far
+        self.last_count = self.shared.count()
+        # Time of last checked row (in ms, cycle times of the acquisition process)
+        self.last_time = None
+        # Columns already shut down
+        self.tripped = np.zeros(self.threshold_engine.width, dtype=bool)
+        # Number of rows checked / overwritten before they were checked
+        self.checks = 0
+        self.missed = 0
+        # Number of times the shutdown action was called
+        self.trips = 0
+        # Set once the acquisition process stalled
+        self.stalled = False
+        # Run flag
+        self.running = False
+
+    # Check new rows until stopped
+    def run(self):
+        self.running = True
+        last_row = None
+        try:
+            while self.running:
+                if self.poll():
+                    last_row = perf_counter()
+                elif last_row is not None and not self.stalled and perf_counter() - last_row > self.timeout:
+                    self.stalled = True
+                    logger.critical('No cycles for %.2f s, shutting down all columns', self.timeout)
+                    self.shutdown(~self.tripped)
+                else:
+                    sleep(self.poll_interval)
+        finally:
+            self.running = False
+
+    # Stop after current poll
+    def stop(self):
+        self.running = False
+
+    # Check rows written since last poll, returns number of rows checked
+    def poll(self):
+        count = self.shared.count()
+        n = count - self.last_count
+        if not n:
+            return 0
+        checked = 0
+        for times, cycles, data in self.shared.window(count, n):
+            for t, row in zip(times, data):
+                self.check(row, t)
+                checked += 1
+        # Rows changed while they were checked (writer lapped the watchdog)
+        if not self.shared.valid(count, checked):
+            logger.warning('Shared buffer overwritten while checking rows')
+        self.missed += n - checked
+        self.last_count = count
+        self.checks += checked
+        return checked
+
+    # Check a row at cycle time t (in ms), trigger shutdown for newly tripped columns
+    def check(self, row, t):
+        cycle_time = 0 if self.last_time is None else t - self.last_time
+        self.last_time = t
+        mask = self.threshold_engine.check(row, cycle_time)
+        new = mask & ~self.tripped
+        if new.any():
+            self.shutdown(new)
+
+    # Call shutdown action for the given columns
+    def shutdown(self, mask):
+        if not mask.any():
+            return
+        self.tripped |= mask
+        self.trips += 1
+        try:
+            self.action(self, mask)
+        except Exception as e:
+            logger.exception('Shutdown Error: %s', e)
+
+    # Detach from shared buffer
+    def close(self):
+        self.shared.close()
+
+    # Get report of form:
+    #   {'checks': 100, 'missed': 0, 'trips': 1, 'tripped': [0], 'stalled': False}
+    def get_stats(self):
+        return {'checks': self.checks, 'missed': self.missed, 'trips': self.trips,
+                'tripped': np.flatnonzero(self.tripped).tolist(), 'stalled': self.stalled}
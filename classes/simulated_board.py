@@ -0,0 +1,136 @@
+"""
+Simulated Board Class
+
+Stands in for the Arduino so a Session can run without hardware. Frames are
+written on a background thread at SimulatedBoard.rate frames per second (as fast
+as possible if rate is 0) in any wire format of FRAME_ENCODERS, either to a
+pseudo terminal (POSIX only) or to a pyserial loop:// port:
+
+    board = SimulatedBoard([17, 18], sub_sensors=3, rate=1000)
+    session = Session(..., com_port=board.open_pty())
+    board.start()
+
+    session = Session(..., com_port='loop://')
+    board.connect(session.board)
+    board.start()
+
+Every sample of a frame holds the sequence number of the frame (wraps at 2^24 so
+it is exact in float32), so receivers can tell which frame a sample came from and
+look up when it was sent with SimulatedBoard.sent_time. A fraction
+(corruption_rate) of frames have one random byte flipped before they are sent;
+their sent time is not recorded.
+"""
+import os
+import random
+import threading
+from time import perf_counter, sleep
+import numpy as np
+from binary_protocol import encode_binary_frame
+
+# Largest sequence number held by samples (exact in float32)
+MAX_SEQUENCE = 2**24
+# Number of sent times kept (per frame)
+HISTORY_LENGTH = 2**16
+
+# Encode a frame of form 'port:v1,v2;port:v1?' from a list of (port, samples)
+def encode_ascii_frame(sequence, port_data):
+    return (';'.join('%d:%s' % (port, ','.join('%.10g' % sample for sample in samples))
+                     for port, samples in port_data) + '?').encode('ascii')
+
+# Frame encoders of each Session.protocol, called as encode(sequence, [(port, samples), ...])
+FRAME_ENCODERS = {'ascii': encode_ascii_frame, 'binary': encode_binary_frame}
+
+class SimulatedBoard(threading.Thread):
+    def __init__(self, ports, sub_sensors=1, rate=100, protocol='ascii', corruption_rate=0, seed=None):
+        super().__init__(name='simulated_board', daemon=True)
+        if protocol not in FRAME_ENCODERS:
+            raise ValueError('Unknown protocol %s' % protocol)
+        # Port numbers to send data for
+        self.ports = ports
+        # Number of sub sensors of each port (int for all ports)
+        self.sub_sensors = sub_sensors if isinstance(sub_sensors, (list, tuple)) else [sub_sensors]*len(ports)
+        # Frames per second (0 for as fast as possible)
+        self.rate = rate
+        # Wire format (see FRAME_ENCODERS)
+        self.protocol = protocol
+        self.encode = FRAME_ENCODERS[protocol]
+        # Fraction of frames to corrupt
+        self.corruption_rate = corruption_rate
+        # Random number generator for corruption
+        self.random = random.Random(seed)
+        # Function to write bytes (set by open_pty / connect)
+        self.write = None
+        # Sequence number of next frame
+        self.sequence = 0
+        # Number of frames / bytes sent
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        # Number of corrupted frames
+        self.corrupted = 0
+        # Send time (from perf_counter) of recent frames, NaN if corrupted
+        self.sent_times = np.full(HISTORY_LENGTH, np.nan)
+        # Run flag
+        self.running = False
+
+    # Create pseudo terminal to write to (POSIX only)
+    # Returns device name to use as Session.com_port
+    def open_pty(self):
+        import pty
+        import tty
+        master, slave = pty.openpty()
+        # Send bytes as is (no line discipline)
+        tty.setraw(slave)
+        self.write = lambda data: os.write(master, data)
+        return os.ttyname(slave)
+
+    # Write to a pyserial-like object, i.e. the board of a Session with com_port 'loop://'
+    def connect(self, board):
+        self.write = board.write
+
+    # Send time (from perf_counter) of the frame a sample came from
+    # Returns None if unknown, corrupted or too old
+    def sent_time(self, value):
+        value = int(value)
+        # Latest frame with this value
+        sequence = value + MAX_SEQUENCE * ((self.sequence - 1 - value) // MAX_SEQUENCE)
+        if not 0 < self.sequence - sequence <= HISTORY_LENGTH:
+            return None
+        sent = self.sent_times[sequence % HISTORY_LENGTH]
+        return None if np.isnan(sent) else sent
+
+    # Build next frame
+    # Returns (frame, corrupted)
+    def next_frame(self):
+        value = self.sequence % MAX_SEQUENCE
+        port_data = [(port, [value]*count) for port, count in zip(self.ports, self.sub_sensors)]
+        frame = self.encode(self.sequence, port_data)
+        if self.corruption_rate and self.random.random() < self.corruption_rate:
+            frame = bytearray(frame)
+            # Flip bits of one byte (last byte is kept, so ascii frames stay terminated)
+            frame[self.random.randrange(len(frame) - 1)] ^= self.random.randrange(1, 256)
+            return bytes(frame), True
+        return frame, False
+
+    # Send frames until stopped
+    def run(self):
+        if self.write is None:
+            raise RuntimeError('Board not connected, call open_pty or connect first')
+        self.running = True
+        start = perf_counter()
+        while self.running:
+            # Wait until next frame is due
+            if self.rate:
+                delay = start + self.frames_sent / self.rate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            frame, corrupted = self.next_frame()
+            self.sent_times[self.sequence % HISTORY_LENGTH] = np.nan if corrupted else perf_counter()
+            self.sequence += 1
+            self.write(frame)
+            self.corrupted += corrupted
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+
+    # Stop after current frame
+    def stop(self):
+        self.running = False
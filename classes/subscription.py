@@ -0,0 +1,113 @@
+"""
+Subscription Class
+
+Lets a client receive only the channels it shows instead of every sub sensor at
+every log interval. Clients subscribe with:
+
+    'SUBSCRIBE::{"channels": {"sensor_1": ["sub_sensor", ...], "sensor_2": null},
+                 "max_rate": 2, "decimation": 10}'
+
+    channels     sub sensors of each sensor (null for all sub sensors of a
+                 sensor), all sensors if not given
+    max_rate     max LOG_UPDATE messages per second (0 or not given: one per log
+                 interval)
+    decimation   only send cycles whose cycle number is a multiple of decimation
+
+and go back to full updates with 'UNSUBSCRIBE::'. Clients with the same
+channels, max_rate and decimation share one Subscription: each update is built
+once from the buffer (only the subscribed columns) and encoded once per payload
+format in use. Updates hold every (decimated) cycle since the last update of the
+subscription, so rate limited clients do not lose cycles that are still in the
+buffer. Subscribed LOG_UPDATE messages have the usual form (see
+Session.label_columns / payload module) with the fields:
+    start_cycle, end_cycle: range of cycles covered
+    decimation: decimation of subscription
+"""
+import json
+from time import perf_counter
+from payload import encode_payload
+from metrics import metrics
+
+# Parse payload of SUBSCRIBE request
+# Returns dict of form {'channels': {...} or None, 'max_rate': 0, 'decimation': 1}
+# Raises ValueError for invalid requests
+def parse_subscription(payload):
+    try:
+        request = json.JSONDecoder().decode(payload) if payload else {}
+        channels = request.get('channels')
+        if channels is not None:
+            channels = {str(sensor): None if sub_sensors is None else [str(name) for name in sub_sensors]
+                        for sensor, sub_sensors in channels.items()}
+        max_rate = float(request.get('max_rate') or 0)
+        decimation = int(request.get('decimation') or 1)
+    except (TypeError, AttributeError) as e:
+        raise ValueError(str(e))
+    if max_rate < 0 or decimation < 1:
+        raise ValueError('max_rate must be >= 0 and decimation >= 1')
+    return {'channels': channels, 'max_rate': max_rate, 'decimation': decimation}
+
+class Subscription:
+    def __init__(self, session, channels=None, max_rate=0, decimation=1):
+        # Session to read data from
+        self.session = session
+        # Buffer columns and their layout (see Session.get_channel_columns)
+        self.columns, self.layout = session.get_channel_columns(channels)
+        # Max messages per second (0 for no limit)
+        self.max_rate = max_rate
+        # Only cycles divisible by decimation are sent
+        self.decimation = decimation
+        # Subscriptions with the same key are shared
+        self.key = (tuple(self.columns), max_rate, decimation)
+        # Client queues of subscribed clients
+        self.queues = set()
+        # Last cycle sent (updates start at the next cycle collected)
+        self.last_cycle = session.last_cycle()
+        # Time (from perf_counter) of last update
+        self.last_sent = None
+        # Number of updates / bytes built (per format)
+        self.updates = 0
+        self.bytes = 0
+
+    # Check if rate limit allows an update at time now
+    def due(self, now):
+        return not self.max_rate or self.last_sent is None or now - self.last_sent >= 1 / self.max_rate
+
+    # Build update (if due) and queue it for all subscribed clients
+    # Returns number of clients the update was queued for
+    def publish(self):
+        now = perf_counter()
+        if not self.queues or not self.due(now):
+            return 0
+        end_cycle, times, cycles, data = self.session.get_column_block(self.last_cycle, self.columns, self.decimation)
+        fields = {'action': 'LOG_UPDATE', 'start_cycle': self.last_cycle + 1, 'end_cycle': end_cycle,
+                  'decimation': self.decimation}
+        self.last_cycle = end_cycle
+        if not len(times):
+            return 0
+        self.last_sent = now
+        self.updates += 1
+        # Encode once per payload format
+        messages = {}
+        for queue in list(self.queues):
+            if queue.format not in messages:
+                messages[queue.format] = self.encode(queue.format, fields, times, cycles, data)
+                self.bytes += len(messages[queue.format])
+            queue.put(messages[queue.format])
+        metrics.observe_since('encode', now)
+        return len(self.queues)
+
+    # Encode update in given payload format
+    def encode(self, payload_format, fields, times, cycles, data):
+        if payload_format == 'binary':
+            return encode_payload(fields, self.layout, times, cycles, data)
+        dset = self.session.label_columns(times, data, self.layout)
+        dset.update(fields)
+        return json.JSONEncoder().encode(dset)
+
+    # Get report of form:
+    #   {'channels': {'sensor_1': ['sub_sensor']}, 'max_rate': 2, 'decimation': 10,
+    #    'clients': 3, 'updates': 10, 'bytes': 12345}
+    def get_stats(self):
+        return {'channels': {sensor.name: list(sensor.sub_sensors) for sensor in self.layout},
+                'max_rate': self.max_rate, 'decimation': self.decimation, 'clients': len(self.queues),
+                'updates': self.updates, 'bytes': self.bytes}
@@ -0,0 +1,67 @@
+"""
+Threshold Engine Class
+
+Evaluates safety thresholds for every attached sub sensor at once. When a sensor
+is attached to a Session its thresholds, precisions and shutdown times are
+stacked into arrays with one row per buffer column, so each cycle is checked
+with a handful of numpy operations instead of a Python loop per value.
+
+A value is below its threshold if value - precision * |value| < min and above
+if value + precision * |value| > max. The engine keeps track of how long (in ms)
+each sub sensor has been continuously below/above its thresholds:
+    times[column] = [ms below, ms above]
+A sub sensor should be shut down once it is out of range and the time on that
+side reaches its shutdown time (so a shutdown time of 0 trips on the first out of
+range value, never while in range).
+Missing samples (NaN) leave the counters unchanged.
+"""
+import numpy as np
+
+class ThresholdEngine:
+    def __init__(self):
+        # Min and max thresholds per column
+        self.mins = np.empty(0)
+        self.maxs = np.empty(0)
+        # Relative precision per column
+        self.precisions = np.empty(0)
+        # Allowed time (in ms) out of range per column of form [below, above]
+        self.shutdown_times = np.empty((0, 2))
+        # Time (in ms) spent out of range per column of form [below, above]
+        self.times = np.zeros((0, 2))
+
+    # Number of columns tracked
+    @property
+    def width(self):
+        return len(self.mins)
+
+    # Add thresholds of a sensor for the given buffer columns
+    def add(self, sensor, columns):
+        # Columns must be added in order
+        if columns.start != self.width:
+            raise ValueError('Threshold columns must be added in buffer order')
+        thresholds = np.array(sensor.thresholds, dtype=float).reshape(-1, 2)
+        self.mins = np.concatenate((self.mins, thresholds[:, 0]))
+        self.maxs = np.concatenate((self.maxs, thresholds[:, 1]))
+        self.precisions = np.concatenate((self.precisions, np.array(sensor.precisions, dtype=float)))
+        shutdown_times = np.array(sensor.shutdown_times, dtype=float).reshape(-1, 2)
+        self.shutdown_times = np.concatenate((self.shutdown_times, shutdown_times))
+        self.times = np.concatenate((self.times, np.zeros((len(thresholds), 2))))
+
+    # Reset out of range times
+    def reset(self):
+        self.times[:] = 0
+
+    # Check values (one per column) and accumulate out of range times
+    # Returns shutdown mask with one flag per column
+    def check(self, values, cycle_time, columns=slice(None)):
+        times = self.times[columns]
+        # Apply precision
+        error = self.precisions[columns] * np.abs(values)
+        below = values - error < self.mins[columns]
+        above = ~below & (values + error > self.maxs[columns])
+        # Missing values keep their counters
+        valid = ~np.isnan(values)
+        times[:, 0] = np.where(below, times[:, 0] + cycle_time, np.where(valid, 0, times[:, 0]))
+        times[:, 1] = np.where(above, times[:, 1] + cycle_time, np.where(valid, 0, times[:, 1]))
+        # Out of range (this cycle) for too long
+        return ((times >= self.shutdown_times[columns]) & np.stack((below, above), axis=1)).any(axis=1)
@@ -1,6 +1,8 @@
 from sensational import Sensor, Client
 from accelerometer import accelerometer, session
 import argparse
+import json
+import logging
 
 # Commmand line arguments
 parser = argparse.ArgumentParser()
@@ -8,12 +10,19 @@ parser.add_argument('-i', '--ip_address', help='IP address of server', default='
 parser.add_argument('-p', '--port', help='Websocket port', required=True)
 parser.add_argument('--log_dir', help='Directory for log files', default='Logs')
 parser.add_argument('--log_file', help='Log file name (no extension)', default='test')
+parser.add_argument('--compression', help='Log compression (gzip or lzf)', default=None)
+parser.add_argument('--log_format', help='Log format (hdf5 or segments)', default='hdf5')
+parser.add_argument('--subscribe', help='Subscription as JSON, i.e. \'{"channels": {"Accelerometer": ["temp"]}, "max_rate": 2}\'',
+                    default=None)
+parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='INFO')
 args = parser.parse_args()
+logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
 
 # Get sensor info
 acc = Sensor(**accelerometer)
 # Create client
-client = Client([acc], args.ip_address, args.port, args.log_dir, args.log_file)
+client = Client([acc], args.ip_address, args.port, args.log_dir, args.log_file, log_compression=args.compression,
+                log_format=args.log_format, subscription=json.loads(args.subscribe) if args.subscribe else None)
 
 # Start client
 client.start()
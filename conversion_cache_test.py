@@ -0,0 +1,46 @@
+import sensational
+from registry import ConversionCache
+from expression import SYMPY_FUNCTIONS
+from sensor import compiled_conversions
+import argparse
+import logging
+import shutil
+import tempfile
+import numpy as np
+
+# Builds a cold conversion cache, then reads it warm (see ConversionCache), loaded
+# conversions must convert arrays like freshly compiled ones
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--cache_dir', help='Cache directory (temporary if not given)', default=None)
+args = parser.parse_args()
+logging.basicConfig(level='WARNING')
+
+cache_dir = args.cache_dir or tempfile.mkdtemp(prefix='sensational_cache_')
+conversions = ['(x - 32) * (5 / 9)', '2 * sin(x) + pi', 'log(x, 10)']
+conversions += ['%s(x, 3)' % name if name == 'root' else '%s(x)' % name for name in sorted(SYMPY_FUNCTIONS)]
+raw = np.linspace(-3, 3, 100)[:, np.newaxis].repeat(2, axis=1)
+
+# Convert raw values with every conversion
+def convert_all(cache):
+    with np.errstate(all='ignore'):
+        return [np.asarray(cache.get(conversion)(raw), dtype=float) for conversion in conversions]
+
+# Cold cache compiles every conversion
+compiled_conversions.clear()
+cold = ConversionCache(cache_dir)
+expected = convert_all(cold)
+assert cold.misses == len(conversions) and cold.hits == 0, (cold.misses, cold.hits)
+print('Cold: %d misses' % cold.misses)
+
+# Warm cache loads every conversion from disk
+compiled_conversions.clear()
+warm = ConversionCache(cache_dir)
+converted = convert_all(warm)
+assert warm.hits == len(conversions) and warm.misses == 0, (warm.hits, warm.misses)
+for conversion, a, b in zip(conversions, expected, converted):
+    assert a.shape == b.shape and np.allclose(a, b, equal_nan=True), conversion
+print('Warm: %d hits' % warm.hits)
+
+if not args.cache_dir:
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,35 @@
+from sensational import Sensor
+from expression import FUNCTIONS, SYMPY_FUNCTIONS
+from sensor import compile_conversion
+import argparse
+import logging
+import numpy as np
+
+# Runs every function allowed in conversions on an array of raw values (see
+# expression module), each must return one finite or NaN value per sample
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', help='Number of samples per sub sensor', default='100')
+args = parser.parse_args()
+logging.basicConfig(level='ERROR')
+
+# Functions of two arguments
+BINARY = {'atan2', 'Min', 'Max', 'root'}
+
+raw = np.linspace(-3, 3, int(args.samples))[:, np.newaxis].repeat(2, axis=1)
+for name in sorted(set(FUNCTIONS) | SYMPY_FUNCTIONS):
+    conversion = '%s(x, 3)' % name if name in BINARY else '%s(x)' % name
+    with np.errstate(all='ignore'):
+        converted = np.asarray(compile_conversion(conversion)(raw), dtype=float)
+    assert converted.shape == raw.shape, (conversion, converted.shape)
+    assert not np.isinf(converted).all(), conversion
+    print('%-12s ok' % conversion)
+
+# Sensors convert blocks of frames with the same functions
+sensor = Sensor(name='Test', sub_sensors=['a', 'b'], model='Test', ranges=[[-3, 3]]*2, precisions=[0, 0],
+                thresholds=[[-3, 3]]*2, shutdown_times=[[0, 0]]*2, conversions=['erf(x)', 'gamma(x) + 1'],
+                units=['', ''], documentation='', position=[0, 0])
+converted = sensor.convert_block(raw)
+assert converted.shape == raw.shape
+assert np.allclose(converted[-1], [0.9999779, 3])
+print('Sensor block ok')
@@ -0,0 +1,71 @@
+from sensational import SimulatedBoard
+from multi_board import MultiBoardReader, ALIGNMENTS
+import argparse
+import logging
+import time
+import numpy as np
+
+# Merges frames of boards on loop:// ports, with corrupted frames (see MultiBoardReader)
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--duration', help='Length of simulated run of each alignment (in s)', default='1')
+parser.add_argument('--corruption_rate', help='Fraction of corrupted frames in simulated run', default='0.2')
+args = parser.parse_args()
+# Parsing errors of corrupted frames are expected
+logging.basicConfig(level='ERROR')
+
+# Create reader of two boards (port 1 on first board, port 2 on second board)
+def make_reader(alignment, max_delay=1.0):
+    reader = MultiBoardReader([{'com_port': 'loop://', 'ports': [1]}, {'com_port': 'loop://', 'ports': [2]}],
+                              alignment=alignment, max_delay=max_delay)
+    # Frames start after the first terminator
+    for board in reader.readers:
+        board.board.write(b'?')
+    reader.sync()
+    return reader
+
+# Write frames of form [(board index, frame), ...] with time between them
+def write_frames(reader, frames, delay=0.02):
+    for index, frame in frames:
+        reader.readers[index].board.write(frame)
+        time.sleep(delay)
+
+# Interpolated between frames of second board with the same number of samples
+reader = make_reader('interpolate')
+write_frames(reader, [(1, b'2:0,0,0,0?'), (0, b'1:5,5,5,5?'), (1, b'2:10,10,10,10?')])
+_, port_data = reader.next_frame()
+port_data = dict(port_data)
+assert sorted(port_data) == [1, 2], port_data
+assert len(port_data[2]) == 4 and np.all((port_data[2] > 0) & (port_data[2] < 10)), port_data
+print('Interpolated: %s' % port_data[2])
+
+# Corrupted frame (different number of samples) falls back to nearest samples
+write_frames(reader, [(0, b'1:6,6,6,6?'), (1, b'2:20,20,20?')])
+_, port_data = reader.next_frame()
+port_data = dict(port_data)
+assert sorted(port_data) == [1, 2], port_data
+assert list(port_data[2]) in [[10]*4, [20]*3], port_data
+print('Corrupted frame, nearest: %s' % port_data[2])
+reader.stop()
+
+# Simulated boards with corrupted frames, readers must keep merging
+for alignment in ALIGNMENTS:
+    reader = make_reader(alignment, max_delay=0.05)
+    boards = [SimulatedBoard([port], sub_sensors=4, rate=500, corruption_rate=float(args.corruption_rate), seed=i)
+              for i, port in enumerate([1, 2])]
+    for board, board_reader in zip(boards, reader.readers):
+        board.connect(board_reader.board)
+        board.start()
+    merged = 0
+    end = time.time() + float(args.duration)
+    while time.time() < end:
+        reader.next_frame()
+        merged += 1
+    for board in boards:
+        board.stop()
+    reader.stop()
+    assert all(board_reader.is_alive() for board_reader in reader.readers), alignment
+    assert merged > 0, alignment
+    print('%s: merged %d frames, %d corrupted, %d dropped' % (
+        alignment, merged, sum(board.corrupted for board in boards), reader.dropped))
+print('OK')
@@ -0,0 +1,46 @@
+"""
+Reprocess logs
+
+Converts HDF5 logs (written with Session(..., log_raw=True)) again with the
+sensor templates of a template directory and writes a JSON report of threshold
+summaries (see reprocess module):
+
+    python reprocess_logs.py Logs/*.hdf5 --templates Templates --output_dir Reprocessed
+"""
+from sensational import Registry
+from reprocess import reprocess
+import argparse
+import glob
+import json
+import logging
+from time import perf_counter
+
+# Process pool workers import this script, so everything runs under main
+if __name__ == '__main__':
+    # Commmand line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', help='HDF5 log files (or glob patterns)', nargs='+')
+    parser.add_argument('--templates', help='Template directory with updated sensors', default='Templates')
+    parser.add_argument('--output_dir', help='Directory of new log files (logs are replaced if not given)', default=None)
+    parser.add_argument('--workers', help='Number of worker processes (number of CPUs if not given)', default=None)
+    parser.add_argument('--chunk_size', help='Rows per chunk', default='65536')
+    parser.add_argument('--max_pending', help='Max chunks converted ahead of writing (2 per worker if not given)',
+                        default=None)
+    parser.add_argument('-o', '--output', help='Report file', default='reprocess_results.json')
+    parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+    paths = sorted(path for pattern in args.logs for path in (glob.glob(pattern) or [pattern]))
+    registry = Registry(args.templates)
+    sensors = [registry.sensor(name) for name in registry.sensors]
+    start = perf_counter()
+    results = reprocess(paths, sensors, args.output_dir, int(args.workers) if args.workers else None,
+                        int(args.chunk_size), int(args.max_pending) if args.max_pending else None)
+    elapsed = perf_counter() - start
+    rows = sum(result['rows'] for result in results)
+    report = {'config': vars(args), 'seconds': elapsed, 'rows': rows,
+              'rows_per_second': rows / elapsed if elapsed else None, 'logs': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info('Reprocessed %d logs (%d rows) in %.2f s', len(results), rows, elapsed)
@@ -5,3 +5,7 @@ from sensor import Sensor
 from session import Session
 from server import Server
 from client import Client
+from simulated_board import SimulatedBoard
+from registry import Registry
+from shared_session import SharedSession
+from shared_watchdog import SharedWatchdog
@@ -1,27 +1,51 @@
-from sensational import Sensor, Session, Server
+from sensational import Sensor, Session, Server, Registry
 from accelerometer import accelerometer, session
 import argparse
+import logging
 
 # Commmand line arguments
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--serial', help='Serial port of Arduino', required=True)
 parser.add_argument('-p', '--port', help='Websocket port', required=True)
 parser.add_argument('--log_interval', help='Number of cycles between logs', default='20')
+parser.add_argument('-b', '--baud_rate', help='Baud rate of Arduino', default='9600')
+parser.add_argument('--log_file', help='Local log file name (no extension)', default=None)
+parser.add_argument('--log_format', help='Local log format (hdf5 or segments)', default='hdf5')
+parser.add_argument('--log_raw', help='Also log raw values (see reprocess_logs.py)', action='store_true')
+parser.add_argument('--shared_buffer', help='Name of shared buffer for other processes', default=None)
+parser.add_argument('--metrics_port', help='Port of Prometheus metrics endpoint', default=None)
+parser.add_argument('--templates', help='Template directory (see Registry class)', default='Templates')
+parser.add_argument('--session', help='Name of session template to build the session from', default=None)
+parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='INFO')
 args = parser.parse_args()
-session['com_port'] = args.serial
-session['log_interval'] = int(args.log_interval)
+logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+overrides = {
+    'com_port': args.serial,
+    'baud_rate': int(args.baud_rate),
+    'log_file': args.log_file,
+    'log_interval': int(args.log_interval),
+    'shared_buffer': args.shared_buffer,
+    'log_format': args.log_format,
+    'log_raw': args.log_raw
+}
 
-# Init sensors
-accelerometer = Sensor(**accelerometer)
+if args.session:
+    # Init test session with sensors attached from templates
+    sess = Registry(args.templates).session(args.session, **overrides)
+else:
+    session.update(overrides)
 
-# Init test session
-sess = Session(**session)
+    # Init sensors
+    accelerometer = Sensor(**accelerometer)
 
-# Attach sensors
-sess.attach(accelerometer, 0)
+    # Init test session
+    sess = Session(**session)
+
+    # Attach sensors
+    sess.attach(accelerometer, 0)
 
 # Create server
-server = Server(sess, args.port)
+server = Server(sess, args.port, metrics_port=args.metrics_port)
 
 # Start server
 server.start()
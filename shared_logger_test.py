@@ -0,0 +1,38 @@
+from sensational import Sensor
+from shared_buffer import SharedRingBuffer
+from log_writer import LogWriter
+import argparse
+import os
+import time
+
+# Logs cycles of a Session running in another process (see Session.shared_buffer)
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--name', help='Name of shared buffer', required=True)
+parser.add_argument('--log_dir', help='Directory for log files', default='Logs')
+parser.add_argument('--log_file', help='Log file name (no extension)', default='shared')
+parser.add_argument('--interval', help='Time between reads (in s)', default='0.1')
+args = parser.parse_args()
+
+# Attach to buffer of session process
+shared = SharedRingBuffer.attach(args.name)
+sensors = [Sensor(**info) for info in shared.meta['sensors']]
+os.makedirs(args.log_dir, exist_ok=True)
+log = LogWriter(os.path.join(args.log_dir, args.log_file + '.hdf5'), sensors)
+print('Logging %s to %s' % (shared.meta['session'], log.path))
+
+# Start with the next cycle
+last_count = shared.count()
+try:
+    while True:
+        time.sleep(float(args.interval))
+        count, (times, cycles, data) = shared.read_since(last_count)
+        if count - last_count > len(times):
+            print('Missed %d cycles' % (count - last_count - len(times)))
+        last_count = count
+        log.append(times, data)
+except KeyboardInterrupt:
+    pass
+finally:
+    log.close()
+    shared.close()
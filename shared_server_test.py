@@ -0,0 +1,23 @@
+from sensational import Server, SharedSession
+import argparse
+import logging
+
+# Serves a Session running in another process (see Session.shared_buffer), so
+# websocket clients and encoding do not share the GIL of the acquisition process
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--name', help='Name of shared buffer', required=True)
+parser.add_argument('-p', '--port', help='Websocket port', required=True)
+parser.add_argument('--metrics_port', help='Port of Prometheus metrics endpoint', default=None)
+parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='INFO')
+args = parser.parse_args()
+logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+# Attach to buffer of session process
+sess = SharedSession(args.name)
+
+# Create server
+server = Server(sess, args.port, metrics_port=args.metrics_port)
+
+# Start server
+server.start()
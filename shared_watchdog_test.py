@@ -0,0 +1,24 @@
+from sensational import SharedWatchdog
+import argparse
+import logging
+
+# Checks thresholds of a Session running in another process (see
+# Session.shared_buffer) and shuts down if its cycles stop
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--name', help='Name of shared buffer', required=True)
+parser.add_argument('--timeout', help='Time without cycles before shutting down (in s)', default='1')
+parser.add_argument('--log_level', help='Logging level (DEBUG, INFO, WARNING, ...)', default='INFO')
+args = parser.parse_args()
+logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
+# Attach to buffer of session process
+watchdog = SharedWatchdog(args.name, timeout=float(args.timeout))
+print('Watching %s' % watchdog.shared.meta['session'])
+try:
+    watchdog.run()
+except KeyboardInterrupt:
+    pass
+finally:
+    print(watchdog.get_stats())
+    watchdog.close()
@@ -0,0 +1,57 @@
+"""
+Startup benchmark
+
+Measures how long it takes to get back online after a restart: importing the
+sensational modules and building a Sensor (compiling its conversions), each in
+a fresh interpreter. Writes a JSON report with the median / max of each.
+
+    python startup_benchmark.py --repeat 10
+"""
+from accelerometer import accelerometer
+import argparse
+import json
+import subprocess
+import sys
+import numpy as np
+
+# Commmand line arguments
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', help='Number of fresh interpreters per measurement', default='5')
+parser.add_argument('--conversion', help='Conversion of test sensor', default=accelerometer['conversions'][0])
+parser.add_argument('-o', '--output', help='Results file', default='startup_results.json')
+args = parser.parse_args()
+
+# Run in a fresh interpreter, prints timings as JSON
+SCRIPT = '''
+import json, sys
+from time import perf_counter
+start = perf_counter()
+import sensational
+imported = perf_counter()
+from accelerometer import accelerometer
+sensor = sensational.Sensor(**dict(accelerometer, conversions=[%r]))
+built = perf_counter()
+print(json.dumps({'import': imported - start, 'sensor': built - imported, 'total': built - start,
+                  'sympy_imported': 'sympy' in sys.modules}))
+'''
+
+# Summary of timings (in s)
+def summary(values):
+    return {'median': float(np.median(values)), 'max': float(np.max(values))}
+
+runs = []
+for _ in range(int(args.repeat)):
+    output = subprocess.run([sys.executable, '-c', SCRIPT % args.conversion], stdout=subprocess.PIPE,
+                            check=True, universal_newlines=True).stdout
+    runs.append(json.loads(output.strip().splitlines()[-1]))
+
+results = {
+    'config': vars(args),
+    'python': sys.version,
+    'sympy_imported': any(run['sympy_imported'] for run in runs)
+}
+for key in ['import', 'sensor', 'total']:
+    results[key] = summary([run[key] for run in runs])
+with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+print(json.dumps(results, indent=2))